@@ -0,0 +1,163 @@
+import logging
+import threading
+
+
+# reserved key in permissions.json holding named groups of users
+GROUPS_KEY = '_groups'
+
+# built-in groups whose members come from Slack account flags
+ROLE_FLAGS = {
+    'admins': 'is_admin',
+    'owners': 'is_owner',
+}
+
+
+def member_roles(member):
+    if member.get('deleted'):
+        return frozenset()
+    return frozenset(role for role, flag in ROLE_FLAGS.items() if member.get(flag))
+
+
+class PermissionIndex(object):
+    """Per-command sets of the user IDs allowed to run each command.
+
+    permissions.json maps each command to null (anyone may run it) or a list
+    of usernames and '@group' references. Groups are defined under '_groups'
+    and may nest; '@admins' and '@owners' are built in and follow the Slack
+    account flags. Each list is compiled into a frozenset of user IDs so a
+    check is a single set lookup, and membership changes only recompile the
+    commands that mention the user or one of their roles.
+    """
+
+    def __init__(self, directory, permissions=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.rules = {}
+        self.allowed = {}
+        self.name_refs = {}
+        self.role_refs = {}
+        # roles are only tracked for the few members that hold one
+        self.user_roles = {}
+        self.role_members = dict((role, set()) for role in ROLE_FLAGS)
+        # bumped whenever the set of commands changes
+        self.generation = 0
+        if permissions is not None:
+            self.load_permissions(permissions)
+
+    def __contains__(self, command):
+        return command in self.allowed
+
+    def commands(self):
+        return sorted(self.allowed)
+
+    def is_allowed(self, command, user_id):
+        allowed = self.allowed[command]
+        return allowed is None or user_id in allowed
+
+    def load_permissions(self, permissions):
+        groups = permissions.get(GROUPS_KEY) or {}
+        rules = {}
+        for command, entries in permissions.items():
+            if command == GROUPS_KEY:
+                continue
+            if entries is None:
+                rules[command] = None
+            elif type(entries) is list:
+                rules[command] = self.expand(command, entries, groups, ())
+            else:
+                logging.warning("Value for permission key '{}' was not a list; nobody may run it.".format(command))
+                rules[command] = (frozenset(), frozenset())
+
+        name_refs = {}
+        role_refs = {}
+        for command, rule in rules.items():
+            if rule is None:
+                continue
+            names, roles = rule
+            for name in names:
+                name_refs.setdefault(name, set()).add(command)
+            for role in roles:
+                role_refs.setdefault(role, set()).add(command)
+
+        with self.lock:
+            self.rules = rules
+            self.name_refs = name_refs
+            self.role_refs = role_refs
+            self.allowed = dict((command, self.compile(rule)) for command, rule in rules.items())
+            self.generation += 1
+        logging.info("Compiled permissions for {} commands.".format(len(rules)))
+
+    def expand(self, command, entries, groups, seen):
+        names = set()
+        roles = set()
+        for entry in entries:
+            if not entry.startswith('@'):
+                names.add(entry)
+                continue
+            group = entry[1:]
+            if group in groups:
+                if group in seen:
+                    logging.warning("Group '{}' includes itself; ignoring the cycle.".format(group))
+                    continue
+                n, r = self.expand(command, groups[group] or [], groups, seen + (group,))
+                names |= n
+                roles |= r
+            elif group in ROLE_FLAGS:
+                roles.add(group)
+            else:
+                logging.warning("Unknown group '{}' in permission list for command '{}'.".format(group, command))
+        return frozenset(names), frozenset(roles)
+
+    def compile(self, rule):
+        if rule is None:
+            return None
+        names, roles = rule
+        ids = set()
+        for name in names:
+            user_id = self.directory.id_for_name(name)
+            if user_id is None:
+                logging.warning("Username in permission list not found: {}".format(name))
+                continue
+            ids.add(user_id)
+        for role in roles:
+            ids |= self.role_members[role]
+        return frozenset(ids)
+
+    def load_members(self):
+        members = self.directory.members()
+        with self.lock:
+            self.user_roles = {}
+            self.role_members = dict((role, set()) for role in ROLE_FLAGS)
+            for m in members:
+                self.index_roles(m)
+            self.allowed = dict((command, self.compile(rule)) for command, rule in self.rules.items())
+
+    def index_roles(self, member):
+        user_id = member['id']
+        old_roles = self.user_roles.get(user_id, frozenset())
+        roles = member_roles(member)
+        for role in old_roles - roles:
+            self.role_members[role].discard(user_id)
+        for role in roles - old_roles:
+            self.role_members[role].add(user_id)
+        if roles:
+            self.user_roles[user_id] = roles
+        else:
+            self.user_roles.pop(user_id, None)
+        return old_roles ^ roles
+
+    def update_member(self, member, old_name=None):
+        # the directory has already been updated with the member
+        if 'id' not in member or 'name' not in member:
+            return
+        with self.lock:
+            changed_roles = self.index_roles(member)
+            commands = set(self.name_refs.get(member['name'], ()))
+            if old_name is not None and old_name != member['name']:
+                commands |= self.name_refs.get(old_name, set())
+            for role in changed_roles:
+                commands |= self.role_refs.get(role, set())
+            for command in commands:
+                self.allowed[command] = self.compile(self.rules[command])
+        if commands:
+            logging.info("Recompiled permissions for {} after a change to {}.".format(sorted(commands), member['name']))
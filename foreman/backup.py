@@ -0,0 +1,260 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+
+# bytes per stored chunk; region files are rewritten a 4 KiB sector at a
+# time, so a small edit only changes the chunks it falls in
+CHUNK_SIZE = 256 * 1024
+
+# files hashed or restored at the same time
+DEFAULT_WORKERS = 4
+
+# snapshots kept per server when pruning
+DEFAULT_KEEP = 14
+
+SNAPSHOT_FORMAT = "%Y%m%d-%H%M%S"
+
+
+class BackupException(Exception):
+    def __init__(self, message):
+        super(BackupException, self).__init__(message)
+        self.message = message
+
+
+def walk_files(root):
+    """Paths of every regular file under root, relative to it."""
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                yield os.path.relpath(path, root)
+
+
+class ChunkStore(object):
+    """Content-addressed chunks and per-server snapshot manifests.
+
+    Chunks live under chunks/ named by their SHA-256, so a chunk shared by
+    any number of files or snapshots is stored once. Each snapshot is a JSON
+    manifest under snapshots/<server>/ listing every file with its size,
+    mtime and chunk hashes.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        # backups writing chunks not yet in a manifest; no garbage collection
+        # while there are any
+        self.writers = 0
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self.lock:
+            self.writers += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.writers -= 1
+
+    def chunk_path(self, digest):
+        return os.path.join(self.root, 'chunks', digest[:2], digest)
+
+    def put_chunk(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+        return digest, True
+
+    def get_chunk(self, digest):
+        with open(self.chunk_path(digest), 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise BackupException("chunk {} is corrupt".format(digest))
+        return data
+
+    def snapshot_dir(self, server_id):
+        return os.path.join(self.root, 'snapshots', server_id)
+
+    def snapshots(self, server_id):
+        """Snapshot names for a server, oldest first."""
+        directory = self.snapshot_dir(server_id)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(n[:-len('.json')] for n in os.listdir(directory) if n.endswith('.json'))
+
+    def load_manifest(self, server_id, name=None):
+        """A snapshot's manifest; the latest one if name is None."""
+        names = self.snapshots(server_id)
+        if name is None:
+            if not names:
+                return None
+            name = names[-1]
+        elif name not in names:
+            # names come from chat, so they're never joined into a path unchecked
+            return None
+        path = os.path.join(self.snapshot_dir(server_id), name + '.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        directory = self.snapshot_dir(manifest['server'])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, manifest['name'] + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+    def prune(self, server_id, keep):
+        """Drop all but the newest `keep` snapshots, then unreferenced chunks."""
+        names = self.snapshots(server_id)
+        for name in names[:max(0, len(names) - keep)]:
+            logging.info("Pruning backup {} of {}.".format(name, server_id))
+            os.remove(os.path.join(self.snapshot_dir(server_id), name + '.json'))
+        return self.collect_garbage()
+
+    def collect_garbage(self):
+        with self.lock:
+            if self.writers:
+                logging.info("Backups are in progress; skipping garbage collection.")
+                return 0
+            referenced = set()
+            snapshots_root = os.path.join(self.root, 'snapshots')
+            if os.path.isdir(snapshots_root):
+                for server_id in os.listdir(snapshots_root):
+                    for name in self.snapshots(server_id):
+                        manifest = self.load_manifest(server_id, name)
+                        for entry in manifest['files'].values():
+                            referenced.update(entry['chunks'])
+
+            removed = 0
+            chunks_root = os.path.join(self.root, 'chunks')
+            if os.path.isdir(chunks_root):
+                for prefix in os.listdir(chunks_root):
+                    for digest in os.listdir(os.path.join(chunks_root, prefix)):
+                        if digest not in referenced:
+                            os.remove(os.path.join(chunks_root, prefix, digest))
+                            removed += 1
+            return removed
+
+
+class BackupEngine(object):
+    """Incremental backups of server world directories into a ChunkStore.
+
+    A file whose size and mtime match the previous snapshot is carried over
+    without being read, so a backup costs as much as what changed since the
+    last one, not the size of the world. Changed files are split into
+    chunks, and only chunks the store doesn't already hold are written.
+    Restores stream every file's chunks back in parallel into a fresh
+    directory that then replaces the world.
+    """
+
+    def __init__(self, store, workers=DEFAULT_WORKERS):
+        self.store = store
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup')
+
+    def store_file(self, root, relpath):
+        path = os.path.join(root, relpath)
+        stat = os.stat(path)
+        chunks = []
+        written = 0
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest, created = self.store.put_chunk(data)
+                chunks.append(digest)
+                if created:
+                    written += len(data)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'chunks': chunks}
+        return entry, written
+
+    def backup(self, server_id, root, progress=None):
+        """Snapshot the files under root; returns the new manifest."""
+        if not os.path.isdir(root):
+            raise BackupException("world directory {} not found".format(root))
+
+        previous = self.store.load_manifest(server_id)
+        previous_files = previous['files'] if previous else {}
+        files = {}
+        changed = []
+        for relpath in walk_files(root):
+            stat = os.stat(os.path.join(root, relpath))
+            old = previous_files.get(relpath)
+            if old is not None and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime_ns:
+                files[relpath] = old
+            else:
+                changed.append(relpath)
+
+        if progress:
+            progress("{} of {} files changed since the last backup".format(len(changed), len(files) + len(changed)))
+        written = 0
+        with self.store.writing():
+            futures = dict((self.executor.submit(self.store_file, root, relpath), relpath) for relpath in changed)
+            for future in concurrent.futures.as_completed(futures):
+                entry, size = future.result()
+                files[futures[future]] = entry
+                written += size
+
+            manifest = {
+                'server': server_id,
+                'name': time.strftime(SNAPSHOT_FORMAT, time.gmtime()),
+                'created': time.time(),
+                'files': files,
+                'changed': len(changed),
+                'written': written,
+            }
+            self.store.save_manifest(manifest)
+        return manifest
+
+    def restore_file(self, target, relpath, entry):
+        path = os.path.join(target, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            for digest in entry['chunks']:
+                f.write(self.store.get_chunk(digest))
+        os.utime(path, ns=(entry['mtime'], entry['mtime']))
+        return entry['size']
+
+    def restore(self, server_id, root, name=None, progress=None):
+        """Replace root with a snapshot; the old directory is kept aside.
+
+        Returns (manifest, path the old directory was moved to).
+        """
+        manifest = self.store.load_manifest(server_id, name)
+        if manifest is None:
+            raise BackupException("no backup {}for {}".format(name + " " if name else "", server_id))
+
+        stamp = time.strftime(SNAPSHOT_FORMAT, time.gmtime())
+        staging = "{}.restore-{}".format(root.rstrip(os.sep), stamp)
+        if progress:
+            progress("Restoring {} files from {}".format(len(manifest['files']), manifest['name']))
+        try:
+            os.makedirs(staging)
+            futures = [self.executor.submit(self.restore_file, staging, relpath, entry)
+                       for relpath, entry in manifest['files'].items()]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        aside = None
+        if os.path.exists(root):
+            aside = "{}.before-restore-{}".format(root.rstrip(os.sep), stamp)
+            os.rename(root, aside)
+        os.rename(staging, root)
+        return manifest, aside
@@ -0,0 +1,766 @@
+#!/usr/bin/env python
+"""Benchmark and load-test harness for foreman.
+
+Replays synthetic RTM event streams through process_event with in-process
+fakes of the Slack Web API, the RTM client, the Docker daemons and the
+Server List Ping prober, each with configurable latency. Reports per-event
+dispatch cost, events/sec and reply latency percentiles under load, and the
+Slack and Docker API calls each command makes. Results can be written as
+JSON to compare versions.
+
+With --check it instead runs the real clients against local fake servers,
+and the backup engine against a temporary world, and reports whether each
+behaves as it should.
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import http.server
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import backup
+import fleet
+import foreman
+import rcon
+import slackapi
+import slp
+
+
+BOT_ID = 'UFOREMAN'
+SENDER_ID = 'U0000001'
+CHANNEL_ID = 'C0000001'
+IM_CHANNEL_ID = 'D0000001'
+
+# senders that aren't in the user directory, so get_user goes to users.info
+UNKNOWN_SENDERS = ['B{:07d}'.format(i) for i in range(50)]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class CallCounter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class FakeSlackApi(object):
+    """Stands in for slackapi.SlackApi; answers every call after `latency`."""
+
+    def __init__(self, counter, latency=0.0):
+        self.counter = counter
+        self.latency = latency
+        self.ts = 0
+
+    def call(self, method, priority=None, timeout=None, **params):
+        self.counter.count("slack:" + method)
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'users.info':
+            return {'ok': True, 'user': {'id': params['user'], 'name': params['user'].lower(), 'is_bot': True}}
+        self.ts += 1
+        return {'ok': True, 'channel': params.get('channel'), 'ts': "{}.000".format(self.ts)}
+
+
+class FakeSlackClient(object):
+    def __init__(self, counter):
+        self.counter = counter
+
+    def rtm_send_message(self, channel, message):
+        self.counter.count("slack:rtm.send")
+
+
+class FakeContainers(object):
+    def __init__(self, docker):
+        self.docker = docker
+
+    def list(self, **kwargs):
+        self.docker.called('containers.list')
+        return [fleet.dockerstate.ContainerState(dict(c)) for c in self.docker.listing]
+
+
+class FakeApi(object):
+    def __init__(self, docker):
+        self.docker = docker
+
+    def containers(self, **kwargs):
+        self.docker.called('api.containers')
+        return [dict(c) for c in self.docker.listing]
+
+    def stats(self, container_id, **kwargs):
+        self.docker.called('api.stats')
+        return fake_stats()
+
+    def logs(self, container_id, **kwargs):
+        self.docker.called('api.logs')
+        return fake_logs()
+
+
+def fake_logs():
+    # what the daemon has, then a new line a second while followed
+    for i in itertools.count():
+        level = 'WARN' if i % 10 == 0 else 'INFO'
+        yield "2024-01-01T00:00:{:02d}.000000000Z [00:00:00] [Server thread/{}]: line {}\n".format(i % 60, level, i).encode()
+        if i >= 1000:
+            time.sleep(1)
+
+
+def fake_stats():
+    # a docker stats stream: the first reading has no precpu_stats, then one
+    # a second
+    previous = {}
+    for i in itertools.count():
+        cpu = {'cpu_usage': {'total_usage': i * 5 * 10 ** 8}, 'system_cpu_usage': i * 10 ** 9, 'online_cpus': 4}
+        yield {
+            'cpu_stats': cpu,
+            'precpu_stats': previous,
+            'memory_stats': {'usage': (1024 + i) << 20, 'limit': 16 << 30, 'stats': {'inactive_file': 64 << 20}},
+            'networks': {'eth0': {'rx_bytes': i * 4096, 'tx_bytes': i * 16384}},
+            'blkio_stats': {'io_service_bytes_recursive': [{'op': 'Read', 'value': i * 1024}, {'op': 'Write', 'value': i * 8192}]},
+        }
+        previous = cpu
+        if i > 0:
+            time.sleep(1)
+
+
+class FakeDockerClient(object):
+    """A daemon whose containers are `listing`, answering after `latency`."""
+
+    def __init__(self, counter, listing, latency=0.0):
+        self.counter = counter
+        self.listing = listing
+        self.latency = latency
+        self.containers = FakeContainers(self)
+        self.api = FakeApi(self)
+
+    def called(self, name):
+        self.counter.count("docker:" + name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def events(self, **kwargs):
+        self.called('events')
+        return FakeEventStream()
+
+    def close(self):
+        pass
+
+
+class FakeEventStream(object):
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        self.closed.wait()
+        return iter(())
+
+    def close(self):
+        self.closed.set()
+
+
+class UnsyncedState(object):
+    """A Docker state cache that never syncs, so every listing hits the daemon."""
+
+    def staleness(self):
+        return None
+
+    def stop(self):
+        pass
+
+
+class FakeProber(object):
+    def __init__(self, counter, latency=0.0):
+        self.counter = counter
+        self.latency = latency
+
+    async def probe_many(self, addresses):
+        self.counter.count("slp:ping")
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        response = {'version': {'name': '1.12.2'}, 'players': {'online': 0, 'max': 20}, 'description': 'bench'}
+        return dict((a, slp.ServerStatus(a[0], a[1], response=response, latency=1.0)) for a in addresses)
+
+
+def container_listing(servers, noise):
+    listing = []
+    for i, s in enumerate(servers):
+        listing.append({
+            'Id': "{:064x}".format(i + 1),
+            'Names': ["/" + s['id']],
+            'Image': foreman.server_image(s),
+            'Labels': {foreman.SERVER_LABEL: s['id']},
+            'State': 'running' if i % 2 == 0 else 'exited',
+        })
+    for i in range(noise):
+        listing.append({
+            'Id': "{:064x}".format(len(servers) + i + 1),
+            'Names': ["/noise-{}".format(i)],
+            'Image': "unrelated/app-{}:latest".format(i % 7),
+            'Labels': {},
+            'State': 'running',
+        })
+    return listing
+
+
+def setup(options, counter):
+    with open(options.permissions) as p:
+        permissions = json.load(p)
+    with open(options.servers) as s:
+        servers = json.load(s)
+    # let everyone run everything so every command is exercised
+    permissions = dict((command, None) for command in permissions)
+
+    foreman.snapshot = foreman.ConfigSnapshot({}, permissions, servers)
+    foreman.slack_api = FakeSlackApi(counter, options.slack_latency)
+    foreman.sc = FakeSlackClient(counter)
+    foreman.user_cache = foreman.init_user_cache()
+    foreman.prober = FakeProber(counter, options.probe_latency)
+    foreman.stats_collector = foreman.telemetry.StatsCollector()
+    foreman.log_tailer = foreman.logtail.LogTailer()
+    foreman.job_engine = foreman.jobs.JobEngine()
+    foreman.my_identity = BOT_ID
+    foreman.mention_matcher = foreman.init_mention_matcher(BOT_ID)
+    foreman.im_channels = {IM_CHANNEL_ID: SENDER_ID}
+    foreman.im_channels_loaded_at = time.time()
+
+    foreman.user_directory.update({'id': SENDER_ID, 'name': 'bench'})
+    foreman.permission_index.load_permissions(permissions)
+    foreman.permission_index.load_members()
+
+    listing = container_listing(servers, options.noise_containers)
+    docker_fleet = fleet.DockerFleet()
+    docker_fleet.connect = lambda base_url: FakeDockerClient(counter, listing, options.docker_latency)
+    docker_fleet.configure(foreman.snapshot.docker_endpoints)
+    foreman.docker_fleet = docker_fleet
+    foreman.image_prewarmer = foreman.prewarm.ImagePrewarmer(docker_fleet)
+    for name in foreman.snapshot.docker_endpoints:
+        if options.docker_events:
+            docker_fleet.state(name).synced.wait(5)
+        else:
+            docker_fleet.states.pop(name).stop()
+            docker_fleet.states[name] = UnsyncedState()
+
+
+def message(text, channel=CHANNEL_ID, user=SENDER_ID):
+    return {'type': 'message', 'channel': channel, 'user': user, 'text': text, 'ts': '1.0'}
+
+
+# command text for each command exercised; status is listed twice to cover
+# the all-servers and single-server paths
+COMMANDS = [
+    ('help', "help"),
+    ('list', "list"),
+    ('status', "status"),
+    ('status-one', "status {server}"),
+    ('jobs', "jobs"),
+    ('stats', "stats"),
+    ('logs', "logs {server} level:warn 10"),
+    ('unknown', "frobnicate"),
+]
+
+DISPATCH_SCENARIOS = [
+    ('noise', lambda: message("anyone up for the nether later?")),
+    ('other-mention', lambda: message("<@U9999999> can you start it?")),
+    ('presence', lambda: {'type': 'presence_change', 'user': SENDER_ID, 'presence': 'active'}),
+    ('mention-help', lambda: message("<@{}> help".format(BOT_ID))),
+    ('im-help', lambda: message("help", channel=IM_CHANNEL_ID)),
+    ('im-unknown', lambda: message("frobnicate", channel=IM_CHANNEL_ID)),
+    ('unknown-sender-help', lambda: message("<@{}> help".format(BOT_ID), user=random.choice(UNKNOWN_SENDERS))),
+]
+
+
+def command_event(text, rng):
+    if rng.random() < 0.5:
+        return message("<@{}> {}".format(BOT_ID, text))
+    return message(text, channel=IM_CHANNEL_ID)
+
+
+def synthetic_stream(count, mix, rng):
+    """Events in the proportions of mix: noise, mention, im, unknown-sender."""
+    server_ids = [s['id'] for s in foreman.snapshot.servers]
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    events = []
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        text = rng.choice(COMMANDS)[1].format(server=rng.choice(server_ids))
+        if kind == 'noise':
+            events.append(message("just chatting about builds {}".format(i)))
+        elif kind == 'mention':
+            events.append(message("<@{}> {}".format(BOT_ID, text)))
+        elif kind == 'im':
+            events.append(message(text, channel=IM_CHANNEL_ID))
+        else:
+            events.append(message("<@{}> {}".format(BOT_ID, text), user=rng.choice(UNKNOWN_SENDERS)))
+    return events
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def bench_dispatch(iterations):
+    results = {}
+    for name, make_event in DISPATCH_SCENARIOS:
+        events = [make_event() for i in range(iterations)]
+        start = time.perf_counter()
+        for event in events:
+            foreman.process_event(event)
+        results[name] = (time.perf_counter() - start) / iterations * 1e6
+    return results
+
+
+def bench_commands(repeat, counter):
+    server_id = foreman.snapshot.servers[0]['id']
+    rng = random.Random(1)
+    results = {}
+    for name, text in COMMANDS:
+        before = counter.snapshot()
+        start = time.perf_counter()
+        for i in range(repeat):
+            foreman.process_event(command_event(text.format(server=server_id), rng))
+        elapsed = time.perf_counter() - start
+        after = counter.snapshot()
+        calls = dict((k, round((after.get(k, 0) - before.get(k, 0)) / float(repeat), 3))
+                     for k in after if after.get(k, 0) != before.get(k, 0))
+        results[name] = {'ms_per_command': elapsed / repeat * 1e3, 'calls_per_command': calls}
+    return results
+
+
+async def replay(events, workers):
+    loop = asyncio.get_running_loop()
+    foreman.event_loop = loop
+    foreman.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    latencies = []
+
+    async def timed(event):
+        started = time.perf_counter()
+        await foreman.handle_event(loop, event)
+        latencies.append(time.perf_counter() - started)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[timed(e) for e in events])
+    elapsed = time.perf_counter() - start
+    foreman.executor.shutdown()
+    foreman.event_loop = None
+    return latencies, elapsed
+
+
+def bench_load(count, mix, workers, counter, seed):
+    events = synthetic_stream(count, mix, random.Random(seed))
+    before = counter.snapshot()
+    latencies, elapsed = asyncio.run(replay(events, workers))
+    after = counter.snapshot()
+    return {
+        'events': count,
+        'workers': workers,
+        'mix': mix,
+        'seconds': elapsed,
+        'events_per_sec': count / elapsed,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1e3,
+            'p90': percentile(latencies, 90) * 1e3,
+            'p99': percentile(latencies, 99) * 1e3,
+            'max': max(latencies) * 1e3,
+        },
+        'calls': dict((k, after.get(k, 0) - before.get(k, 0)) for k in after),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, weight = part.split('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+class FakeSlackHandler(http.server.BaseHTTPRequestHandler):
+    """Answers Web API calls like Slack, counting them by method.
+
+    users.info is slow, so concurrent reads overlap; chat.postMessage is
+    rate limited on its first call.
+    """
+
+    def do_POST(self):
+        server = self.server
+        method = self.path.rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        with server.lock:
+            server.calls[method] += 1
+            server.forms.append((method, form, self.headers.get('Authorization')))
+            calls = server.calls[method]
+        if method == 'users.info':
+            time.sleep(0.2)
+        if method == 'chat.postMessage' and calls == 1:
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            body = {'ok': False, 'error': 'ratelimited'}
+        else:
+            self.send_response(200)
+            body = {'ok': True, 'method': method}
+        data = json.dumps(body).encode('utf-8')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def check_slack_api():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeSlackHandler)
+    server.lock = threading.Lock()
+    server.calls = collections.Counter()
+    server.forms = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = slackapi.SlackApi(slackapi.HttpTransport('xoxb-check', base_url="http://127.0.0.1:{}/api/".format(server.server_port)))
+    results = []
+    try:
+        futures = [api.submit('users.info', user='U1') for i in range(5)]
+        responses = [f.result(10) for f in futures]
+        results.append(("identical concurrent reads share one request",
+                        server.calls['users.info'] == 1 and all(r.get('ok') for r in responses)))
+
+        started = time.monotonic()
+        response = api.call('chat.postMessage', timeout=10, channel=CHANNEL_ID, text="hi",
+                            attachments=slackapi.Encoded('[{"text":"pre-serialised"}]'))
+        waited = time.monotonic() - started
+        results.append(("a 429 is retried after Retry-After",
+                        response.get('ok') and server.calls['chat.postMessage'] == 2 and waited >= 1))
+        method, form, authorization = server.forms[-1]
+        results.append(("parameters and token are posted as a form",
+                        form.get('attachments') == ['[{"text":"pre-serialised"}]'] and
+                        authorization == "Bearer xoxb-check"))
+
+        # tier 3 allows a burst of 5, then one call every 1.2s
+        started = time.monotonic()
+        futures = [api.submit('chat.update', channel=CHANNEL_ID, ts=str(i), text="x") for i in range(6)]
+        for f in futures[:5]:
+            f.result(10)
+        burst_time = time.monotonic() - started
+        futures[5].result(10)
+        results.append(("calls beyond a method's burst wait for its token bucket",
+                        burst_time < 0.5 and time.monotonic() - started >= 1.0))
+    finally:
+        server.shutdown()
+    return results
+
+
+STATUS_RESPONSE = {
+    'version': {'name': "1.20.4", 'protocol': 765},
+    'players': {'max': 20, 'online': 2, 'sample': [{'name': "steve", 'id': "0"}, {'name': "alex", 'id': "1"}]},
+    'description': {'text': "§aA ", 'extra': [{'text': "Minecraft"}, " §lServer"]},
+}
+
+
+async def fake_slp_server(reader, writer, connections, handshakes, broken=False):
+    connections.append(writer)
+    try:
+        packet_id, payload = await slp.read_packet(reader)
+        protocol, offset = slp.unpack_varint(payload)
+        length, offset = slp.unpack_varint(payload, offset)
+        host = payload[offset:offset + length].decode('utf-8')
+        next_state, offset = slp.unpack_varint(payload, offset + length + 2)
+        handshakes.append((packet_id, host, next_state))
+        packet_id, payload = await slp.read_packet(reader)
+        if broken:
+            writer.write(slp.pack_packet(0x05, b'nonsense'))
+        else:
+            writer.write(slp.pack_packet(0x00, slp.pack_string(json.dumps(STATUS_RESPONSE))))
+        await writer.drain()
+        packet_id, payload = await slp.read_packet(reader)
+        # answer the ping with its own payload
+        writer.write(slp.pack_packet(0x01, payload))
+        await writer.drain()
+    except (EOFError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def check_slp_async():
+    connections = []
+    handshakes = []
+    server = await asyncio.start_server(
+        lambda r, w: fake_slp_server(r, w, connections, handshakes), '127.0.0.1', 0)
+    broken = await asyncio.start_server(
+        lambda r, w: fake_slp_server(r, w, [], [], broken=True), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    broken_port = broken.sockets[0].getsockname()[1]
+    results = []
+    try:
+        status = await slp.ping('127.0.0.1', port, timeout=2)
+        results.append(("a status response is parsed", status.ready and status.online == 2 and status.max == 20 and
+                        status.version == "1.20.4" and status.players == ["steve", "alex"]))
+        results.append(("the MOTD is flattened and stripped of formatting", status.motd == "A Minecraft Server"))
+        results.append(("the handshake asks for status", handshakes == [(0x00, '127.0.0.1', 1)]))
+        results.append(("the ping is timed", status.latency is not None and status.latency >= 0))
+
+        prober = slp.Prober(ttl=60, timeout=2)
+        before = len(connections)
+        statuses = await asyncio.gather(*[prober.probe('127.0.0.1', port) for i in range(3)])
+        await prober.probe('127.0.0.1', port)
+        results.append(("concurrent and repeated probes share one ping",
+                        len(connections) - before == 1 and all(s.ready for s in statuses)))
+
+        status = await slp.ping('127.0.0.1', broken_port, timeout=2)
+        results.append(("a bad response is reported, not raised", not status.ready and status.error))
+        server.close()
+        await server.wait_closed()
+        status = await slp.ping('127.0.0.1', port, timeout=2)
+        results.append(("a closed port isn't ready", not status.ready))
+    finally:
+        server.close()
+        broken.close()
+    return results
+
+
+def check_slp():
+    return asyncio.run(check_slp_async())
+
+
+def check_backup():
+    root = tempfile.mkdtemp(prefix='foreman-check-')
+    world = os.path.join(root, 'world')
+    files = {'level.dat': b'level', os.path.join('region', 'r.0.0.mca'): os.urandom(3 * backup.CHUNK_SIZE // 2)}
+    engine = backup.BackupEngine(backup.ChunkStore(os.path.join(root, 'backups')))
+    results = []
+    try:
+        for relpath, data in files.items():
+            os.makedirs(os.path.dirname(os.path.join(world, relpath)), exist_ok=True)
+            with open(os.path.join(world, relpath), 'wb') as f:
+                f.write(data)
+        first = engine.backup('check', world)
+        results.append(("a first backup stores every file", first['changed'] == 2 and sorted(first['files']) == sorted(files)))
+        again = engine.backup('check', world)
+        results.append(("unchanged files are carried over unread", again['changed'] == 0 and again['written'] == 0))
+
+        # snapshots are named to the second
+        time.sleep(1.1)
+        with open(os.path.join(world, 'level.dat'), 'wb') as f:
+            f.write(b'changed level')
+        changed = engine.backup('check', world)
+        results.append(("only the changed file is stored again",
+                        changed['changed'] == 1 and changed['written'] == len(b'changed level')))
+
+        manifest, aside = engine.restore('check', world, first['name'])
+        restored = {}
+        for relpath in backup.walk_files(world):
+            with open(os.path.join(world, relpath), 'rb') as f:
+                restored[relpath] = f.read()
+        with open(os.path.join(aside, 'level.dat'), 'rb') as f:
+            kept = f.read()
+        results.append(("a restore brings back the snapshot and keeps the old world aside",
+                        manifest['name'] == first['name'] and restored == files and kept == b'changed level'))
+
+        try:
+            engine.restore('check', world, os.path.join('..', first['name']))
+            rejected = False
+        except backup.BackupException:
+            rejected = True
+        results.append(("a snapshot name that isn't listed is refused", rejected))
+    finally:
+        engine.executor.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+async def fake_rcon_server(reader, writer, password, connections):
+    connections.append(asyncio.current_task())
+    try:
+        request_id, packet_type, body = await rcon.read_packet(reader)
+        # some servers send an empty response value before the auth response
+        writer.write(rcon.pack_packet(request_id, rcon.SERVERDATA_RESPONSE_VALUE, ''))
+        if body != password:
+            writer.write(rcon.pack_packet(-1, rcon.SERVERDATA_AUTH_RESPONSE, ''))
+            await writer.drain()
+            return
+        writer.write(rcon.pack_packet(request_id, rcon.SERVERDATA_AUTH_RESPONSE, ''))
+        await writer.drain()
+        while True:
+            request_id, packet_type, body = await rcon.read_packet(reader)
+            if packet_type == rcon.END_MARKER_TYPE:
+                writer.write(rcon.pack_packet(request_id, rcon.SERVERDATA_RESPONSE_VALUE, "Unknown request c8"))
+            elif body == 'drop':
+                return
+            elif body == 'long':
+                # more than fits one packet, so it's split
+                writer.write(rcon.pack_packet(request_id, rcon.SERVERDATA_RESPONSE_VALUE, 'a' * rcon.MAX_PAYLOAD))
+                writer.write(rcon.pack_packet(request_id, rcon.SERVERDATA_RESPONSE_VALUE, 'b' * 10))
+            else:
+                writer.write(rcon.pack_packet(request_id, rcon.SERVERDATA_RESPONSE_VALUE, "ran " + body))
+            await writer.drain()
+    except (EOFError, asyncio.IncompleteReadError, ConnectionError, rcon.RconException):
+        pass
+    finally:
+        writer.close()
+
+
+async def check_rcon_async():
+    connections = []
+    server = await asyncio.start_server(
+        lambda r, w: fake_rcon_server(r, w, 'secret', connections), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    pool = rcon.RconPool(timeout=2)
+    results = []
+    try:
+        response = await pool.command('check', '127.0.0.1', port, 'secret', "list")
+        results.append(("a command's response is returned", response == "ran list"))
+
+        responses = await asyncio.gather(*[pool.command('check', '127.0.0.1', port, 'secret', "say {}".format(i))
+                                           for i in range(5)])
+        results.append(("concurrent commands are pipelined over one connection",
+                        responses == ["ran say {}".format(i) for i in range(5)] and len(connections) == 1))
+
+        response = await pool.command('check', '127.0.0.1', port, 'secret', "long")
+        results.append(("a split response is joined", response == 'a' * rcon.MAX_PAYLOAD + 'b' * 10))
+
+        try:
+            await pool.command('bad', '127.0.0.1', port, 'wrong', "list")
+            refused = False
+        except rcon.RconException as e:
+            refused = e.message == "authentication failed"
+        results.append(("a wrong password is reported", refused))
+
+        try:
+            await pool.command('check', '127.0.0.1', port, 'secret', "drop")
+            lost = False
+        except rcon.RconException:
+            lost = True
+        before = len(connections)
+        response = await pool.command('check', '127.0.0.1', port, 'secret', "list")
+        results.append(("a dropped connection fails its command and is reopened",
+                        lost and response == "ran list" and len(connections) == before + 1))
+    finally:
+        pool.close()
+        server.close()
+        # let each connection see its client go before the loop closes
+        await asyncio.wait(connections, timeout=2)
+    return results
+
+
+def check_rcon():
+    return asyncio.run(check_rcon_async())
+
+
+def run_checks():
+    failed = 0
+    for name, check in CHECKS:
+        try:
+            results = check()
+        except Exception as e:
+            results = [("{} ran".format(name), False)]
+            logging.exception("{} check failed.".format(name))
+        for description, ok in results:
+            print("{:>10}: {} {}".format(name, "ok    " if ok else "FAILED", description))
+            if not ok:
+                failed += 1
+    return failed
+
+
+CHECKS = [
+    ('slackapi', check_slack_api),
+    ('slp', check_slp),
+    ('backup', check_backup),
+    ('rcon', check_rcon),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark foreman against fake Slack and Docker backends.')
+    parser.add_argument('--iterations', '-n', type=int, default=20000, help='events per dispatch scenario')
+    parser.add_argument('--commands', type=int, default=200, help='repetitions of each command')
+    parser.add_argument('--events', '-e', type=int, default=5000, help='events in the load-test stream')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix("noise=85,mention=7,im=5,unknown=3"),
+                        help='weights of noise, mention, im and unknown-sender events')
+    parser.add_argument('--workers', '-w', type=int, default=foreman.DEFAULT_WORKERS, help='event handler threads')
+    parser.add_argument('--slack-latency', type=float, default=0.02, help='seconds per Slack Web API call')
+    parser.add_argument('--docker-latency', type=float, default=0.005, help='seconds per Docker API call')
+    parser.add_argument('--probe-latency', type=float, default=0.005, help='seconds per Server List Ping batch')
+    parser.add_argument('--noise-containers', type=int, default=200, help='unrelated containers on each host')
+    parser.add_argument('--no-docker-events', dest='docker_events', action='store_false',
+                        help='run without the events-fed Docker state cache')
+    parser.add_argument('--metrics', action='store_true', help='record metrics, to measure their overhead')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--permissions', '-p', default=os.path.join(HERE, 'permissions.json'))
+    parser.add_argument('--servers', '-s', default=os.path.join(HERE, 'servers.json'))
+    parser.add_argument('--output', '-o', help='write results as JSON to this file')
+    parser.add_argument('--check', action='store_true', help='check the Slack, SLP and RCON clients and backups against local fakes, then exit')
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if options.check:
+        sys.exit(1 if run_checks() else 0)
+
+    counter = CallCounter()
+    setup(options, counter)
+    if options.metrics:
+        foreman.metrics.enable()
+
+    # dispatch cost is measured without backend latency
+    slack_latency, foreman.slack_api.latency = foreman.slack_api.latency, 0
+    dispatch = bench_dispatch(options.iterations)
+    foreman.slack_api.latency = slack_latency
+    for name, us in dispatch.items():
+        print("{:>20}: {:8.2f} us/event".format(name, us))
+
+    command_results = bench_commands(options.commands, counter)
+    for name, result in command_results.items():
+        calls = ", ".join("{}={}".format(k, v) for k, v in sorted(result['calls_per_command'].items()))
+        print("{:>20}: {:8.2f} ms/command  {}".format(name, result['ms_per_command'], calls))
+
+    load = bench_load(options.events, options.mix, options.workers, counter, options.seed)
+    print("{:>20}: {:.0f} events/sec, p50 {:.2f} ms, p99 {:.2f} ms".format(
+        'load', load['events_per_sec'], load['latency_ms']['p50'], load['latency_ms']['p99']))
+
+    if options.output:
+        results = {
+            'revision': git_revision(),
+            'timestamp': time.time(),
+            'options': dict((k, v) for k, v in vars(options).items() if k != 'output'),
+            'dispatch_us_per_event': dispatch,
+            'commands': command_results,
+            'load': load,
+        }
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Results written to {}.".format(options.output))
+
+
+if __name__ == "__main__":
+    main()
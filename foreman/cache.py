@@ -0,0 +1,126 @@
+import collections
+import threading
+import time
+
+
+# stored in place of a value for lookups that found nothing
+MISSING = object()
+
+
+class LRUCache(object):
+    """Size-bounded cache with least-recently-used eviction and per-entry TTL.
+
+    Lookups that find nothing can be cached as negative results with their own
+    TTL. get_or_load() coalesces concurrent loads of the same key, so only one
+    caller does the work and the others wait for its result.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, negative_ttl=None, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def lookup(self, key):
+        # returns MISSING for a cached negative result and None for a miss
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= self.clock():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.lookup(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        if value is MISSING:
+            return default
+        return value
+
+    def put(self, key, value):
+        if value is None:
+            ttl = self.negative_ttl
+            value = MISSING
+        else:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = self.clock() + ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_or_load(self, key, load):
+        """Return the cached value for key, calling load(key) on a miss.
+
+        A None result from load is cached as a negative result when the cache
+        has a negative TTL.
+        """
+        with self.lock:
+            value = self.lookup(key)
+            if value is not None:
+                self.hits += 1
+                return None if value is MISSING else value
+            self.misses += 1
+            pending = self.loading.get(key)
+            if pending is None:
+                pending = self.loading[key] = [threading.Event(), None, None]
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            pending[0].wait()
+            if pending[2] is not None:
+                raise pending[2]
+            return pending[1]
+
+        try:
+            value = load(key)
+            if value is not None or self.negative_ttl is not None:
+                self.put(key, value)
+            pending[1] = value
+            return value
+        except Exception as e:
+            pending[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.loading[key]
+            pending[0].set()
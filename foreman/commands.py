@@ -0,0 +1,103 @@
+import collections
+
+
+class UsageException(Exception):
+    def __init__(self, command):
+        super(UsageException, self).__init__(command.usage())
+        self.command = command
+
+
+class Arg(object):
+    """A positional command argument.
+
+    A `rest` argument takes every remaining word, joined with spaces.
+    """
+
+    def __init__(self, name, required=True, rest=False, metavar=None):
+        self.name = name
+        self.required = required
+        self.rest = rest
+        self.metavar = metavar or name.replace('_', '-')
+
+    def usage(self):
+        text = "<{}>".format(self.metavar)
+        if self.rest:
+            text += "..."
+        if not self.required:
+            text = "[{}]".format(text)
+        return text
+
+
+class Request(object):
+    """Who sent a command and where, and how to reply to them."""
+
+    def __init__(self, channel_id, sender_id, user_name, message_is_im, words, send):
+        self.channel_id = channel_id
+        self.sender_id = sender_id
+        self.user_name = user_name
+        self.message_is_im = message_is_im
+        self.words = words
+        self.send = send
+
+    def reply(self, text, attachments=None):
+        self.send(self.channel_id, self.sender_id, text, attachments, message_is_im=self.message_is_im)
+
+
+class Command(object):
+    def __init__(self, name, handler, args=(), description=None, color=None):
+        self.name = name
+        self.handler = handler
+        self.args = tuple(args)
+        self.description = description
+        self.color = color
+
+    def usage(self):
+        return " ".join([self.name] + [a.usage() for a in self.args])
+
+    def parse(self, words):
+        """Map the words after the command name to handler keyword arguments."""
+        kwargs = {}
+        for i, arg in enumerate(self.args):
+            if i < len(words):
+                kwargs[arg.name] = " ".join(words[i:]) if arg.rest else words[i]
+            elif arg.required:
+                raise UsageException(self)
+            else:
+                kwargs[arg.name] = None
+        return kwargs
+
+    def __call__(self, request, words):
+        return self.handler(request, **self.parse(words))
+
+    def help_attachment(self):
+        usage = self.usage()
+        return {
+            'fallback': usage,
+            'color': self.color,
+            'title': self.name.capitalize(),
+            'text': "`{}`\n{}".format(usage, self.description),
+            "mrkdwn_in": ["text"]
+        }
+
+
+class CommandRegistry(object):
+    """Commands by name, in the order they were registered."""
+
+    def __init__(self):
+        self.commands = collections.OrderedDict()
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def get(self, name):
+        return self.commands.get(name)
+
+    def register(self, name, args=(), description=None, color=None):
+        """Decorator registering a handler(request, **args) as a command."""
+        def decorator(handler):
+            self.commands[name] = Command(name, handler, args, description, color)
+            return handler
+        return decorator
+
+    def help_attachments(self, names=None):
+        return [c.help_attachment() for c in self.commands.values() if names is None or c.name in names]
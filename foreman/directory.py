@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+# members requested per users.list page
+PAGE_SIZE = 200
+
+# bit flags kept per user instead of the whole profile
+DELETED = 8
+FLAGS = (
+    ('is_admin', 1),
+    ('is_owner', 2),
+    ('is_bot', 4),
+    ('deleted', DELETED),
+)
+
+SNAPSHOT_VERSION = 1
+
+
+def member_flags(member):
+    flags = 0
+    for key, bit in FLAGS:
+        if member.get(key):
+            flags |= bit
+    return flags
+
+
+def stream_members(api_call, page_size=PAGE_SIZE):
+    """Yield team members from users.list one cursor page at a time."""
+    cursor = None
+    pages = 0
+    while True:
+        kwargs = {'limit': page_size}
+        if cursor:
+            kwargs['cursor'] = cursor
+        response = api_call("users.list", **kwargs)
+        if not response.get('ok', True):
+            raise IOError("users.list failed: {}".format(response.get('error')))
+        pages += 1
+        for m in response.get('members', []):
+            yield m
+        cursor = (response.get('response_metadata') or {}).get('next_cursor')
+        if not cursor:
+            logging.debug("Read {} pages of members.".format(pages))
+            return
+
+
+class UserDirectory(object):
+    """Compact ID <-> name directory of team members.
+
+    Only the ID, name and a few account flags are kept per member; get()
+    rebuilds a small user dict on demand. The directory can be saved to and
+    loaded from a snapshot file so a restart doesn't wait on users.list.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = {}
+        self.ids = {}
+        self.flags = {}
+        self.loaded_at = 0
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, user_id):
+        name = self.names.get(user_id)
+        if name is None:
+            return None
+        user = {'id': user_id, 'name': name}
+        flags = self.flags.get(user_id, 0)
+        for key, bit in FLAGS:
+            user[key] = bool(flags & bit)
+        return user
+
+    def name_for_id(self, user_id):
+        return self.names.get(user_id)
+
+    def id_for_name(self, name):
+        return self.ids.get(name)
+
+    def members(self):
+        with self.lock:
+            return [self.get(user_id) for user_id in list(self.names)]
+
+    def update(self, member):
+        user_id = member.get('id')
+        name = member.get('name')
+        if user_id is None or name is None:
+            return None
+        with self.lock:
+            old_name = self.add(self.names, self.ids, self.flags, user_id, name, member_flags(member))
+        return old_name
+
+    def add(self, names, ids, flags, user_id, name, bits):
+        old_name = names.get(user_id)
+        if old_name is not None and ids.get(old_name) == user_id:
+            del ids[old_name]
+        names[user_id] = name
+        if not bits & DELETED:
+            ids[name] = user_id
+        if bits:
+            flags[user_id] = bits
+        else:
+            flags.pop(user_id, None)
+        return old_name
+
+    def replace(self, names, ids, flags, loaded_at):
+        with self.lock:
+            self.names = names
+            self.ids = ids
+            self.flags = flags
+            self.loaded_at = loaded_at
+
+    def refresh(self, api_call, page_size=PAGE_SIZE):
+        logging.info("Requesting team member list...")
+        names = {}
+        ids = {}
+        flags = {}
+        for m in stream_members(api_call, page_size):
+            if 'id' in m and 'name' in m:
+                self.add(names, ids, flags, m['id'], m['name'], member_flags(m))
+        self.replace(names, ids, flags, time.time())
+        logging.info("Got {} members.".format(len(names)))
+        return len(names)
+
+    def load_file(self, file):
+        if not os.path.isfile(file):
+            return False
+        logging.info("Loading user directory from {}...".format(file))
+        try:
+            with open(file, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            logging.exception("Could not read user directory snapshot {}.".format(file))
+            return False
+        if data.get('version') != SNAPSHOT_VERSION:
+            logging.warning("Ignoring user directory snapshot with version {}.".format(data.get('version')))
+            return False
+
+        names = {}
+        ids = {}
+        flags = {}
+        for user_id, name, bits in data.get('users', []):
+            self.add(names, ids, flags, user_id, name, bits)
+        self.replace(names, ids, flags, data.get('saved_at', 0))
+        logging.info("Loaded {} members from the snapshot.".format(len(names)))
+        return True
+
+    def save_file(self, file):
+        with self.lock:
+            users = [[user_id, name, self.flags.get(user_id, 0)] for user_id, name in self.names.items()]
+            saved_at = self.loaded_at
+        tmp = "{}.tmp".format(file)
+        with open(tmp, 'w') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'saved_at': saved_at, 'users': users}, f, separators=(',', ':'))
+        # replace atomically so a crash never leaves a truncated snapshot
+        os.replace(tmp, file)
+        logging.debug("Saved {} members to {}.".format(len(users), file))
@@ -0,0 +1,211 @@
+import logging
+import threading
+import time
+
+import metrics
+
+
+# event actions that move a container into a new state
+ACTION_STATES = {
+    'create': 'created',
+    'start': 'running',
+    'restart': 'running',
+    'unpause': 'running',
+    'pause': 'paused',
+    'die': 'exited',
+    'stop': 'exited',
+    'oom': 'exited',
+}
+
+# event attributes that aren't container labels
+EVENT_ATTRIBUTES = ('image', 'name', 'exitCode', 'signal', 'container')
+
+# seconds to wait before re-subscribing after the event stream drops, doubling
+# up to the maximum while the daemon stays unreachable
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+API_ERRORS = metrics.Counter('foreman_docker_api_errors_total', "Docker API calls that failed.", ['endpoint', 'call'])
+API_DURATION = metrics.Histogram('foreman_docker_api_duration_seconds', "Docker API call duration.", ['endpoint', 'call'])
+EVENTS = metrics.Counter('foreman_docker_events_total', "Container events received.", ['endpoint'])
+RECONNECTS = metrics.Counter('foreman_docker_event_stream_reconnects_total', "Docker event stream reconnects.",
+                             ['endpoint'])
+
+# APIClient methods behind every Docker call foreman makes, high-level
+# client calls included
+INSTRUMENTED_CALLS = ('containers', 'inspect_container', 'create_container', 'start', 'stop', 'remove_container',
+                      'pull', 'inspect_image', 'logs', 'stats', 'events')
+
+
+def instrument(client, name):
+    """Count and time each of a client's Docker API calls, labelled by call.
+
+    Streaming calls are timed until the stream is opened.
+    """
+    api = client.api
+    for call in INSTRUMENTED_CALLS:
+        method = getattr(api, call, None)
+        if method is not None:
+            setattr(api, call, metrics.timed(API_DURATION, API_ERRORS, endpoint=name, call=call)(method))
+    return client
+
+
+class ContainerState(object):
+    """Snapshot of a container, shaped like a sparse containers.list entry."""
+
+    def __init__(self, attrs):
+        self.attrs = attrs
+
+    @property
+    def id(self):
+        return self.attrs.get('Id')
+
+    @property
+    def status(self):
+        return self.attrs.get('State')
+
+    def __repr__(self):
+        return "<ContainerState: {} {}>".format((self.id or '')[:12], self.status)
+
+
+class DockerStateCache(object):
+    """Keeps a live snapshot of containers from the Docker events stream.
+
+    The snapshot is seeded with one listing and then updated from
+    start/stop/die/health_status events, so readers never touch the daemon.
+    The watcher re-seeds and re-subscribes whenever the stream drops.
+    """
+
+    def __init__(self, client, label=None, name='docker'):
+        self.client = client
+        self.label = label
+        self.name = name
+        self.lock = threading.Lock()
+        self.containers_by_id = {}
+        self.synced = threading.Event()
+        self.connected = False
+        self.updated_at = 0
+        self.disconnected_at = time.time()
+        self.stream = None
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="{}-events".format(self.name))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        stream = self.stream
+        if stream is not None:
+            stream.close()
+
+    def containers(self):
+        with self.lock:
+            return list(self.containers_by_id.values())
+
+    def staleness(self):
+        # seconds the snapshot may be behind the daemon; zero while subscribed
+        if not self.synced.is_set():
+            return None
+        if self.connected:
+            return 0.0
+        return time.time() - self.disconnected_at
+
+    def filters(self):
+        if self.label:
+            return {'label': self.label}
+        return None
+
+    def seed(self):
+        logging.info("Seeding container state for {}...".format(self.name))
+        listing = self.client.api.containers(all=True, filters=self.filters())
+        containers = dict((c['Id'], ContainerState(c)) for c in listing)
+        with self.lock:
+            self.containers_by_id = containers
+            self.updated_at = time.time()
+        self.synced.set()
+        logging.info("Seeded state for {} containers on {}.".format(len(containers), self.name))
+
+    def apply(self, event):
+        if event.get('Type') != 'container':
+            return
+        action = event.get('Action') or event.get('status') or ''
+        actor = event.get('Actor') or {}
+        container_id = actor.get('ID') or event.get('id')
+        attributes = actor.get('Attributes') or {}
+        if container_id is None:
+            return
+        logging.debug("Container event on {}: {} {}".format(self.name, action, container_id[:12]))
+
+        with self.lock:
+            self.updated_at = time.time()
+
+            if action == 'destroy':
+                self.containers_by_id.pop(container_id, None)
+                return
+
+            state = self.containers_by_id.get(container_id)
+            if state is None:
+                if action not in ACTION_STATES:
+                    return
+                labels = dict((k, v) for k, v in attributes.items() if k not in EVENT_ATTRIBUTES)
+                state = ContainerState({
+                    'Id': container_id,
+                    'Names': ["/" + attributes.get('name', container_id[:12])],
+                    'Image': attributes.get('image') or event.get('from'),
+                    'Labels': labels,
+                    'State': 'created',
+                })
+                self.containers_by_id[container_id] = state
+
+            # build a new attrs dict so readers holding the old one see a
+            # consistent snapshot
+            attrs = dict(state.attrs)
+            if action.startswith('health_status'):
+                attrs['Health'] = action.split(':', 1)[-1].strip()
+            elif action == 'rename' and 'name' in attributes:
+                attrs['Names'] = ["/" + attributes['name']]
+            elif action in ACTION_STATES:
+                attrs['State'] = ACTION_STATES[action]
+                if attrs['State'] != 'running':
+                    attrs.pop('Health', None)
+            else:
+                return
+            self.containers_by_id[container_id] = ContainerState(attrs)
+
+    def run(self):
+        delay = RECONNECT_DELAY
+        while not self.stopping:
+            try:
+                # subscribe from before the listing so nothing falls between
+                since = int(time.time())
+                self.seed()
+                kwargs = {'since': since, 'decode': True, 'filters': {'type': 'container'}}
+                if self.label:
+                    kwargs['filters']['label'] = self.label
+                self.stream = self.client.events(**kwargs)
+                self.connected = True
+                delay = RECONNECT_DELAY
+                for event in self.stream:
+                    EVENTS.inc(endpoint=self.name)
+                    self.apply(event)
+                logging.warning("Docker event stream for {} ended.".format(self.name))
+            except Exception:
+                if self.stopping:
+                    break
+                logging.exception("Docker event stream for {} failed.".format(self.name))
+            finally:
+                if self.connected:
+                    self.disconnected_at = time.time()
+                self.connected = False
+                self.stream = None
+
+            if self.stopping:
+                break
+            logging.info("Reconnecting to {} in {} seconds.".format(self.name, delay))
+            RECONNECTS.inc(endpoint=self.name)
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
@@ -0,0 +1,177 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+import docker
+
+import dockerstate
+
+
+# endpoint for servers that don't name one; uses the DOCKER_HOST environment
+LOCAL_ENDPOINT = 'local'
+
+# seconds a single Docker API call may take
+DEFAULT_TIMEOUT = 10
+
+# pooled HTTP connections kept open to each daemon
+DEFAULT_POOL_SIZE = 4
+
+# hosts queried at the same time
+MAX_PARALLEL_HOSTS = 16
+
+# API version spoken to every daemon; 'auto' asks each daemon when its client
+# is created, so a host that's down then is retried rather than connected
+DEFAULT_API_VERSION = 'auto'
+
+# seconds between attempts to create a client for an endpoint that was down
+RECONNECT_DELAY = 30
+
+
+class DockerFleet(object):
+    """Docker clients and container state caches for each endpoint.
+
+    Endpoints are named; each has one pooled client and one events-fed
+    DockerStateCache. containers() answers from the caches and only queries
+    hosts whose cache has fallen behind, all of them at once, so a listing
+    costs as much as the slowest host rather than the sum of all of them.
+    """
+
+    def __init__(self, label=None, timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE, version=DEFAULT_API_VERSION):
+        self.label = label
+        self.timeout = timeout
+        self.version = version
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.clients = {}
+        self.states = {}
+        # name -> (base URL, time of the last attempt) for endpoints without a
+        # client yet
+        self.pending = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_PARALLEL_HOSTS, thread_name_prefix='docker-fleet')
+
+    def connect(self, base_url):
+        if base_url is None:
+            return docker.from_env(version=self.version, timeout=self.timeout, max_pool_size=self.pool_size)
+        return docker.DockerClient(base_url=base_url, version=self.version, timeout=self.timeout, max_pool_size=self.pool_size)
+
+    def configure(self, endpoints):
+        """Connect to each endpoint in a name -> base URL map.
+
+        Endpoints whose URL is unchanged keep their client and cache; removed
+        ones are shut down. One whose client can't be created is retried by
+        later calls.
+        """
+        with self.lock:
+            for name in list(self.pending):
+                if name not in endpoints or endpoints[name] != self.pending[name][0]:
+                    del self.pending[name]
+            for name in list(self.endpoints):
+                if name not in endpoints or endpoints[name] != self.endpoints[name]:
+                    logging.info("Disconnecting from Docker endpoint {}.".format(name))
+                    self.states.pop(name).stop()
+                    self.clients.pop(name).close()
+                    del self.endpoints[name]
+
+            for name, base_url in endpoints.items():
+                if name not in self.endpoints:
+                    self.pending[name] = (base_url, None)
+
+        # with the API version on auto each attempt waits on its daemon, so
+        # the hosts are tried at once
+        concurrent.futures.wait([self.executor.submit(self.reconnect, name) for name in endpoints])
+
+    def reconnect(self, name, force=True):
+        """Try to create the client for a pending endpoint.
+
+        Unless forced, nothing is tried within RECONNECT_DELAY of the last
+        attempt. Returns the exception if the attempt failed.
+        """
+        with self.lock:
+            if name not in self.pending:
+                return None
+            base_url, attempted_at = self.pending[name]
+            if not force and attempted_at is not None and time.time() - attempted_at < RECONNECT_DELAY:
+                return None
+            self.pending[name] = (base_url, time.time())
+        logging.info("Connecting to Docker endpoint {} ({}).".format(name, base_url or "environment"))
+        try:
+            client = self.connect(base_url)
+        except docker.errors.DockerException as e:
+            logging.warning("Could not create a client for Docker endpoint {}: {}".format(name, e))
+            return e
+        with self.lock:
+            if self.pending.get(name, (None,))[0] != base_url:
+                # reconfigured while connecting
+                client.close()
+                return None
+            del self.pending[name]
+            self.endpoints[name] = base_url
+            self.clients[name] = dockerstate.instrument(client, name)
+            self.states[name] = dockerstate.DockerStateCache(client, label=self.label, name=name).start()
+        return None
+
+    def client(self, name):
+        if name in self.pending:
+            error = self.reconnect(name)
+            if error is not None:
+                raise error
+        return self.clients[name]
+
+    def state(self, name):
+        return self.states.get(name)
+
+    def list_containers(self, name):
+        filters = None
+        if self.label:
+            filters = {'label': self.label}
+        logging.debug("Listing containers on {} with filters: {}".format(name, filters))
+        # sparse listings skip inspecting every container on the host
+        return self.clients[name].containers.list(all=True, sparse=True, filters=filters)
+
+    def containers(self, names, max_staleness, timeout=None):
+        """Containers on each named endpoint.
+
+        Returns (results, failures): endpoint name -> list of containers, and
+        endpoint name -> reason for every host that couldn't be read in time.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        results = {}
+        failures = {}
+        pending = {}
+        for name in set(names):
+            state = self.states.get(name)
+            if state is None and name in self.pending:
+                # retried in the background; this listing reports it as down
+                self.executor.submit(self.reconnect, name, False)
+                failures[name] = "not connected"
+                continue
+            if state is None:
+                failures[name] = "unknown Docker endpoint"
+                continue
+            staleness = state.staleness()
+            if staleness is not None and staleness <= max_staleness:
+                results[name] = state.containers()
+                continue
+            logging.debug("Docker state for {} is stale ({}), querying the daemon.".format(name, staleness))
+            pending[self.executor.submit(self.list_containers, name)] = name
+
+        if pending:
+            done, not_done = concurrent.futures.wait(pending, timeout)
+            for future in done:
+                name = pending[future]
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logging.warning("Could not list containers on {}: {}".format(name, e))
+                    failures[name] = str(e)
+            for future in not_done:
+                name = pending[future]
+                logging.warning("Listing containers on {} timed out.".format(name))
+                failures[name] = "timed out"
+                future.cancel()
+
+        return results, failures
@@ -3,13 +3,35 @@
 from slackclient import SlackClient
 import os
 import time
+import asyncio
+import threading
+import concurrent.futures
+import functools
+import urllib.parse
 import json
 import argparse
 import logging
 import sys
 import re
-import random
 import docker
+import fleet
+import jobs
+import slp
+import telemetry
+import logtail
+import prewarm
+import rcon
+import backup
+import regions
+import scheduler
+import commands
+from commands import Arg
+import acl
+import directory
+import cache
+import slackapi
+import metrics
+import render
 
 
 parser = argparse.ArgumentParser(description='Command-line arguments.')
@@ -18,23 +40,133 @@ parser.add_argument('--quiet', '-q', help='be quiet', action='store_true')
 parser.add_argument('--config', '-c', help='path to configuration file', default='./config.json')
 parser.add_argument('--permissions', '-p', help='path to the permissions file', default='./permissions.json')
 parser.add_argument('--servers', '-s', help='path to managed Minecraft servers', default='./servers.json')
-args = parser.parse_args()
-logging.basicConfig(level=logging.INFO)
-if args.debug:
-    logging.getLogger().setLevel(logging.DEBUG)
-elif args.quiet:
-    logging.getLogger().setLevel(logging.WARNING)
+args = None
 
 
-members = []
-name_to_user_id_map = {}
-user_id_to_name_map = {}
+user_directory = directory.UserDirectory()
 sc = None
-dc = None
-permissions = {}
-servers = []
-config = {}
-user_cache = {}
+slack_api = None
+docker_fleet = None
+job_engine = None
+prober = None
+stats_collector = None
+backup_engine = None
+rcon_pool = None
+log_tailer = None
+image_prewarmer = None
+region_analyzer = None
+last_backups = {}
+backup_failures = {}
+render_cache = render.RenderCache()
+server_scheduler = scheduler.Scheduler()
+event_loop = None
+my_identity = None
+mention_matcher = None
+registry = commands.CommandRegistry()
+permission_index = acl.PermissionIndex(user_directory)
+snapshot = None
+user_cache = None
+im_channels = {}
+# the last status seen for each server, for metrics
+server_statuses = {}
+im_channels_loaded_at = 0
+im_channels_failures = 0
+im_channels_failed_at = 0
+executor = None
+rtm_lock = threading.Lock()
+
+# seconds before the IM channel index is refreshed from im.list, in case an
+# im_created/im_open/im_close event was missed while disconnected
+IM_CHANNEL_TTL = 15 * 60
+
+# seconds before a failed im.list is tried again, doubled after each failure
+# in a row up to IM_CHANNEL_TTL
+IM_CHANNEL_RETRY_DELAY = 30
+
+# worker threads for event handling, which does blocking Slack and Docker calls
+DEFAULT_WORKERS = 8
+
+# concurrent Slack Web API requests, each with its own pooled connection
+DEFAULT_SLACK_API_WORKERS = 4
+
+# seconds to wait for the RTM socket to become readable before reading anyway;
+# the SSL layer can hold decrypted frames the selector doesn't know about
+RTM_READ_TIMEOUT = 1.0
+
+# label on the containers foreman manages, valued with the server ID
+SERVER_LABEL = 'foreman.server'
+
+# seconds the Docker state cache may lag the daemon before queries go to the
+# daemon directly
+MAX_DOCKER_STATE_STALENESS = 30
+
+# seconds between checks of the configuration files for changes
+CONFIG_POLL_INTERVAL = 2
+
+# concurrent server starts and stops; a start holds its worker until the
+# server is ready
+DEFAULT_JOB_WORKERS = 4
+
+# minimum seconds between progress edits while an image is pulling
+PROGRESS_INTERVAL = 2
+
+# seconds a server gets to save its world before it's killed on stop
+STOP_TIMEOUT = 60
+
+# seconds a started server gets to load its world, and between checks
+READY_TIMEOUT = 5 * 60
+READY_POLL_INTERVAL = 2
+
+# seconds a Server List Ping result is reused, and how long a probe may take
+PROBE_TTL = 5
+PROBE_TIMEOUT = 3
+
+# seconds between checks for idle servers and queued starts
+SCHEDULER_INTERVAL = 60
+
+# docker stats samples kept per server, one a second
+STATS_WINDOW = telemetry.DEFAULT_WINDOW
+
+# log lines kept per server, and shown by the logs command
+LOG_BUFFER_LINES = logtail.DEFAULT_CAPACITY
+DEFAULT_LOG_LINES = 20
+MAX_LOG_LINES = 200
+
+# Slack collapses long messages; the newest lines are kept
+MAX_LOG_REPLY = 3500
+
+# seconds to wait for a log that isn't being followed yet
+LOG_START_TIMEOUT = 2
+
+# where the user directory is persisted between restarts
+DEFAULT_USER_DIRECTORY_FILE = './user-directory.json'
+
+DEFAULT_BACKUP_DIR = './backups'
+
+# processes reading region headers when many have changed
+WORLD_SCAN_WORKERS = regions.DEFAULT_WORKERS
+
+# seconds save-all may take on a large world
+SAVE_TIMEOUT = 120
+
+# seconds before a failed scheduled backup is tried again, doubled after
+# each failure in a row up to the backup interval
+BACKUP_RETRY_DELAY = 5 * 60
+
+# users.info results for IDs the directory doesn't know (bots, integrations,
+# members who joined since the last refresh)
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60 * 60
+USER_NEGATIVE_TTL = 5 * 60
+
+# seconds between event loop lag samples
+LOOP_LAG_INTERVAL = 1
+
+EVENT_DURATION = metrics.Histogram('foreman_event_duration_seconds', "Time to process an RTM event.")
+COMMAND_DURATION = metrics.Histogram('foreman_command_duration_seconds', "Time to handle a command.", ['command'])
+COMMAND_ERRORS = metrics.Counter('foreman_command_errors_total', "Commands that raised an exception.", ['command'])
+LOOP_LAG = metrics.Histogram('foreman_event_loop_lag_seconds', "How late the event loop wakes from a sleep.",
+                             buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 5))
 
 
 # Exceptions
@@ -53,14 +185,65 @@ class ContainerCreationException(Exception):
         super(ContainerCreationException, self).__init__(message)
         self.message = message
 
+class HostUnreachableException(Exception):
+    def __init__(self, endpoint, reason):
+        super(HostUnreachableException, self).__init__("{}: {}".format(endpoint, reason))
+        self.endpoint = endpoint
+        self.reason = reason
+
+class ServerNotReadyException(Exception):
+    def __init__(self, server_id, reason):
+        super(ServerNotReadyException, self).__init__("{} {}".format(server_id, reason))
+        self.server_id = server_id
+        self.reason = reason
+
+
+class InsufficientMemoryException(Exception):
+    def __init__(self, server_id, position):
+        super(InsufficientMemoryException, self).__init__(server_id)
+        self.server_id = server_id
+        self.position = position
+
+class ConfigValidationException(Exception):
+    def __init__(self, file, message):
+        super(ConfigValidationException, self).__init__("{}: {}".format(file, message))
+        self.file = file
+        self.message = message
+
+
+# Configuration
+
+class ConfigSnapshot(object):
+    """Parsed configuration files plus the lookup tables derived from them.
+
+    Snapshots are never modified once built; a reload builds a new one and
+    swaps it in with a single assignment, so a handler that reads `snapshot`
+    once sees one consistent version of every file.
+    """
+
+    def __init__(self, config, permissions, servers, mtimes=None):
+        self.config = config
+        self.permissions = permissions
+        self.servers = tuple(servers)
+        self.mtimes = mtimes or {}
+        self.servers_by_id = dict((s['id'], s) for s in self.servers)
+        self.server_images = dict((s['id'], server_image(s)) for s in self.servers)
+        self.server_endpoints = dict((s['id'], server_endpoint(s)) for s in self.servers)
+        self.docker_endpoints = docker_endpoints(config, self.server_endpoints.values())
+
 
 # Functions
 
-def randhex(size=1):
-    result = []
-    for i in range(size):
-        result.append(str(random.choice("0123456789ABCDEF")) + str(random.choice("0123456789ABCDEF")))
-    return "".join(result)
+def debug(message, *args):
+    # skip formatting, which can be costly, unless it will be logged
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug(message.format(*args))
+
+
+def slack_unescape(text):
+    # Slack escapes only these three in message text; &amp; goes last so
+    # "&amp;lt;" stays "&lt;"
+    return text.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
 
 
 def load_permissions(file):
@@ -90,6 +273,140 @@ def load_config(file):
     return { 'token': "" }
 
 
+def validate_config(file, cfg):
+    if type(cfg) is not dict:
+        raise ConfigValidationException(file, "configuration must be an object")
+
+
+def validate_permissions(file, perms):
+    if type(perms) is not dict:
+        raise ConfigValidationException(file, "permissions must be an object")
+    for command, entries in perms.items():
+        if command == acl.GROUPS_KEY:
+            if type(entries) is not dict:
+                raise ConfigValidationException(file, "'{}' must be an object".format(command))
+            for group, members in entries.items():
+                if type(members) is not list or not all(type(m) is str for m in members):
+                    raise ConfigValidationException(file, "group '{}' must be a list of strings".format(group))
+            continue
+        if entries is not None and (type(entries) is not list or not all(type(e) is str for e in entries)):
+            raise ConfigValidationException(file, "permissions for '{}' must be a list of strings or null".format(command))
+
+
+def validate_servers(file, srvs):
+    if type(srvs) is not list:
+        raise ConfigValidationException(file, "servers must be a list")
+    seen = set()
+    for s in srvs:
+        if type(s) is not dict:
+            raise ConfigValidationException(file, "each server must be an object")
+        for key in ('id', 'name', 'image'):
+            if not s.get(key):
+                raise ConfigValidationException(file, "server is missing '{}': {}".format(key, s))
+        # info may be empty, but the list attachment reads it unconditionally
+        if not isinstance(s.get('info'), str):
+            raise ConfigValidationException(file, "server '{}' is missing 'info'".format(s['id']))
+        if s['id'] in seen:
+            raise ConfigValidationException(file, "duplicate server ID '{}'".format(s['id']))
+        volumes = s.get('volumes', [])
+        if type(volumes) is not list:
+            raise ConfigValidationException(file, "volumes of server '{}' must be a list".format(s['id']))
+        for v in volumes:
+            if type(v) is not dict or not v.get('host') or not v.get('container'):
+                raise ConfigValidationException(file, "each volume of server '{}' needs a 'host' and a 'container': {}".format(s['id'], v))
+        try:
+            scheduler.parse_memory(s.get('memory'))
+        except ValueError as e:
+            raise ConfigValidationException(file, str(e))
+        seen.add(s['id'])
+
+
+def server_endpoint(server):
+    return server.get('endpoint') or fleet.LOCAL_ENDPOINT
+
+
+def docker_endpoints(cfg, names):
+    # endpoint names come from docker_endpoints in config.json, or are a
+    # daemon URL themselves
+    configured = cfg.get('docker_endpoints') or {}
+    endpoints = {}
+    for name in names:
+        if name in configured:
+            endpoints[name] = configured[name]
+        elif '://' in name:
+            endpoints[name] = name
+        elif name == fleet.LOCAL_ENDPOINT:
+            endpoints[name] = None
+        else:
+            raise ConfigValidationException('servers', "unknown Docker endpoint '{}'".format(name))
+    return endpoints
+
+
+def file_mtime(file):
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def load_snapshot(previous=None):
+    files = (
+        ('config', args.config, load_config, validate_config),
+        ('permissions', args.permissions, load_permissions, validate_permissions),
+        ('servers', args.servers, load_servers, validate_servers),
+    )
+    mtimes = {}
+    values = {}
+    changed = []
+    for key, file, load, validate in files:
+        mtimes[key] = file_mtime(file)
+        if previous is not None and previous.mtimes.get(key) == mtimes[key]:
+            values[key] = getattr(previous, key)
+            continue
+        value = load(file)
+        validate(file, value)
+        values[key] = value
+        changed.append(key)
+
+    if previous is not None and len(changed) == 0:
+        return previous, changed
+    return ConfigSnapshot(values['config'], values['permissions'], values['servers'], mtimes), changed
+
+
+def reload_snapshot():
+    global snapshot
+    try:
+        new_snapshot, changed = load_snapshot(snapshot)
+    except (IOError, ValueError, ConfigValidationException) as e:
+        logging.error("Configuration reload failed, keeping the previous configuration: {}".format(e))
+        return False
+    if len(changed) == 0:
+        return False
+
+    logging.info("Reloaded configuration: {}".format(", ".join(changed)))
+    if 'permissions' in changed:
+        permission_index.load_permissions(new_snapshot.permissions)
+    if new_snapshot.docker_endpoints != snapshot.docker_endpoints:
+        docker_fleet.configure(new_snapshot.docker_endpoints)
+    snapshot = new_snapshot
+    if 'servers' in changed:
+        # names and descriptions are baked into the cached attachments
+        render_cache.invalidate()
+        prewarm_servers()
+    return True
+
+
+async def watch_config(loop):
+    while True:
+        await asyncio.sleep(CONFIG_POLL_INTERVAL)
+        # stat and parse off the event loop
+        try:
+            await loop.run_in_executor(executor, reload_snapshot)
+        except Exception:
+            logging.exception("Reloading the configuration failed.")
+
+
 def init_slack_client(token):
     logging.info("Creating Slack client.")
     client = SlackClient(token)
@@ -97,154 +414,454 @@ def init_slack_client(token):
     return client
 
 
-def init_docker_client():
-    logging.info("Creating Docker client.")
-    client = docker.from_env()
-    logging.debug("client: {}".format(client))
-    return client
+def init_slack_api(token):
+    cfg = snapshot.config
+    logging.info("Creating Slack Web API scheduler.")
+    transport = slackapi.HttpTransport(
+        token,
+        base_url=cfg.get('slack_api_url', slackapi.SLACK_API_URL),
+        pool_size=cfg.get('slack_api_workers', DEFAULT_SLACK_API_WORKERS))
+    return slackapi.SlackApi(transport, workers=cfg.get('slack_api_workers', DEFAULT_SLACK_API_WORKERS))
+
+
+def init_executor(workers):
+    logging.info("Creating executor with {} workers.".format(workers))
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='foreman')
+
+
+def init_docker_fleet():
+    cfg = snapshot.config
+    label = None
+    if cfg.get('docker_label_filter'):
+        label = SERVER_LABEL
+    logging.info("Creating Docker clients.")
+    docker_fleet = fleet.DockerFleet(label=label, timeout=cfg.get('docker_timeout', fleet.DEFAULT_TIMEOUT),
+                                     version=cfg.get('docker_api_version', fleet.DEFAULT_API_VERSION))
+    docker_fleet.configure(snapshot.docker_endpoints)
+    return docker_fleet
+
+
+def user_directory_file():
+    return snapshot.config.get('user_directory', DEFAULT_USER_DIRECTORY_FILE)
 
 
 def load_members():
-    logging.info("Requesting team member list...")
-    members = sc.api_call("users.list")
-    logging.info("Got {} members.".format(len(members)))
+    user_directory.refresh(functools.partial(slack_api.call, priority=slackapi.PRIORITY_BACKGROUND))
+    permission_index.load_members()
+    try:
+        user_directory.save_file(user_directory_file())
+    except (IOError, OSError):
+        logging.exception("Could not save the user directory.")
+
+
+def init_members():
+    # warm-start from the snapshot and refresh it in the background, or load
+    # the whole team now if there isn't one yet
+    if user_directory.load_file(user_directory_file()):
+        permission_index.load_members()
+        thread = threading.Thread(target=refresh_members, name='members')
+        thread.daemon = True
+        thread.start()
+    else:
+        load_members()
 
-    name_to_user_id_map = {}
-    user_id_to_name_map = {}
 
-    for m in members:
-        if 'name' in m and 'id' in m:
-            name = m.get('name')
-            user_id = m.get('id')
-            name_to_user_id_map[name] = user_id
-            user_id_to_name_map[user_id] = name
+def refresh_members():
+    try:
+        load_members()
+    except Exception:
+        logging.exception("Background refresh of team members failed.")
 
-    return members, name_to_user_id_map, user_id_to_name_map
+
+def handle_member_event(event):
+    member = event.get('user')
+    if type(member) is not dict or 'id' not in member or 'name' not in member:
+        logging.debug("Member event without a user object, skipping it.")
+        return
+
+    old_name = user_directory.update(member)
+    user_cache.pop(member['id'])
+    permission_index.update_member(member, old_name)
 
 
 def load_im_channels():
     logging.info("Requesting IM channels...")
-    c = sc.api_call("im.list")
+    c = slack_api.call("im.list")
     logging.debug("IM channels: {}".format(c))
 
-    if 'ims' not in c:
-        return []
+    if not c.get('ok') or 'ims' not in c:
+        logging.warning("Could not load IM channels: {}".format(c.get('error')))
+        return None
     channels = c['ims']
 
-    ims = []
+    # channel_id -> user_id
+    ims = {}
     for im in channels:
-        if 'id' in im and 'user' in im:
-            t = (im['id'], im['user'])
-            ims.append(t)
+        if 'id' in im and 'user' in im and not im.get('is_user_deleted'):
+            ims[im['id']] = im['user']
 
     return ims
 
+
+def refresh_im_channels():
+    global im_channels, im_channels_loaded_at, im_channels_failures, im_channels_failed_at
+    ims = load_im_channels()
+    if ims is None:
+        # keep answering DMs from the index we have, and don't ask again on
+        # every message while im.list is failing
+        im_channels_failures += 1
+        im_channels_failed_at = time.time()
+        return
+    im_channels = ims
+    im_channels_loaded_at = time.time()
+    im_channels_failures = 0
+    logging.info("Indexed {} IM channels.".format(len(im_channels)))
+
+
+def handle_im_event(event):
+    event_type = event.get('type')
+    channel = event.get('channel')
+    user_id = event.get('user')
+    # im_created carries the whole channel object, im_open/im_close only its ID
+    if type(channel) is dict:
+        user_id = channel.get('user', user_id)
+        channel = channel.get('id')
+    if channel is None:
+        logging.debug("IM event without a channel ID, skipping it.")
+        return
+
+    if event_type in ('im_created', 'im_open'):
+        if user_id is None:
+            logging.debug("IM event without a user ID, skipping it.")
+            return
+        logging.debug("Adding IM channel {} for user {}.".format(channel, user_id))
+        im_channels[channel] = user_id
+    elif event_type == 'im_close':
+        logging.debug("Removing IM channel {}.".format(channel))
+        im_channels.pop(channel, None)
+
+
 def load_identity():
     logging.info("Requesting auth.test to get user identity...")
-    info = sc.api_call("auth.test")
+    info = slack_api.call("auth.test")
     logging.debug("info: {}".format(info))
     return info.get('user_id')
 
 
-def is_mention(message_tokens):
-    logging.debug("Checking if message tokens contain a mention.")
-    if len(message_tokens) == 0:
-        logging.debug("No message tokens provided for mention check.")
-        return False
-    first_token = message_tokens[0].strip()
-    result = re.match("^\\<\\@(\\S+)\\>\\S*$", first_token)
-    logging.debug("result: {}".format(result))
-    if result is None:
-        logging.debug("Regular expression match for user ID failed for token '{}'.".format(first_token))
+def init_mention_matcher(identity):
+    # "<@U123>", "<@U123|name>" and "<@U123>:" all address us
+    return re.compile("^\\s*<@{}(?:\\|[^>]*)?>".format(re.escape(identity)))
+
+
+def is_mention(text):
+    return mention_matcher is not None and mention_matcher.match(text) is not None
+
+
+def im_channels_due():
+    now = time.time()
+    if now - im_channels_loaded_at <= IM_CHANNEL_TTL:
         return False
-    user_id = result.group(1)
-    logging.debug("user_id: {}".format(user_id))
-    return user_id == my_identity
+    if im_channels_failures:
+        delay = min(IM_CHANNEL_TTL, IM_CHANNEL_RETRY_DELAY * 2 ** (im_channels_failures - 1))
+        return now - im_channels_failed_at >= delay
+    return True
 
 
 def is_im(event):
-    logging.debug("Checking if event is on an IM channel.")
     if event is None or type(event) is not dict:
-        logging.debug("Event provided for IM check was empty or not a dictionary.")
+        debug("Event provided for IM check was empty or not a dictionary.")
         return False
     if 'channel' in event and 'user' in event and 'text' in event:
         channel_id = event['channel']
         user_id = event['user']
-        text = event['text']
 
-        # list of (channel_id, user_id) tuples
-        im_channels = load_im_channels()
-        logging.debug("im_channels: {}".format(im_channels))
+        if im_channels_due():
+            logging.debug("IM channel index is stale, refreshing it.")
+            refresh_im_channels()
 
-        for c, u in im_channels:
-            if channel_id == c and user_id == u:
-                logging.debug("Found a matching IM channel with the user.")
-                return True
+        if im_channels.get(channel_id) == user_id:
+            debug("Found a matching IM channel with the user.")
+            return True
 
     return False
 
 
-def get_user(user_id):
-    logging.debug("Getting user for ID {}".format(user_id))
-    user = user_cache.get(user_id)
-    logging.debug("user: {}".format(user))
-    if user is not None:
-        logging.debug("Returning cached user: {}".format(user))
-        return user
+def init_user_cache():
+    cfg = snapshot.config
+    return cache.LRUCache(
+        max_size=cfg.get('user_cache_size', USER_CACHE_SIZE),
+        ttl=cfg.get('user_cache_ttl', USER_CACHE_TTL),
+        negative_ttl=cfg.get('user_negative_ttl', USER_NEGATIVE_TTL))
+
 
+def request_user(user_id):
     logging.info("Requesting user info for ID {}...".format(user_id))
-    info = sc.api_call("users.info", user=user_id)
+    info = slack_api.call("users.info", user=user_id)
     logging.debug("info: {}".format(info))
     if 'user' in info:
-        user = info['user']
-        user_cache[user_id] = user
+        return info['user']
+    if info.get('error') == 'user_not_found':
+        # cached as a negative result
+        return None
+    raise IOError("users.info failed for {}: {}".format(user_id, info.get('error')))
+
+
+def get_user(user_id):
+    debug("Getting user for ID {}", user_id)
+    user = user_directory.get(user_id)
+    if user is not None:
         return user
 
+    try:
+        return user_cache.get_or_load(user_id, request_user)
+    except IOError as e:
+        logging.warning(e)
+        return None
+
+
+def container_image_name(container):
+    attrs = container.attrs
+    # sparse listings carry the image name at the top level; inspected
+    # containers have the image ID there and the name under Config
+    image = attrs.get('Image')
+    if image is None or image.startswith('sha256:'):
+        image = (attrs.get('Config') or {}).get('Image', image)
+    return image
+
+
+def container_labels(container):
+    attrs = container.attrs
+    labels = attrs.get('Labels')
+    if labels is None:
+        labels = (attrs.get('Config') or {}).get('Labels')
+    return labels or {}
+
+
+def container_names(container):
+    attrs = container.attrs
+    names = attrs.get('Names')
+    if names is None:
+        names = [attrs.get('Name') or '']
+    return [n.lstrip('/') for n in names if n]
+
+
+def container_health(container):
+    attrs = container.attrs
+    if 'Health' in attrs:
+        return attrs['Health']
+    state = attrs.get('State')
+    if type(state) is dict:
+        return (state.get('Health') or {}).get('Status')
+    return None
+
+
+def normalize_image(image):
+    if image is None:
+        return None
+    if image.endswith(':latest'):
+        image = image[:-len(':latest')]
+    return image
+
+
+def server_image(server):
+    image = server.get('image')
+    version = server.get('version')
+    if image and version and ':' not in image.rsplit('/', 1)[-1]:
+        image = "{}:{}".format(image, version)
+    return normalize_image(image)
+
+
+def build_container_index(containers):
+    index = {}
+    for c in containers:
+        keys = []
+        label = container_labels(c).get(SERVER_LABEL)
+        if label:
+            keys.append(('label', label))
+        for name in container_names(c):
+            keys.append(('name', name))
+        image = normalize_image(container_image_name(c))
+        if image:
+            keys.append(('image', image))
+
+        for key in keys:
+            existing = index.get(key)
+            # prefer a running container when several share an image
+            if existing is None or (existing.status != 'running' and c.status == 'running'):
+                index[key] = c
+
+    return index
+
+
+def lookup_container(index, server, image=None, by_image=True):
+    if image is None:
+        image = server_image(server)
+    # an explicit label wins over a container named after the server, which
+    # wins over one that merely runs the same image
+    keys = [('label', server['id']), ('name', server['id'])]
+    if by_image:
+        keys.append(('image', image))
+    for key in keys:
+        c = index.get(key)
+        if c is not None:
+            return c
     return None
 
 
+def resolve_containers(srvs=None, by_image=True):
+    snap = snapshot
+    if srvs is None:
+        srvs = snap.servers
+    endpoints = [snap.server_endpoints[s['id']] for s in srvs]
+    listings, failures = docker_fleet.containers(endpoints, MAX_DOCKER_STATE_STALENESS)
+
+    containers = {}
+    unreachable = {}
+    indexes = {}
+    for s in srvs:
+        endpoint = snap.server_endpoints[s['id']]
+        if endpoint in failures:
+            unreachable[s['id']] = HostUnreachableException(endpoint, failures[endpoint])
+            continue
+        index = indexes.get(endpoint)
+        if index is None:
+            index = indexes[endpoint] = build_container_index(listings[endpoint])
+            logging.debug("Container index for {} has {} keys.".format(endpoint, len(index)))
+        containers[s['id']] = lookup_container(index, s, snap.server_images.get(s['id']), by_image)
+    return containers, unreachable
+
+
+def server_address(server):
+    host = server.get('host')
+    if not host:
+        # servers on a remote Docker host are reachable on that host
+        base_url = snapshot.docker_endpoints.get(server_endpoint(server))
+        if base_url:
+            host = urllib.parse.urlparse(base_url).hostname
+    return host or 'localhost', server.get('port') or slp.DEFAULT_PORT
+
+
+def run_coroutine(coro, timeout=None):
+    # handlers run on executor threads; probes run on the event loop
+    if event_loop is not None and event_loop.is_running():
+        return asyncio.run_coroutine_threadsafe(coro, event_loop).result(timeout)
+    return asyncio.run(coro)
+
+
+def probe_servers(srvs, containers):
+    addresses = {}
+    for s in srvs:
+        c = containers.get(s['id'])
+        if c is not None and c.status == 'running':
+            addresses[s['id']] = server_address(s)
+    if len(addresses) == 0:
+        return {}
+
+    try:
+        results = run_coroutine(prober.probe_many(list(set(addresses.values()))), PROBE_TIMEOUT + 1)
+    except concurrent.futures.TimeoutError:
+        logging.warning("Server List Ping probes timed out.")
+        return {}
+    return dict((server_id, results[address]) for server_id, address in addresses.items())
+
+
 def get_server_status(server_id):
     logging.debug("Getting server status for ID '{}'".format(server_id))
 
+    server = find_server(server_id)
+    if server is None:
+        raise ServerIdNotFoundException(server_id)
+
     try:
-        container = dc.containers.get(server_id)
-        status = container.status
-        return status.capitalize()
-    except docker.errors.NotFound:
-        return "Offline"
+        container = container_for_server(server)
+    except HostUnreachableException:
+        return record_status(server_id, unreachable=True)
     except docker.errors.APIError:
         return "Error"
+    probe = None
+    if container is not None:
+        probe = probe_servers([server], {server['id']: container}).get(server['id'])
+    return record_status(server_id, container, probe=probe)
+
+
+def record_status(server_id, container=None, unreachable=False, probe=None):
+    """The status shown for a server, remembered for the status gauge."""
+    if unreachable:
+        status = "Unreachable"
+    elif container is None:
+        status = "Offline"
+    elif probe is not None:
+        status = "Ready" if probe.ready else "Starting"
+    else:
+        status = container.status.capitalize()
+    server_statuses[server_id] = status
+    return status
+
 
-    return "WTF"
+def find_server(server_id):
+    return snapshot.servers_by_id.get(server_id)
 
 
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='list')
 def handle_list_command():
     logging.debug("Handle list command.")
 
+    snap = snapshot
+    srvs = snap.servers
+    containers, unreachable = resolve_containers(srvs)
+    probes = probe_servers(srvs, containers)
+
     # format the list of servers for display
     attachments = []
-    for s in servers:
-        attachment = server_status_attachment(container=None, server=s)
+    for s in srvs:
+        repository, tag = split_image(s)
+        image_cache = image_prewarmer.state(snap.server_endpoints[s['id']], "{}:{}".format(repository, tag))
+        record_status(s['id'], containers.get(s['id']), s['id'] in unreachable, probes.get(s['id']))
+        attachment = rendered_status_attachment('list', container=containers.get(s['id']), server=s, unreachable=s['id'] in unreachable, probe=probes.get(s['id']), image_cache=image_cache)
         attachments.append(attachment)
 
     return attachments
 
 
-def container_for_server(server):
-    return None
+def container_for_server(server, by_image=True):
+    # anything that changes a container passes by_image=False, since another
+    # server may run the same image
+    containers, unreachable = resolve_containers([server], by_image)
+    if server['id'] in unreachable:
+        raise unreachable[server['id']]
+    return containers.get(server['id'])
 
 
-def server_status_attachment(container=None, server=None):
+def server_status_values(container=None, unreachable=False, probe=None, image_cache=None):
+    # everything a status attachment shows that can change between calls
     status = "Offline"
     image = "None"
 
-    if container:
+    if unreachable:
+        status = "Unreachable"
+    elif container:
         status = container.status.capitalize()
-        image = container.image
-
+        if probe is not None:
+            # a running container may still be generating spawn chunks
+            status = "Ready" if probe.ready else "Starting"
+        health = container_health(container)
+        if health:
+            status = "{} ({})".format(status, health)
+        image = container_image_name(container)
+
+    players = ping = motd = None
+    if probe is not None and probe.ready:
+        players = "{}/{}".format(probe.online, probe.max)
+        ping = "{:.0f} ms".format(probe.latency)
+        motd = probe.motd
+    cache = image_cache.describe() if image_cache is not None else None
+    return status, image, players, ping, motd, cache
+
+
+def status_attachment(server, status, image, players, ping, motd, cache):
     attachment = {
         'fallback': "{:>10}: {}\n  {}".format(server['id'], server['name'], server['info']),
-        'color': "#{}".format(randhex(3)),
+        'color': render.stable_color(server['id']),
         # 'image_url': "minecraft.png",
         'title': server['name'],
         'text': server.get('info'),
@@ -266,8 +883,52 @@ def server_status_attachment(container=None, server=None):
             },
         ]
     }
+    if players is not None:
+        attachment['fields'].extend([
+            {
+                'title': "Players",
+                'value': players,
+                'short': True
+            },
+            {
+                'title': "Ping",
+                'value': ping,
+                'short': True
+            },
+        ])
+        if motd:
+            attachment['fields'].append({
+                'title': "MOTD",
+                'value': motd,
+                'short': False
+            })
+    if server.get('endpoint'):
+        attachment['fields'].append({
+            'title': "Host",
+            'value': server['endpoint'],
+            'short': True
+        })
+    if cache is not None:
+        attachment['fields'].append({
+            'title': "Image cache",
+            'value': cache,
+            'short': True
+        })
     return attachment
 
+
+def server_status_attachment(container=None, server=None, unreachable=False, probe=None, image_cache=None):
+    return status_attachment(server, *server_status_values(container, unreachable, probe, image_cache))
+
+
+def rendered_status_attachment(view, container=None, server=None, unreachable=False, probe=None, image_cache=None):
+    # serialised once per state a server is seen in, so repeated list and
+    # status calls only compare the values shown
+    values = server_status_values(container, unreachable, probe, image_cache)
+    return render_cache.render((view, server['id']), values, lambda: status_attachment(server, *values))
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='status')
 def handle_status_command(server_id):
     logging.debug("Handle status command.")
 
@@ -278,316 +939,1117 @@ def handle_status_command(server_id):
     # default server status
     if server_id is None:
         # figure out which server is running and display its status
-        containers = dc.containers.list(all=True)
-
-        for s in servers:
-            server_image = s['image']
-
-            found = False
-            for c in containers:
-                logging.debug("c: {}".format(c))
-                container_image = c.attrs['Config']['Image']
-                logging.debug("image: {}".format(container_image))
-
-                if server_image == container_image:
-                    attachment = server_status_attachment(container=c, server=s)
-                    attachments.append(attachment)
-                    found = True
-                    break
-            if not found:
-                attachment = server_status_attachment(container=None, server=s)
-                attachments.append(attachment)
+        srvs = snapshot.servers
     else:
-        for s in servers:
-            if s['id'] == server_id:
-                c = container_for_server(s)
-                a = server_status_attachment(container=c, server=s)
-                attachments.append(a)
-        if len(attachments) == 0:
+        s = find_server(server_id)
+        if s is None:
             raise ServerIdNotFoundException(server_id)
+        srvs = [s]
+
+    containers, unreachable = resolve_containers(srvs)
+    probes = probe_servers(srvs, containers)
+    for s in srvs:
+        record_status(s['id'], containers.get(s['id']), s['id'] in unreachable, probes.get(s['id']))
+        attachment = rendered_status_attachment('status', container=containers.get(s['id']), server=s, unreachable=s['id'] in unreachable, probe=probes.get(s['id']))
+        attachments.append(attachment)
 
     return attachments
 
 
-def handle_start_command(server_id):
-    logging.debug("Handle start command for server ID {}.".format(server_id))
+def heap_limit(server, container):
+    # the -Xmx the server was started with, falling back to its configured memory
+    xmx = telemetry.parse_xmx(container.attrs.get('Command') or (container.attrs.get('Config') or {}).get('Cmd'))
+    return scheduler.parse_memory(xmx or server.get('memory'))
+
+
+def running_containers(srvs, containers):
+    # server ID -> (Docker client, container ID) for every running server
+    running = {}
+    for s in srvs:
+        c = containers.get(s['id'])
+        if c is not None and c.status == 'running':
+            running[s['id']] = (docker_fleet.client(snapshot.server_endpoints[s['id']]), c.id)
+    return running
+
+
+def format_rate(rate):
+    if rate is None:
+        return "-"
+    return "{}/s".format(scheduler.format_memory(rate))
+
+
+def stats_fields(summary, limit):
+    if summary is None:
+        return [{
+            'title': "Resources",
+            'value': "No samples yet",
+            'short': True
+        }]
+
+    cpu = "-"
+    if summary['cpu'] is not None:
+        cpu = "{:.0f}% (avg {:.0f}%, peak {:.0f}%)".format(summary['cpu'], summary['cpu_avg'], summary['cpu_peak'])
+    memory = "{} (peak {})".format(scheduler.format_memory(summary['memory']), scheduler.format_memory(summary['memory_peak']))
+    if limit:
+        # docker only sees the process's RSS, which runs above the heap
+        memory += " of {} -Xmx, {:.0f}%".format(scheduler.format_memory(limit), summary['memory'] * 100.0 / limit)
+    return [
+        {
+            'title': "CPU",
+            'value': cpu,
+            'short': True
+        },
+        {
+            'title': "Memory (RSS)",
+            'value': memory,
+            'short': True
+        },
+        {
+            'title': "Network",
+            'value': "in {}, out {}".format(format_rate(summary['rx_rate']), format_rate(summary['tx_rate'])),
+            'short': True
+        },
+        {
+            'title': "Block I/O",
+            'value': "read {}, write {}".format(format_rate(summary['read_rate']), format_rate(summary['write_rate'])),
+            'short': True
+        },
+    ]
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='stats')
+def handle_stats_command(server_id):
+    logging.debug("Handle stats command.")
 
     if server_id is None:
-        raise MissingArgumentException('server_id')
+        srvs = snapshot.servers
+    else:
+        s = find_server(server_id)
+        if s is None:
+            raise ServerIdNotFoundException(server_id)
+        srvs = [s]
+
+    containers, unreachable = resolve_containers(srvs)
+    running = running_containers(srvs, containers)
+    # servers nobody asked about yet get a stream now and a short wait for
+    # their first samples
+    for key, (client, container_id) in running.items():
+        stats_collector.subscribe(key, client, container_id)
+    probes = probe_servers(srvs, containers)
 
-    server = None
-    for s in servers:
-        if 'id' in s and s['id'] == server_id:
-            server = s
+    attachments = []
+    for s in srvs:
+        if s['id'] not in running:
+            continue
+        container = containers[s['id']]
+        attachment = server_status_attachment(container=container, server=s, probe=probes.get(s['id']))
+        summary = stats_collector.summary(s['id'], timeout=telemetry.FIRST_SAMPLE_TIMEOUT)
+        attachment['fields'].extend(stats_fields(summary, heap_limit(s, container)))
+        attachments.append(attachment)
+
+    return attachments
+
+
+def split_image(server):
+    image = server['image']
+    tag = server.get('version') or 'latest'
+    if ':' in image.rsplit('/', 1)[-1]:
+        image, tag = image.rsplit(':', 1)
+    return image, tag
+
+
+def container_options(server):
+    ports = {}
+    if server.get('port'):
+        ports['25565/tcp'] = server['port']
+    if rcon_password(server) is not None:
+        # RCON is reached on the same host as the game, at rcon_port
+        ports['{}/tcp'.format(rcon.DEFAULT_PORT)] = server.get('rcon_port', rcon.DEFAULT_PORT)
+    volumes = {}
+    for v in server.get('volumes', []):
+        volumes[v['host']] = {'bind': v['container'], 'mode': 'rw'}
+    return {
+        'name': server['id'],
+        'labels': {SERVER_LABEL: server['id']},
+        'ports': ports,
+        'volumes': volumes,
+        'detach': True,
+    }
+
+
+def ensure_image(job, client, server):
+    repository, tag = split_image(server)
+    ref = "{}:{}".format(repository, tag)
+    # locally built images can't be pulled; only pull when asked to or
+    # missing, and not when the prewarmer has just pulled it
+    if not server.get('pull') or image_prewarmer.is_fresh(snapshot.server_endpoints[server['id']], ref):
+        try:
+            client.images.get(ref)
+            job.progress("Image {} is present".format(ref))
+            return ref
+        except docker.errors.ImageNotFound:
+            pass
+
+    job.progress("Pulling {}".format(ref))
+    layers = {}
+    last = 0
+    for line in client.api.pull(repository, tag=tag, stream=True, decode=True):
+        if 'error' in line:
+            raise ContainerCreationException(line['error'])
+        if 'id' in line and 'status' in line:
+            layers[line['id']] = line['status']
+        now = time.time()
+        if layers and now - last >= PROGRESS_INTERVAL:
+            done = sum(1 for s in layers.values() if s in ('Pull complete', 'Already exists'))
+            job.progress("Pulling {} ({}/{} layers)".format(ref, done, len(layers)), replace=True)
+            last = now
+    job.progress("Pulled {}".format(ref), replace=True)
+    return ref
+
+
+def start_server(job, server, evict=()):
+    for s in evict:
+        job.progress("Stopping idle server {} to free memory".format(s['id']))
+        stop_server(job, s)
+
+    client = docker_fleet.client(snapshot.server_endpoints[server['id']])
+    existing = container_for_server(server, by_image=False)
+    if existing is not None:
+        container = client.containers.get(existing.attrs['Id'])
+        if container.status == 'running':
+            job.progress("Already running in container {}".format(container.short_id))
+            return
+    else:
+        ref = ensure_image(job, client, server)
+        container = client.containers.create(ref, **container_options(server))
+        job.progress("Created container {}".format(container.short_id))
+
+    # lines already in the buffer are from an earlier run of this container
+    previous = log_tailer.buffer(server['id'])
+    mark = previous.next_seq if previous is not None else 0
+    container.start()
+    job.progress("Started container {}".format(container.short_id))
+    follower = log_tailer.follow(server['id'], client, container.id)
+    if follower.buffer is not previous:
+        mark = 0
+    wait_until_ready(job, server, container, follower.buffer, mark)
+
+
+def wait_until_ready(job, server, container, buffer, mark):
+    # ready once the log says the world is loaded or the server answers a
+    # ping, whichever is seen first
+    job.progress("Loading the world")
+    address = server_address(server)
+    deadline = time.time() + server.get('ready_timeout', READY_TIMEOUT)
+    while time.time() < deadline:
+        if buffer.find(logtail.READY_PATTERN, mark) is not None:
             break
+        try:
+            probe = run_coroutine(prober.probe_many([address]), PROBE_TIMEOUT + 1).get(address)
+        except concurrent.futures.TimeoutError:
+            probe = None
+        if probe is not None and probe.ready:
+            break
+        container.reload()
+        if container.status != 'running':
+            raise ServerNotReadyException(server['id'], "exited while loading (status {})".format(container.status))
+        time.sleep(READY_POLL_INTERVAL)
+    else:
+        raise ServerNotReadyException(server['id'], "wasn't ready after {}s".format(server.get('ready_timeout', READY_TIMEOUT)))
+    job.progress("Ready", replace=True)
+
+
+def stop_server(job, server):
+    client = docker_fleet.client(snapshot.server_endpoints[server['id']])
+    existing = container_for_server(server, by_image=False)
+    if existing is None or existing.status != 'running':
+        job.progress("Not running")
+        return
+
+    container = client.containers.get(existing.attrs['Id'])
+    job.progress("Stopping container {}".format(container.short_id))
+    container.stop(timeout=server.get('stop_timeout', STOP_TIMEOUT))
+    job.progress("Stopped container {}".format(container.short_id), replace=True)
+
+
+def job_notifier(channel_id):
+    # posts the job's log once, then edits that message as the job progresses
+    def notify(job):
+        text = job.text()
+        if job.message is None:
+            response = slack_api.call("chat.postMessage", priority=slackapi.PRIORITY_REPLY, channel=channel_id, as_user=True, text=text)
+            if response.get('ok'):
+                job.message = (response['channel'], response['ts'])
+        else:
+            channel, ts = job.message
+            slack_api.call("chat.update", priority=slackapi.PRIORITY_REPLY, channel=channel, ts=ts, text=text)
+    return notify
+
+
+def submit_server_job(kind, run, server_id, requested_by=None, notify=None):
+    if server_id is None:
+        raise MissingArgumentException('server_id')
+
+    server = find_server(server_id)
     if server is None:
         raise ServerIdNotFoundException(server_id)
 
+    return job_engine.submit(kind, server_id, lambda job: run(job, server), requested_by=requested_by, notify=notify)
+
+
+def memory_budget(endpoint):
+    budget = snapshot.config.get('memory_budget')
+    if type(budget) is dict:
+        budget = budget.get(endpoint)
+    return scheduler.parse_memory(budget)
+
+
+def idle_timeout(server):
+    minutes = server.get('idle_timeout', snapshot.config.get('idle_timeout'))
+    if not minutes:
+        return None
+    return minutes * 60
+
+
+def plan_server_start(server):
+    snap = snapshot
+    endpoint = snap.server_endpoints[server['id']]
+    budget = memory_budget(endpoint)
+    if budget is None:
+        return scheduler.START, []
+
+    # a server that's already running needs no room; the start job will
+    # say so rather than it being queued
+    own, unreachable = resolve_containers([server], by_image=False)
+    if own.get(server['id']) is not None and own[server['id']].status == 'running':
+        return scheduler.START, []
+
+    same_host = [s for s in snap.servers if snap.server_endpoints[s['id']] == endpoint and s['id'] != server['id']]
+    containers, unreachable = resolve_containers(same_host)
+    running = [s for s in same_host if containers.get(s['id']) is not None and containers[s['id']].status == 'running']
+    return server_scheduler.plan_start(server, running, budget)
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='start')
+def handle_start_command(server_id, requested_by=None, notify=None):
+    logging.debug("Handle start command for server ID {}.".format(server_id))
+
+    if server_id is None:
+        raise MissingArgumentException('server_id')
+    server = find_server(server_id)
+    if server is None:
+        raise ServerIdNotFoundException(server_id)
+
+    plan, evict = plan_server_start(server)
+    if plan == scheduler.QUEUE:
+        position = server_scheduler.enqueue(server_id, (requested_by, notify))
+        raise InsufficientMemoryException(server_id, position)
+    server_scheduler.dequeue(server_id)
+    return submit_server_job('start', functools.partial(start_server, evict=evict), server_id, requested_by, notify)
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='stop')
+def handle_stop_command(server_id, requested_by=None, notify=None):
+    logging.debug("Handle stop command for server ID {}.".format(server_id))
+    return submit_server_job('stop', stop_server, server_id, requested_by, notify)
+
+
+def rcon_password(server):
+    # config.json holds one password for every server, or one per server ID
+    password = snapshot.config.get('rcon_password')
+    if type(password) is dict:
+        password = password.get(server['id'])
+    return password or None
+
+
+def rcon_command(server, text, timeout=None):
+    password = rcon_password(server)
+    if password is None:
+        raise rcon.RconException("RCON isn't configured for {}".format(server['id']))
+    host, port = server_address(server)
+    timeout = timeout or rcon_pool.timeout
+    return run_coroutine(rcon_pool.command(server['id'], host, server.get('rcon_port', rcon.DEFAULT_PORT), password, text, timeout), timeout + 1)
+
+
+async def rcon_broadcast(srvs, text, timeout=None):
+    # one command to several servers at once; failures are returned, not raised
+    tasks = []
+    for s in srvs:
+        host, port = server_address(s)
+        command = rcon_pool.command(s['id'], host, s.get('rcon_port', rcon.DEFAULT_PORT), rcon_password(s), text)
+        tasks.append(asyncio.wait_for(command, timeout))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    return dict(zip([s['id'] for s in srvs], results))
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='rcon')
+def handle_rcon_command(server_id, text):
+    text = slack_unescape(text)
+    logging.debug("Handle rcon command for server ID {}: {}".format(server_id, text))
+
+    if server_id == 'all':
+        srvs = [s for s in snapshot.servers if rcon_password(s) is not None]
+        containers, unreachable = resolve_containers(srvs)
+        srvs = [s for s in srvs if containers.get(s['id']) is not None and containers[s['id']].status == 'running']
+    else:
+        s = find_server(server_id)
+        if s is None:
+            raise ServerIdNotFoundException(server_id)
+        if rcon_password(s) is None:
+            raise rcon.RconException("RCON isn't configured for {}".format(server_id))
+        srvs = [s]
+    if len(srvs) == 0:
+        return []
+
+    try:
+        # each command has its own timeout; this only trips if the loop is stuck
+        results = run_coroutine(rcon_broadcast(srvs, text, rcon_pool.timeout), rcon_pool.timeout * 2)
+    except concurrent.futures.TimeoutError:
+        results = dict((s['id'], concurrent.futures.TimeoutError()) for s in srvs)
     attachments = []
+    for s in srvs:
+        result = results[s['id']]
+        if isinstance(result, (asyncio.TimeoutError, concurrent.futures.TimeoutError)):
+            output = "Timed out"
+            color = "danger"
+        elif isinstance(result, Exception):
+            output = "Failed: {}".format(str(result) or type(result).__name__)
+            color = "danger"
+        else:
+            output = "```{}```".format(result.strip()) if result.strip() else "_No output_"
+            color = "good"
+        attachments.append({
+            'fallback': "{}: {}".format(s['id'], output),
+            'color': color,
+            'title': s['name'],
+            'text': output,
+            "mrkdwn_in": ["text"]
+        })
+    return attachments
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='logs')
+def handle_logs_command(server_id, pattern=None, count=None):
+    logging.debug("Handle logs command for server ID {}.".format(server_id))
+
+    if server_id is None:
+        raise MissingArgumentException('server_id')
+    server = find_server(server_id)
+    if server is None:
+        raise ServerIdNotFoundException(server_id)
+
+    # a lone number is a line count
+    if count is None and pattern is not None and pattern.isdigit():
+        pattern, count = None, pattern
+    if count is None:
+        count = DEFAULT_LOG_LINES
+    elif count.isdigit():
+        count = min(int(count), MAX_LOG_LINES)
+    else:
+        raise commands.UsageException(registry.get('logs'))
+
+    buffer = log_tailer.buffer(server_id)
+    if buffer is None:
+        # nobody has asked for this log since the server started; follow it
+        # from now on
+        containers, unreachable = resolve_containers([server])
+        running = running_containers([server], containers)
+        if server_id not in running:
+            return None
+        client, container_id = running[server_id]
+        log_tailer.follow(server_id, client, container_id).started.wait(LOG_START_TIMEOUT)
+        buffer = log_tailer.buffer(server_id)
+    return buffer.search(pattern, count)
+
+
+def is_local_endpoint(endpoint):
+    base_url = snapshot.docker_endpoints.get(endpoint)
+    return base_url is None or base_url.startswith('unix://')
+
+
+def world_path(server):
+    # the host side of the volume holding the world, unless configured
+    if server.get('world'):
+        return server['world']
+    endpoint = snapshot.server_endpoints[server['id']]
+    if not is_local_endpoint(endpoint):
+        # volume paths are on the Docker host, not where foreman runs
+        raise backup.BackupException("{} runs on Docker host {}, so its world isn't reachable from here; "
+                                     "set 'world' to a path foreman can read".format(server['id'], endpoint))
+    volumes = server.get('volumes', [])
+    for v in volumes:
+        if v['container'].rstrip('/').endswith('world'):
+            return v['host']
+    if volumes:
+        return volumes[0]['host']
+    raise backup.BackupException("no world volume configured for {}".format(server['id']))
+
+
+def backup_server(job, server):
+    path = world_path(server)
+    container = container_for_server(server, by_image=False)
+    paused = False
+    if container is not None and container.status == 'running':
+        if rcon_password(server) is None:
+            raise backup.BackupException("{} is running and RCON isn't configured, so saving can't be paused".format(server['id']))
+        # flush the world to disk and keep it from changing under the backup
+        rcon_command(server, "save-off")
+        paused = True
+        job.progress("Saving paused")
 
     try:
-        container = dc.containers.run(image)
-    except docker.errors.NotFound:
-        pass
-    except docker.errors.APIError:
-        pass
+        if paused:
+            rcon_command(server, "save-all flush", timeout=SAVE_TIMEOUT)
+            job.progress("World saved")
+        manifest = backup_engine.backup(server['id'], path, progress=job.progress)
+    finally:
+        if paused:
+            rcon_command(server, "save-on")
+            job.progress("Saving resumed")
+
+    last_backups[server['id']] = manifest['created']
+    backup_failures.pop(server['id'], None)
+    job.progress("Backed up as {} ({} files changed, {} new)".format(
+        manifest['name'], manifest['changed'], scheduler.format_memory(manifest['written'])))
+    keep = server.get('backup_keep', snapshot.config.get('backup_keep', backup.DEFAULT_KEEP))
+    removed = backup_engine.store.prune(server['id'], keep)
+    if removed:
+        job.progress("Removed {} unreferenced chunks".format(removed))
+
+
+def restore_server(job, server, name=None):
+    container = container_for_server(server, by_image=False)
+    if container is not None and container.status == 'running':
+        raise backup.BackupException("stop {} before restoring it".format(server['id']))
+    manifest, aside = backup_engine.restore(server['id'], world_path(server), name, progress=job.progress)
+    job.progress("Restored {}".format(manifest['name']))
+    if aside:
+        job.progress("The previous world was moved to {}".format(aside))
+
+
+def backup_interval(server):
+    minutes = server.get('backup_interval', snapshot.config.get('backup_interval'))
+    if not minutes:
+        return None
+    return minutes * 60
+
+
+def scheduled_backup(job, server):
+    try:
+        backup_server(job, server)
+    except Exception:
+        failures, at = backup_failures.get(server['id'], (0, None))
+        backup_failures[server['id']] = (failures + 1, time.time())
+        raise
 
-    return attachments
 
+def backup_due(server):
+    interval = backup_interval(server)
+    if interval is None:
+        return False
+    failures, failed_at = backup_failures.get(server['id'], (0, None))
+    if failures:
+        # don't post a failed job every tick while something is broken
+        delay = min(interval, BACKUP_RETRY_DELAY * 2 ** (failures - 1))
+        return time.time() - failed_at >= delay
+    if server['id'] not in last_backups:
+        manifest = backup_engine.store.load_manifest(server['id'])
+        last_backups[server['id']] = manifest['created'] if manifest else 0
+    return time.time() - last_backups[server['id']] >= interval
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='backup')
+def handle_backup_command(server_id, requested_by=None, notify=None):
+    logging.debug("Handle backup command for server ID {}.".format(server_id))
+    return submit_server_job('backup', backup_server, server_id, requested_by, notify)
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='restore')
+def handle_restore_command(server_id, name=None, requested_by=None, notify=None):
+    logging.debug("Handle restore command for server ID {}.".format(server_id))
+    return submit_server_job('restore', functools.partial(restore_server, name=name), server_id, requested_by, notify)
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='backups')
+def handle_backups_command(server_id):
+    logging.debug("Handle backups command for server ID {}.".format(server_id))
+
+    if server_id is None:
+        raise MissingArgumentException('server_id')
+    if find_server(server_id) is None:
+        raise ServerIdNotFoundException(server_id)
+    return backup_engine.store.snapshots(server_id)
+
+
+def format_region(region):
+    where = region.name if region.x is None else "r.{}.{}".format(region.x, region.z)
+    return "{} ({} chunks, {})".format(where, region.chunks, scheduler.format_memory(region.size))
+
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='world')
+def handle_world_command(server_id):
+    logging.debug("Handle world command for server ID {}.".format(server_id))
+
+    if server_id is None:
+        raise MissingArgumentException('server_id')
+    server = find_server(server_id)
+    if server is None:
+        raise ServerIdNotFoundException(server_id)
+    try:
+        path = world_path(server)
+    except backup.BackupException as e:
+        raise regions.RegionException(e.message)
+    summary = region_analyzer.scan(path)
+
+    fields = []
+    for name, totals in sorted(summary.dimensions.items(), key=lambda d: d[0] != 'overworld'):
+        value = "{} chunks in {} regions, {}".format(totals['chunks'], totals['regions'], scheduler.format_memory(totals['bytes']))
+        if totals['other_bytes']:
+            value += " (+{} entities and POIs)".format(scheduler.format_memory(totals['other_bytes']))
+        fields.append({
+            'title': name,
+            'value': value,
+            'short': True
+        })
+    newest = [r for r in summary.newest() if r.newest]
+    if newest:
+        fields.append({
+            'title': "Recently modified",
+            'value': "\n".join("{}, {}".format(format_region(r), time.strftime("%Y-%m-%d %H:%M", time.gmtime(r.newest)))
+                               for r in newest),
+            'short': False
+        })
+    if summary.regions:
+        fields.append({
+            'title': "Largest regions",
+            'value': "\n".join(format_region(r) for r in summary.heaviest()),
+            'short': False
+        })
+    if summary.errors:
+        fields.append({
+            'title': "Unreadable",
+            'value': "\n".join("{}: {}".format(os.path.relpath(p, path), e) for p, e in summary.errors[:regions.DEFAULT_TOP]),
+            'short': False
+        })
+
+    return {
+        'fallback': "{}: {} chunks, {}".format(server['name'], summary.chunks, scheduler.format_memory(summary.bytes)),
+        'color': "good" if not summary.errors else "warning",
+        'title': server['name'],
+        'text': "{} chunks generated, {} on disk".format(summary.chunks, scheduler.format_memory(summary.bytes)),
+        'fields': fields,
+        'footer': "{} region files read, {} unchanged".format(summary.scanned, summary.cached)
+    }
+
+
+def managed_images(snap):
+    images = set()
+    for s in snap.servers:
+        repository, tag = split_image(s)
+        images.add((snap.server_endpoints[s['id']], repository, tag, bool(s.get('pull')), s.get('digest')))
+    return images
+
+
+def prewarm_servers():
+    snap = snapshot
+    submitted = image_prewarmer.warm(managed_images(snap))
+    if submitted:
+        logging.info("Prewarming {} image(s).".format(submitted))
+
+
+def schedule_servers():
+    snap = snapshot
+    prewarm_servers()
+    containers, unreachable = resolve_containers(snap.servers)
+    probes = probe_servers(snap.servers, containers)
+    for s in snap.servers:
+        record_status(s['id'], containers.get(s['id']), s['id'] in unreachable, probes.get(s['id']))
+    # keep a stats stream open on every running server
+    running = running_containers(snap.servers, containers)
+    stats_collector.sync(running)
+    log_tailer.sync(running)
+    for s in snap.servers:
+        if s['id'] in unreachable:
+            continue
+        c = containers.get(s['id'])
+        if c is None or c.status != 'running':
+            server_scheduler.forget(s['id'])
+            continue
+        probe = probes.get(s['id'])
+        # servers that aren't answering pings yet are never idle
+        server_scheduler.observe(s['id'], probe.online if probe is not None and probe.ready else None)
+
+    notify = None
+    if snap.config.get('scheduler_channel'):
+        notify = job_notifier(snap.config['scheduler_channel'])
+
+    timeouts = dict((s['id'], idle_timeout(s)) for s in snap.servers)
+    for server_id in server_scheduler.idle(timeouts):
+        logging.info("Server {} has been empty for {:.0f}s; stopping it.".format(server_id, server_scheduler.idle_for(server_id)))
+        job, created = submit_server_job('stop', stop_server, server_id, notify=notify)
+        if created:
+            server_scheduler.forget(server_id)
+
+    # only running servers change, so only they are backed up on schedule
+    for s in snap.servers:
+        c = containers.get(s['id'])
+        if c is not None and c.status == 'running' and backup_due(s):
+            logging.info("Backup of {} is due.".format(s['id']))
+            submit_server_job('backup', scheduled_backup, s['id'], notify=notify)
+
+    for server_id, (requested_by, queued_notify) in server_scheduler.queued():
+        server = find_server(server_id)
+        if server is None:
+            server_scheduler.dequeue(server_id)
+            continue
+        plan, evict = plan_server_start(server)
+        if plan == scheduler.START:
+            logging.info("Starting queued server {}.".format(server_id))
+            server_scheduler.dequeue(server_id)
+            submit_server_job('start', functools.partial(start_server, evict=evict), server_id, requested_by, queued_notify)
+
+
+async def schedule(loop):
+    while True:
+        await asyncio.sleep(SCHEDULER_INTERVAL)
+        try:
+            await loop.run_in_executor(executor, schedule_servers)
+        except Exception:
+            logging.exception("Scheduling servers failed.")
 
-def handle_stop_command(server_id):
-    logging.debug("Handle stop command.")
+
+@metrics.timed(COMMAND_DURATION, COMMAND_ERRORS, command='jobs')
+def handle_jobs_command():
+    logging.debug("Handle jobs command.")
 
     attachments = []
+    for job in job_engine.active():
+        attachments.append({
+            'fallback': job.text(),
+            'title': job.title(),
+            'text': "\n".join(job.lines[-3:]),
+            'fields': [
+                {
+                    'title': "State",
+                    'value': job.state.capitalize(),
+                    'short': True
+                },
+                {
+                    'title': "Elapsed",
+                    'value': "{:.0f}s".format(job.elapsed()),
+                    'short': True
+                },
+            ]
+        })
 
     return attachments
 
 
+def rtm_send(channel_id, message):
+    # the websocket is shared by the event loop and every worker thread
+    with rtm_lock:
+        sc.rtm_send_message(channel=channel_id, message=message)
+
+
 def send_message(channel_id, sender_id, response, attachments, message_is_im=False):
     logging.debug("Sending message to channel {}...".format(channel_id))
     api = "chat.postMessage"
     if not message_is_im:
         response = "<@{}> {}".format(sender_id, response)
         # api = "chat.postEphemeral"
-    sc.api_call(api, channel=channel_id, as_user=True, text=response, attachments=attachments)
+    slack_api.call(api, priority=slackapi.PRIORITY_REPLY, channel=channel_id, as_user=True, text=response, attachments=attachments)
 
 
 def handle_help():
-    attachments = [
-        {
-            'fallback': "list",
-            'color': "#ff0ff0",
-            'title': "List",
-            'text': "`list`\nList the servers that can be managed, and their current status",
-            "mrkdwn_in": ["text"]
-        }
-        ,
-        {
-            'fallback': "status [<server-id>]",
-            'color': "#0000ff",
-            'title': "Status",
-            'text': "`status [<server-id>]`\nGet the status of all servers, or for a particular server",
-            "mrkdwn_in": ["text"]
-        }
-        ,
-        {
-            'fallback': "start <server-id>",
-            'color': "#00ff00",
-            'title': "Start",
-            'text': "`start <server-id>`\nStart a particular server",
-            "mrkdwn_in": ["text"]
-        }
-        ,
-        {
-            'fallback': "stop <server-id>",
-            'color': "#ff0000",
-            'title': "Stop",
-            'text': "`stop <server-id>`\nStop a particular server",
-            "mrkdwn_in": ["text"]
-        }
-    ]
-    return attachments
+    # only changes when the permissions are reloaded
+    return render_cache.render('help', permission_index.generation,
+                               lambda: registry.help_attachments([name for name in registry.commands if name in permission_index]))
+
+
+# Commands
+
+@registry.register('list', description="List the servers that can be managed, and their current status", color="#ff0ff0")
+def command_list(request):
+    attachments = handle_list_command()
+    request.reply("Here's the server list:", render.join(attachments))
+
+
+@registry.register('status', args=[Arg('server_id', required=False)],
+                   description="Get the status of all servers, or for a particular server", color="#0000ff")
+def command_status(request, server_id):
+    message = "Current server status:"
+    if server_id is not None:
+        message = "Server status for {}:".format(server_id)
+    attachments = handle_status_command(server_id)
+    server_count = len(snapshot.servers)
+    if len(attachments) == 0 and server_count > 0:
+        response = "Could not get server status, even though I manage {} server(s).".format(server_count)
+        request.reply(response)
+        return
+    if server_id is None and len(attachments) != server_count:
+        message = "Could not get status for all servers. Here are the ones I did get:"
+    request.reply(message, render.join(attachments))
 
 
-def process_event(event):
-    logging.debug("event: {}, {}".format(type(event), json.dumps(event, sort_keys=True, indent=4)))
+def reply_job(request, server_id, job, created):
+    if not created:
+        response = "Server '{}' is busy with job {} ({}).".format(server_id, job.id, job.kind)
+        request.reply(response)
+
+
+@registry.register('start', args=[Arg('server_id')],
+                   description="Start a particular server; progress is posted as it goes", color="#00ff00")
+def command_start(request, server_id):
+    job, created = handle_start_command(server_id, requested_by=request.sender_id, notify=job_notifier(request.channel_id))
+    reply_job(request, server_id, job, created)
+
+
+@registry.register('stop', args=[Arg('server_id')], description="Stop a particular server", color="#ff0000")
+def command_stop(request, server_id):
+    job, created = handle_stop_command(server_id, requested_by=request.sender_id, notify=job_notifier(request.channel_id))
+    reply_job(request, server_id, job, created)
+
+
+@registry.register('backup', args=[Arg('server_id')],
+                   description="Back up a server's world; only what changed since the last backup is stored. "
+                               "Servers on remote Docker hosts need a 'world' path foreman can reach", color="#4682b4")
+def command_backup(request, server_id):
+    job, created = handle_backup_command(server_id, requested_by=request.sender_id, notify=job_notifier(request.channel_id))
+    reply_job(request, server_id, job, created)
+
+
+@registry.register('backups', args=[Arg('server_id')], description="List a server's backups", color="#4682b4")
+def command_backups(request, server_id):
+    names = handle_backups_command(server_id)
+    if len(names) == 0:
+        request.reply("There are no backups of '{}'.".format(server_id))
+        return
+    request.reply("Backups of '{}', newest first:\n{}".format(server_id, "\n".join(reversed(names))))
+
 
+@registry.register('restore', args=[Arg('server_id'), Arg('name', required=False, metavar='backup')],
+                   description="Restore a stopped server's world from its latest backup, or the one named. "
+                               "Servers on remote Docker hosts need a 'world' path foreman can reach", color="#b22222")
+def command_restore(request, server_id, name):
+    job, created = handle_restore_command(server_id, name, requested_by=request.sender_id, notify=job_notifier(request.channel_id))
+    reply_job(request, server_id, job, created)
+
+
+@registry.register('rcon', args=[Arg('server_id', metavar='server-id|all'), Arg('text', rest=True, metavar='command')],
+                   description="Run a console command on a server, or on every running server", color="#2f4f4f")
+def command_rcon(request, server_id, text):
+    attachments = handle_rcon_command(server_id, text)
+    if len(attachments) == 0:
+        request.reply("No running servers have RCON configured.")
+        return
+    request.reply("`{}`:".format(text), attachments)
+
+
+@registry.register('logs', args=[Arg('server_id'), Arg('pattern', required=False), Arg('count', required=False, metavar='n')],
+                   description="Show a server's recent log lines, matching text or level:, player: or exception:", color="#696969")
+def command_logs(request, server_id, pattern, count):
+    lines = handle_logs_command(server_id, pattern, count)
+    if lines is None:
+        request.reply("Server '{}' isn't running.".format(server_id))
+        return
+    if len(lines) == 0:
+        request.reply("No matching log lines for '{}'.".format(server_id))
+        return
+    text = "\n".join(lines)
+    if len(text) > MAX_LOG_REPLY:
+        text = "…" + text[-MAX_LOG_REPLY:]
+    request.reply("```{}```".format(text.replace("```", "` ` `")))
+
+
+@registry.register('world', args=[Arg('server_id')],
+                   description="Show a server's generated chunks and world size by dimension. "
+                               "Servers on remote Docker hosts need a 'world' path foreman can reach", color="#228b22")
+def command_world(request, server_id):
+    request.reply("World of '{}':".format(server_id), [handle_world_command(server_id)])
+
+
+@registry.register('stats', args=[Arg('server_id', required=False)],
+                   description="Show CPU, memory, network and disk use of running servers", color="#8b4513")
+def command_stats(request, server_id):
+    attachments = handle_stats_command(server_id)
+    if len(attachments) == 0:
+        if server_id is None:
+            request.reply("No servers are running.")
+        else:
+            request.reply("Server '{}' isn't running.".format(server_id))
+        return
+    request.reply("Recent resource usage:", attachments)
+
+
+@registry.register('jobs', description="List the server jobs in progress", color="#ffa500")
+def command_jobs(request):
+    attachments = handle_jobs_command()
+    if len(attachments) == 0:
+        request.reply("No jobs in progress.")
+    else:
+        request.reply("Jobs in progress:", attachments)
+
+
+@registry.register('help', description="List the commands I understand", color="#808080")
+def command_help(request):
+    request.reply("Here are the commands I understand:", handle_help())
+
+
+@metrics.timed(EVENT_DURATION)
+def process_event(event):
     if type(event) is not dict:
-        logging.debug("Event wasn't a dictionary, so skipping it.")
+        debug("Event wasn't a dictionary, so skipping it.")
         return
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("event: {}".format(json.dumps(event, sort_keys=True, indent=4)))
 
     event_type = event.get('type')
     if event_type is None:
-        logging.debug("Event type not found in dictionary, skipping it.")
+        debug("Event type not found in dictionary, skipping it.")
         return
 
     if event_type == 'message':
-        channel_id = event.get('channel')
-        if channel_id is None:
-            logging.debug("Message event does not have a channel ID, skipping it.")
-            return
-        event_text = event.get('text')
-        if event_text is None:
-            logging.debug("Event text not found in dictionary, skipping it.")
-            return
-        sender_id = event.get('user')
-        if sender_id is None:
-            logging.debug("User ID not found in dictionary, skipping it.")
-            return
-        if sender_id == my_identity:
-            logging.debug("Sender of message was us; skipping it.")
-            return
-        user = get_user(sender_id)
-        if user is None:
-            logging.warning("User not found for sender ID {}.".format(sender_id))
-            return
+        process_message(event)
+    elif event_type in ('im_created', 'im_open', 'im_close'):
+        handle_im_event(event)
+    elif event_type in ('team_join', 'user_change'):
+        handle_member_event(event)
 
-        user_name = user['name']
 
-        # tokenize the text
-        tokens = event_text.split()
-        logging.debug("tokens: {}, {}".format(type(tokens), tokens))
-        if len(tokens) == 0:
-            logging.debug("No tokens in text; skipping.")
-            return
+def process_message(event):
+    channel_id = event.get('channel')
+    if channel_id is None:
+        debug("Message event does not have a channel ID, skipping it.")
+        return
+    event_text = event.get('text')
+    if event_text is None:
+        debug("Event text not found in dictionary, skipping it.")
+        return
+    sender_id = event.get('user')
+    if sender_id is None:
+        debug("User ID not found in dictionary, skipping it.")
+        return
+    if sender_id == my_identity:
+        debug("Sender of message was us; skipping it.")
+        return
 
-        # is the message direct, or a mention in a channel?
-        message_is_im = False
-        if is_mention(tokens):
-            logging.debug("Message is a mention of us ({}).".format(my_identity))
-        elif is_im(event):
-            message_is_im = True
-            logging.debug("Message is an IM to us ({}).".format(my_identity))
-        else:
-            logging.debug("Message was neither a mention or an IM, skipping.")
-            return
+    # is the message direct, or a mention in a channel? most traffic is
+    # neither, so decide that before any other work
+    message_is_im = False
+    if is_mention(event_text):
+        debug("Message is a mention of us ({}).", my_identity)
+    elif is_im(event):
+        message_is_im = True
+        debug("Message is an IM to us ({}).", my_identity)
+    else:
+        debug("Message was neither a mention or an IM, skipping.")
+        return
 
-        # remove mentions from message text
-        words = filter(lambda x: not x.startswith('<@'), tokens)
-        logging.debug("words: {}, {}".format(type(words), words))
-        count = len(words)
-        if count == 0:
-            logging.info("Nothing found in command sequence, skipping it.")
-            return
+    user = get_user(sender_id)
+    if user is None:
+        logging.warning("User not found for sender ID {}.".format(sender_id))
+        return
+    user_name = user['name']
 
-        logging.debug("Do command check.")
-        command = words[0].lower()
-        logging.debug("COMMAND: {}".format(command))
-        if command not in permissions:
-            logging.warning("Command found in text '{}' is not in the permissions list.".format(command))
-            if message_is_im:
-                response = "Unknown command '{}'".format(command)
-            else:
-                response = "<@{}>: Unknown command '{}'".format(sender_id, command)
-            sc.rtm_send_message(channel=channel_id, message=response)
-            return
+    # remove mentions from message text
+    words = [w for w in event_text.split() if not w.startswith('<@')]
+    debug("words: {}", words)
+    if len(words) == 0:
+        logging.info("Nothing found in command sequence, skipping it.")
+        return
 
-        logging.debug("Perform permissions check.")
-        perm_list = permissions[command]
-        has_permission = False
-        if perm_list is None:
-            logging.info("Permissions check succeeded because no permissions required for command {}".format(command))
-            has_permission = True
-        elif type(perm_list) is list:
-            logging.debug("Permission list for command has users: {}".format(perm_list))
-            for username in perm_list:
-                logging.debug("username: {}".format(username))
-                user_id = name_to_user_id_map.get(username)
-                logging.debug("user_id: {}".format(user_id))
-                if user_id is None:
-                    logging.warning("Username not found in permission list for command '{}': {}".format(command, username))
-                    return
-                if sender_id == user_id:
-                    has_permission = True
-                    break
+    command = words[0].lower()
+    debug("COMMAND: {}", command)
+    if command not in permission_index:
+        logging.warning("Command found in text '{}' is not in the permissions list.".format(command))
+        if message_is_im:
+            response = "Unknown command '{}'".format(command)
         else:
-            logging.warning("Value for permission key '{}' was not a list, abort.".format(command))
-            response = "<@{}>: Sorry, I didn't understand the command: {}".format(sender_id, words.join(" "))
-            sc.rtm_send_message(channel=channel_id, message=response)
-            return
-        if not has_permission:
-            logging.warning("User {} does not have permission to execute command {}.".format(user_name, command))
-            response = "<@{}>: You can't execute that command.".format(sender_id)
-            sc.rtm_send_message(channel=channel_id, message=response)
-            return
+            response = "<@{}>: Unknown command '{}'".format(sender_id, command)
+        rtm_send(channel_id, response)
+        return
 
-        logging.debug("Handle command: {}, {}".format(command, words))
-        try:
-            if command == 'list':
-                logging.debug("COMMAND: list; {}".format(words))
-                attachments = handle_list_command()
-                send_message(channel_id, sender_id, "Here's the server list:", attachments, message_is_im=message_is_im)
-            elif command == 'status':
-                logging.debug("COMMAND: status; {}".format(words))
-                param1 = None
-                message = "Current server status:"
-                if len(words) > 1:
-                    server_id = words[1]
-                    message = "Server status for {}:".format(server_id)
-                attachments = handle_status_command(server_id)
-                if len(attachments) == 0:
-                    if len(servers) > 0:
-                        response = "Could not get server status, even though I manage {} server(s).".format(len(servers))
-                        send_message(channel_id, sender_id, response, None, message_is_im=message_is_im)
-                        return
-                if len(attachments) != len(servers):
-                    response = "Could not get status for all servers. Here are the ones I did get:"
-                send_message(channel_id, sender_id, message, attachments, message_is_im=message_is_im)
-            elif command == 'start':
-                logging.debug("COMMAND: start; {}".format(words))
-                if len(words) > 1:
-                    server_id = words[1]
-                    attachments = handle_start_command(server_id=server_id)
-                    message = "Server '{}' started:".format(server_id)
-                    send_message(channel_id, sender_id, message, attachments, message_is_im=message_is_im)
-                else:
-                    response = "<@{}>: Usage: `start <server-id>`".format(sender_id)
-                    sc.rtm_send_message(channel=channel_id, message=response)
-            elif command == 'stop':
-                logging.debug("COMMAND: stop; {}".format(words))
-                if len(words) > 1:
-                    attachments = handle_stop_command(server_id=words[1])
-                else:
-                    response = "<@{}>: Usage: `stop <server-id>`".format(sender_id)
-                    sc.rtm_send_message(channel=channel_id, message=response)
-            elif command == 'help':
-                logging.debug("COMMAND: help; {}".format(words))
-                attachments = handle_help()
-                response = "Here are the commands I understand:"
-                send_message(channel_id, sender_id, response, attachments, message_is_im=message_is_im)
-            else:
-                logging.debug("COMMAND UNKNOWN")
-                response = "Unknown command '{}'. Here are the commands I understand:".format(command)
-                attachments = handle_help()
-                send_message(channel_id, sender_id, response, attachments, message_is_im=message_is_im)
-        except ServerIdNotFoundException as sinf:
-            response = "Server '{}' not found.".format(sinf.server_id)
-            send_message(channel_id, sender_id, response, None, message_is_im=message_is_im)
-            return
-        except MissingArgumentException as ma:
-            response = "Missing value for argument '{}'.".format(sinf.arg_name)
-            send_message(channel_id, sender_id, response, None, message_is_im=message_is_im)
-            return
-        except:
-            logging.exception("Unknown exception raised.")
+    if not permission_index.is_allowed(command, sender_id):
+        logging.warning("User {} does not have permission to execute command {}.".format(user_name, command))
+        response = "<@{}>: You can't execute that command.".format(sender_id)
+        rtm_send(channel_id, response)
+        return
+
+    request = commands.Request(channel_id, sender_id, user_name, message_is_im, words, send_message)
+    handler = registry.get(command)
+    try:
+        if handler is None:
+            debug("COMMAND UNKNOWN")
+            response = "Unknown command '{}'. Here are the commands I understand:".format(command)
+            request.reply(response, handle_help())
             return
+        handler(request, words[1:])
+    except commands.UsageException as ue:
+        response = "<@{}>: Usage: `{}`".format(sender_id, ue.command.usage())
+        rtm_send(channel_id, response)
+    except ServerIdNotFoundException as sinf:
+        response = "Server '{}' not found.".format(sinf.server_id)
+        request.reply(response)
+    except rcon.RconException as rce:
+        response = "RCON failed: {}".format(rce.message)
+        request.reply(response)
+    except regions.RegionException as rge:
+        response = "Couldn't read the world: {}".format(rge.message)
+        request.reply(response)
+    except InsufficientMemoryException as ime:
+        response = "Not enough memory to start '{}' right now; it's number {} in the queue and will start when room frees up.".format(ime.server_id, ime.position)
+        request.reply(response)
+    except MissingArgumentException as ma:
+        response = "Missing value for argument '{}'.".format(ma.arg_name)
+        request.reply(response)
+    except Exception:
+        logging.exception("Unknown exception raised.")
+
+
+async def measure_loop_lag(loop):
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+
+
+def server_states():
+    # scraped from the metrics thread, so it only reports what the scheduler
+    # and the list and status commands last saw rather than probing
+    return dict(((s['id'], server_statuses[s['id']]), 1) for s in snapshot.servers if s['id'] in server_statuses)
+
+
+def user_cache_stats(key):
+    def collect():
+        if user_cache is None:
+            return None
+        return user_cache.stats()[key]
+    return collect
+
+
+def init_metrics():
+    cfg = snapshot.config
+    if not cfg.get('metrics_port'):
+        return None
+    metrics.Gauge('foreman_server_status', "Servers by status, as reported by status.", ['server', 'status'],
+                  callback=server_states)
+    metrics.Gauge('foreman_user_cache_hits_total', "User cache hits.", callback=user_cache_stats('hits'), kind='counter')
+    metrics.Gauge('foreman_user_cache_misses_total', "User cache misses.", callback=user_cache_stats('misses'), kind='counter')
+    metrics.Gauge('foreman_user_cache_evictions_total', "User cache evictions.", callback=user_cache_stats('evictions'), kind='counter')
+    metrics.Gauge('foreman_user_cache_size', "Users in the cache.", callback=user_cache_stats('size'))
+    metrics.Gauge('foreman_jobs_active', "Server jobs queued or running.",
+                  callback=lambda: len(job_engine.active()) if job_engine is not None else None)
+    return metrics.start_server(cfg['metrics_port'], cfg.get('metrics_address', ''))
+
+
+def rtm_socket():
+    websocket = sc.server.websocket
+    if websocket is None:
+        return None
+    return websocket.sock
+
+
+def rtm_read():
+    with rtm_lock:
+        return sc.rtm_read()
+
+
+async def handle_event(loop, event):
+    try:
+        await loop.run_in_executor(executor, process_event, event)
+    except Exception:
+        logging.exception("Unhandled exception processing event.")
+
+
+async def run():
+    global event_loop
+    loop = asyncio.get_running_loop()
+    event_loop = loop
+    readable = asyncio.Event()
+    tasks = set()
+    sock = None
+    watcher = loop.create_task(watch_config(loop))
+    scheduling = loop.create_task(schedule(loop))
+    if metrics.enabled:
+        lag = loop.create_task(measure_loop_lag(loop))
+
+    while True:
+        # the websocket is replaced when the client reconnects
+        current = rtm_socket()
+        if current is not sock:
+            if sock is not None:
+                loop.remove_reader(sock)
+            sock = current
+            if sock is not None:
+                loop.add_reader(sock, readable.set)
 
+        try:
+            await asyncio.wait_for(readable.wait(), RTM_READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        readable.clear()
 
-def main():
-    if sc.rtm_connect():
+        # drain everything that is buffered before waiting again
         while True:
-            events = sc.rtm_read()
+            events = rtm_read()
             if len(events) == 0:
-                time.sleep(1)
-                continue
+                break
 
-            logging.debug("events: {}, {}".format(type(events), events))
+            debug("events: {}", events)
 
             for event in events:
-                process_event(event)
+                task = loop.create_task(handle_event(loop, event))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
 
-            time.sleep(1)
+
+def main():
+    if sc.rtm_connect(auto_reconnect=True):
+        asyncio.run(run())
     else:
         logging.error("Connection failed.")
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    elif args.quiet:
+        logging.getLogger().setLevel(logging.WARNING)
+
     logging.info("Starting Foreman Slack bot.")
-    config = load_config(args.config)
-    permissions = load_permissions(args.permissions)
-    servers = load_servers(args.servers)
+    snapshot, _ = load_snapshot()
+    init_metrics()
 
-    if 'token' in config:
-        slack_token = config['token']
+    if 'token' in snapshot.config:
+        slack_token = snapshot.config['token']
     env_slack_token = os.environ.get("SLACK_API_TOKEN")
     if env_slack_token:
         logging.info("Overriding Slack token from configuration with environment SLACK_API_TOKEN.")
         slack_token = env_slack_token
     sc = init_slack_client(slack_token)
-    dc = init_docker_client()
-
-    members, name_to_user_id_map, user_id_to_name_map = load_members()
+    slack_api = init_slack_api(slack_token)
+    docker_fleet = init_docker_fleet()
+    job_engine = jobs.JobEngine(workers=snapshot.config.get('job_workers', DEFAULT_JOB_WORKERS))
+    prober = slp.Prober(ttl=snapshot.config.get('probe_ttl', PROBE_TTL), timeout=snapshot.config.get('probe_timeout', PROBE_TIMEOUT))
+    stats_collector = telemetry.StatsCollector(window=snapshot.config.get('stats_window', STATS_WINDOW))
+    image_prewarmer = prewarm.ImagePrewarmer(docker_fleet, workers=snapshot.config.get('prewarm_workers', prewarm.DEFAULT_WORKERS),
+                                             refresh=snapshot.config.get('prewarm_refresh', prewarm.DEFAULT_REFRESH))
+    prewarm_servers()
+    log_tailer = logtail.LogTailer(capacity=snapshot.config.get('log_buffer_lines', LOG_BUFFER_LINES))
+    rcon_pool = rcon.RconPool(rate=snapshot.config.get('rcon_rate', rcon.DEFAULT_RATE),
+                              burst=snapshot.config.get('rcon_burst', rcon.DEFAULT_BURST))
+    backup_engine = backup.BackupEngine(backup.ChunkStore(snapshot.config.get('backup_dir', DEFAULT_BACKUP_DIR)))
+    region_analyzer = regions.RegionAnalyzer(workers=snapshot.config.get('world_scan_workers', WORLD_SCAN_WORKERS))
+    executor = init_executor(snapshot.config.get('workers', DEFAULT_WORKERS))
+
+    permission_index.load_permissions(snapshot.permissions)
+    user_cache = init_user_cache()
+    init_members()
     my_identity = load_identity()
+    mention_matcher = init_mention_matcher(my_identity)
     logging.info("My identity: {}".format(my_identity))
+    refresh_im_channels()
 
     main()
@@ -0,0 +1,136 @@
+import collections
+import concurrent.futures
+import itertools
+import logging
+import threading
+import time
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# finished jobs remembered for the jobs command
+DEFAULT_HISTORY = 20
+
+
+class Job(object):
+    """A start, stop, backup or restore of one server, with a log of its progress."""
+
+    def __init__(self, job_id, kind, server_id, requested_by=None, notify=None):
+        self.id = job_id
+        self.kind = kind
+        self.server_id = server_id
+        self.requested_by = requested_by
+        self.notify = notify
+        self.state = QUEUED
+        self.lines = []
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # where the progress message was posted, set by the notifier
+        self.message = None
+
+    @property
+    def active(self):
+        return self.state in (QUEUED, RUNNING)
+
+    def title(self):
+        return "Job {}: {} {}".format(self.id, self.kind, self.server_id)
+
+    def text(self):
+        lines = [self.title()]
+        lines.extend("• {}".format(line) for line in self.lines)
+        return "\n".join(lines)
+
+    def elapsed(self):
+        start = self.started_at or self.created_at
+        end = self.finished_at or time.time()
+        return end - start
+
+    def progress(self, line, replace=False):
+        """Add a line to the job's log, or replace the last one."""
+        logging.info("{}: {}".format(self.title(), line))
+        if replace and self.lines:
+            self.lines[-1] = line
+        else:
+            self.lines.append(line)
+        self.changed()
+
+    def changed(self):
+        if self.notify is None:
+            return
+        try:
+            self.notify(self)
+        except Exception:
+            logging.exception("Could not report progress for {}.".format(self.title()))
+
+
+class JobEngine(object):
+    """Runs server jobs on a worker pool.
+
+    submit() returns as soon as the job is queued. Only one job per server is
+    in flight at a time; submitting another for the same server returns the
+    job already running.
+    """
+
+    def __init__(self, workers=2, history=DEFAULT_HISTORY):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='jobs')
+        self.history = history
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = collections.OrderedDict()
+        self.active_by_server = {}
+
+    def submit(self, kind, server_id, run, requested_by=None, notify=None):
+        """Queue run(job) for a server. Returns (job, created)."""
+        with self.lock:
+            existing = self.active_by_server.get(server_id)
+            if existing is not None:
+                logging.info("{} is already in progress.".format(existing.title()))
+                return existing, False
+            job = Job(next(self.ids), kind, server_id, requested_by, notify)
+            self.jobs[job.id] = job
+            self.active_by_server[server_id] = job
+            self.trim()
+
+        job.progress("Queued")
+        self.executor.submit(self.run, job, run)
+        return job, True
+
+    def trim(self):
+        finished = [j for j in self.jobs.values() if not j.active]
+        for job in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job.id]
+
+    def run(self, job, run):
+        job.state = RUNNING
+        job.started_at = time.time()
+        try:
+            run(job)
+            job.state = DONE
+            job.finished_at = time.time()
+            job.progress("Done in {:.0f}s".format(job.elapsed()))
+        except Exception as e:
+            logging.exception("{} failed.".format(job.title()))
+            job.state = FAILED
+            job.error = e
+            job.finished_at = time.time()
+            job.progress("Failed: {}".format(e))
+        finally:
+            with self.lock:
+                if self.active_by_server.get(job.server_id) is job:
+                    del self.active_by_server[job.server_id]
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def active(self):
+        with self.lock:
+            return [j for j in self.jobs.values() if j.active]
+
+    def recent(self):
+        with self.lock:
+            return list(self.jobs.values())
@@ -0,0 +1,283 @@
+import collections
+import datetime
+import logging
+import re
+import threading
+import time
+
+import metrics
+
+
+# lines kept per server
+DEFAULT_CAPACITY = 10000
+
+# seconds to wait before following a log again after the stream drops
+RECONNECT_DELAY = 5
+
+LEVEL_PATTERN = re.compile(r"[\[/ ](TRACE|DEBUG|INFO|WARN|WARNING|ERROR|SEVERE|FATAL)\]")
+EXCEPTION_PATTERN = re.compile(r"\b((?:[a-zA-Z_$][\w$]*\.)+[A-Z][\w$]*(?:Exception|Error|Throwable))\b")
+PLAYER_PATTERNS = [
+    re.compile(r"\]: <(\w{2,16})> "),
+    re.compile(r"\b(\w{2,16}) (?:joined|left) the game"),
+    re.compile(r"\b(\w{2,16})\[/[\d.:]+\] logged in"),
+    re.compile(r"\bUUID of player (\w{2,16}) is"),
+    re.compile(r"\b(\w{2,16}) lost connection"),
+]
+# stack trace lines belong to the entry above them
+CONTINUATION_PATTERN = re.compile(r"^(?:\s+at |\s*Caused by: |\s+\.\.\. \d+ more)")
+
+LEVEL_ALIASES = {
+    'WARNING': 'WARN',
+    'SEVERE': 'ERROR',
+}
+
+# logged once the server has loaded its world and accepts players
+READY_PATTERN = re.compile(r"\]: Done \([\d.,]+s\)!")
+
+# index keys a query may name, e.g. level:error
+INDEX_FIELDS = ('level', 'player', 'exception')
+
+LINES = metrics.Counter('foreman_log_lines_total', "Server log lines read.", ['server'])
+
+
+class LogLine(object):
+    def __init__(self, seq, text, level=None):
+        self.seq = seq
+        self.text = text
+        self.level = level
+        self.keys = []
+
+
+def index_keys(text, level):
+    keys = []
+    if level:
+        keys.append(('level', level))
+    for pattern in PLAYER_PATTERNS:
+        for name in pattern.findall(text):
+            keys.append(('player', name.lower()))
+    for name in EXCEPTION_PATTERN.findall(text):
+        # found by full or simple class name
+        keys.append(('exception', name.lower()))
+        keys.append(('exception', name.rsplit('.', 1)[-1].lower()))
+    return keys
+
+
+def parse_query(pattern):
+    """(field, value) for an indexed query like 'player:steve', else (None, pattern)."""
+    if pattern and ':' in pattern:
+        field, value = pattern.split(':', 1)
+        field = field.lower()
+        if field in INDEX_FIELDS and value:
+            value = value.lower()
+            if field == 'level':
+                value = LEVEL_ALIASES.get(value.upper(), value.upper())
+            return field, value
+    return None, pattern
+
+
+class LogBuffer(object):
+    """The last `capacity` lines of a log, indexed by level, player and exception.
+
+    Lines are numbered as they arrive; the index maps each key to the
+    numbers of the lines that carry it, oldest first, so the line pushed out
+    of the buffer is always at the front of its keys' entries.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.lines = collections.deque(maxlen=capacity)
+        self.index = collections.defaultdict(collections.deque)
+        self.next_seq = 0
+        self.last_level = None
+        self.lock = threading.Lock()
+
+    def append(self, text):
+        level = None
+        m = LEVEL_PATTERN.search(text)
+        if m is not None:
+            level = LEVEL_ALIASES.get(m.group(1), m.group(1))
+        elif CONTINUATION_PATTERN.match(text):
+            level = self.last_level
+        line = LogLine(self.next_seq, text, level)
+        line.keys = index_keys(text, level)
+        with self.lock:
+            if len(self.lines) == self.capacity:
+                self.evict(self.lines[0])
+            self.lines.append(line)
+            self.next_seq += 1
+            if m is not None:
+                # an exception's message line has no level of its own; the
+                # stack trace below it still belongs to the entry above
+                self.last_level = level
+            for key in line.keys:
+                self.index[key].append(line.seq)
+
+    def evict(self, line):
+        for key in line.keys:
+            entries = self.index.get(key)
+            if entries and entries[0] == line.seq:
+                entries.popleft()
+            if not entries:
+                self.index.pop(key, None)
+
+    def line(self, seq):
+        # called with the lock held
+        return self.lines[seq - (self.next_seq - len(self.lines))]
+
+    def search(self, pattern=None, n=20):
+        """The last n lines matching pattern, oldest first.
+
+        pattern is 'level:<level>', 'player:<name>' or 'exception:<class>',
+        answered from the index, or text to look for in each line, ignoring
+        case.
+        """
+        field, value = parse_query(pattern)
+        with self.lock:
+            if field is not None:
+                entries = self.index.get((field, value))
+                if entries is None:
+                    return []
+                return [self.line(seq).text for seq in list(entries)[-n:]]
+
+            if not value:
+                return [line.text for line in list(self.lines)[-n:]]
+            value = value.lower()
+            result = []
+            for line in reversed(self.lines):
+                if value in line.text.lower():
+                    result.append(line.text)
+                    if len(result) >= n:
+                        break
+            result.reverse()
+            return result
+
+    def find(self, pattern, after=0):
+        """The first line numbered `after` or later that matches a regex."""
+        with self.lock:
+            for line in self.lines:
+                if line.seq >= after and pattern.search(line.text):
+                    return line.text
+        return None
+
+    def __len__(self):
+        return len(self.lines)
+
+
+def split_timestamp(line):
+    # docker prefixes each line with an RFC 3339 timestamp when asked to
+    stamp, sep, text = line.partition(' ')
+    if not sep or not stamp[:4].isdigit():
+        return None, line
+    try:
+        at = datetime.datetime.fromisoformat(stamp[:26].rstrip('Z') + '+00:00').timestamp()
+    except ValueError:
+        return None, line
+    return at, text
+
+
+class LogFollower(object):
+    def __init__(self, key, client, container_id, buffer):
+        self.key = key
+        self.client = client
+        self.container_id = container_id
+        self.buffer = buffer
+        self.stopping = False
+        self.since = None
+        self.thread = None
+        # set once the first lines are in the buffer
+        self.started = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="logs-{}".format(self.key))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def follow(self):
+        kwargs = {'stream': True, 'follow': True, 'timestamps': True}
+        if self.since is None:
+            # fill the buffer from what the daemon already has, once
+            kwargs['tail'] = self.buffer.capacity
+        else:
+            kwargs['since'] = self.since
+        stream = self.client.api.logs(self.container_id, **kwargs)
+        partial = b''
+        try:
+            for chunk in stream:
+                if self.stopping:
+                    break
+                # chunks aren't aligned to lines
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                for raw in lines:
+                    at, text = split_timestamp(raw.decode('utf-8', 'replace').rstrip('\r'))
+                    if at is not None:
+                        self.since = at
+                    self.buffer.append(text)
+                LINES.inc(len(lines), server=self.key)
+                self.started.set()
+        finally:
+            stream.close()
+
+    def run(self):
+        logging.info("Following the log of {} ({}).".format(self.key, self.container_id[:12]))
+        while not self.stopping:
+            try:
+                self.follow()
+                # the stream ends when the container stops
+                break
+            except Exception as e:
+                if self.stopping:
+                    break
+                logging.warning("Log stream for {} failed: {}".format(self.key, e))
+            time.sleep(RECONNECT_DELAY)
+        self.started.set()
+        logging.info("Stopped following the log of {}.".format(self.key))
+
+
+class LogTailer(object):
+    """Follows each running server's log into an in-memory LogBuffer.
+
+    Queries are answered from the buffers without touching the daemon.
+    sync() is given the running servers and starts or stops followers to
+    match; a server's buffer outlives its follower so the last lines before
+    a crash can still be read, and is replaced when a new container starts.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.followers = {}
+        self.buffers = {}
+
+    def follow(self, key, client, container_id):
+        with self.lock:
+            follower = self.followers.get(key)
+            if follower is not None and follower.container_id == container_id and follower.alive():
+                return follower
+            if follower is not None:
+                follower.stopping = True
+            since = None
+            if follower is None or follower.container_id != container_id:
+                self.buffers[key] = LogBuffer(self.capacity)
+            else:
+                # pick up where the last follower left off
+                since = follower.since
+            follower = LogFollower(key, client, container_id, self.buffers[key])
+            follower.since = since
+            self.followers[key] = follower.start()
+            return follower
+
+    def sync(self, running):
+        """Follow each of {key: (client, container ID)}; stop following the rest."""
+        with self.lock:
+            for key in [k for k in self.followers if k not in running]:
+                self.followers.pop(key).stopping = True
+        for key, (client, container_id) in running.items():
+            self.follow(key, client, container_id)
+
+    def buffer(self, key):
+        return self.buffers.get(key)
@@ -0,0 +1,236 @@
+import functools
+import http.server
+import logging
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+# metrics are registered at import but record nothing until enable(), so
+# instrumented code costs one flag check per call while they're off
+enabled = False
+registry = []
+registry_lock = threading.Lock()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def label_key(names, labels):
+    return tuple(str(labels.get(n, '')) for n in names)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        with registry_lock:
+            registry.append(self)
+
+    def header(self):
+        return ["# HELP {} {}".format(self.name, self.description),
+                "# TYPE {} {}".format(self.name, self.kind)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        super(Counter, self).__init__(name, description, labels)
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        if not enabled:
+            return
+        key = label_key(self.labels, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + ["{}{} {}".format(self.name, format_labels(self.labels, k), format_value(v))
+                                for k, v in values]
+
+
+class Gauge(Metric):
+    """A gauge set directly, or read from callback() at scrape time.
+
+    The callback returns a number, or a dict of label value tuples to numbers.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), callback=None, kind=None):
+        super(Gauge, self).__init__(name, description, labels)
+        self.values = {}
+        self.callback = callback
+        if kind is not None:
+            self.kind = kind
+
+    def set(self, value, **labels):
+        if not enabled:
+            return
+        with self.lock:
+            self.values[label_key(self.labels, labels)] = value
+
+    def collect(self):
+        if self.callback is None:
+            with self.lock:
+                return sorted(self.values.items())
+        try:
+            values = self.callback()
+        except Exception:
+            logging.exception("Collecting metric {} failed.".format(self.name))
+            return []
+        if values is None:
+            return []
+        if type(values) is not dict:
+            return [((), values)]
+        return sorted(values.items())
+
+    def render(self):
+        return self.header() + ["{}{} {}".format(self.name, format_labels(self.labels, k), format_value(v))
+                                for k, v in self.collect()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = label_key(self.labels, labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self.lock:
+            values = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.values.items())
+        lines = self.header()
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(self.labels, key, ('le', format_value(bound))), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(self.labels, key), format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, format_labels(self.labels, key), count))
+        return lines
+
+
+class Timer(object):
+    """Context manager observing the duration of its block in histogram."""
+
+    def __init__(self, histogram, errors=None, **labels):
+        self.histogram = histogram
+        self.errors = errors
+        self.labels = labels
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not enabled:
+            return False
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc(**self.labels)
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def timed(histogram, errors=None, **labels):
+    """Decorator observing each call's duration in histogram.
+
+    Exceptions are counted in the errors counter, if given, and re-raised.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def render():
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    for m in metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics: " + format % args)
+
+
+def start_server(port, address=''):
+    enable()
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logging.info("Serving metrics on {}:{}/metrics.".format(address or '*', port))
+    return server
@@ -0,0 +1,149 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+import docker
+
+
+# images pulled at the same time, across all hosts
+DEFAULT_WORKERS = 2
+
+# seconds before a pulled image is checked for updates again
+DEFAULT_REFRESH = 6 * 60 * 60
+
+# seconds before an image that couldn't be pulled is tried again
+RETRY_INTERVAL = 15 * 60
+
+# image cache states
+PENDING = 'pending'
+PULLING = 'pulling'
+CACHED = 'cached'
+MISSING = 'missing'
+MISMATCH = 'mismatch'
+ERROR = 'error'
+
+
+class PrewarmException(Exception):
+    def __init__(self, message):
+        super(PrewarmException, self).__init__(message)
+        self.message = message
+
+
+class ImageState(object):
+    def __init__(self, endpoint, ref, digest=None):
+        self.endpoint = endpoint
+        self.ref = ref
+        # the pinned digest, if the server names one
+        self.expected = digest
+        self.state = PENDING
+        self.digest = None
+        self.size = None
+        self.error = None
+        self.checked_at = None
+
+    def describe(self):
+        if self.state == CACHED:
+            return "Cached ({})".format(self.digest[7:19] if self.digest else "local build")
+        if self.state in (MISMATCH, ERROR):
+            return "{} ({})".format(self.state.capitalize(), self.error)
+        return self.state.capitalize()
+
+
+def repo_digest(image, repository):
+    # digests are per repository; locally built images have none
+    for entry in image.attrs.get('RepoDigests') or []:
+        name, sep, digest = entry.partition('@')
+        if name == repository or name.endswith('/' + repository):
+            return digest
+    return None
+
+
+class ImagePrewarmer(object):
+    """Pulls every managed image onto its Docker host ahead of any start.
+
+    Pulls run in the background on a small pool so they never compete with
+    server traffic for more than a few connections. An image is verified by
+    digest once it's present, against the digest its server pins if it
+    names one. Images are checked again after `refresh` seconds, and only
+    pulled if their server asks for pulls or they're missing, since locally
+    built images can't be pulled.
+    """
+
+    def __init__(self, fleet, workers=DEFAULT_WORKERS, refresh=DEFAULT_REFRESH):
+        self.fleet = fleet
+        self.refresh = refresh
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prewarm')
+        self.lock = threading.Lock()
+        self.states = {}
+        self.inflight = set()
+
+    def state(self, endpoint, ref):
+        return self.states.get((endpoint, ref))
+
+    def is_fresh(self, endpoint, ref):
+        state = self.states.get((endpoint, ref))
+        return (state is not None and state.state == CACHED and
+                state.checked_at is not None and time.time() - state.checked_at < self.refresh)
+
+    def warm(self, images):
+        """Queue a check of each (endpoint, repository, tag, pull, digest) not checked lately."""
+        submitted = 0
+        with self.lock:
+            for endpoint, repository, tag, pull, digest in images:
+                ref = "{}:{}".format(repository, tag)
+                key = (endpoint, ref)
+                state = self.states.get(key)
+                if key in self.inflight or self.is_fresh(endpoint, ref):
+                    continue
+                if state is not None and state.checked_at is not None and time.time() - state.checked_at < RETRY_INTERVAL:
+                    continue
+                if state is None or state.expected != digest:
+                    state = self.states[key] = ImageState(endpoint, ref, digest)
+                self.inflight.add(key)
+                self.executor.submit(self.check, state, repository, tag, pull)
+                submitted += 1
+        return submitted
+
+    def check(self, state, repository, tag, pull):
+        try:
+            client = self.fleet.client(state.endpoint)
+            image = None
+            if not pull:
+                try:
+                    image = client.images.get(state.ref)
+                except docker.errors.ImageNotFound:
+                    pass
+            if image is None:
+                logging.info("Prewarming {} on {}.".format(state.ref, state.endpoint))
+                state.state = PULLING
+                for line in client.api.pull(repository, tag=tag, stream=True, decode=True):
+                    if 'error' in line:
+                        raise PrewarmException(line['error'])
+                image = client.images.get(state.ref)
+
+            digest = repo_digest(image, repository)
+            if state.digest is not None and digest != state.digest:
+                logging.info("{} on {} changed to {}.".format(state.ref, state.endpoint, digest))
+            state.digest = digest
+            state.size = image.attrs.get('Size')
+            if state.expected and digest != state.expected:
+                state.state = MISMATCH
+                state.error = "expected {}".format(state.expected[7:19])
+                logging.warning("{} on {} is {}, not the pinned {}.".format(state.ref, state.endpoint, digest, state.expected))
+            else:
+                state.state = CACHED
+                state.error = None
+        except (docker.errors.ImageNotFound, docker.errors.NotFound) as e:
+            state.state = MISSING
+            state.error = str(e)
+            logging.warning("Could not prewarm {} on {}: {}".format(state.ref, state.endpoint, e))
+        except Exception as e:
+            state.state = ERROR
+            state.error = str(e)
+            logging.warning("Could not prewarm {} on {}: {}".format(state.ref, state.endpoint, e))
+        finally:
+            state.checked_at = time.time()
+            with self.lock:
+                self.inflight.discard((state.endpoint, state.ref))
+
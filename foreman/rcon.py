@@ -0,0 +1,252 @@
+import asyncio
+import itertools
+import logging
+import struct
+import time
+
+import metrics
+from slackapi import TokenBucket
+
+
+DEFAULT_PORT = 25575
+
+# seconds to connect or wait for a response
+DEFAULT_TIMEOUT = 10
+
+# commands a second each server accepts, and how many may burst
+DEFAULT_RATE = 5
+DEFAULT_BURST = 10
+
+# seconds a connection may sit idle before it's checked with KEEPALIVE_COMMAND
+KEEPALIVE_INTERVAL = 60
+KEEPALIVE_COMMAND = "list"
+
+# packet types
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+# servers answer a packet of an unknown type with an error after finishing
+# everything sent before it, which marks the end of a split response
+END_MARKER_TYPE = 200
+
+# the largest payload a server sends in one packet
+MAX_PAYLOAD = 4096
+
+COMMAND_DURATION = metrics.Histogram('foreman_rcon_command_duration_seconds', "RCON command duration.", ['server'])
+COMMAND_ERRORS = metrics.Counter('foreman_rcon_command_errors_total', "RCON commands that failed.", ['server'])
+CONNECTS = metrics.Counter('foreman_rcon_connects_total', "RCON connections opened.", ['server'])
+
+
+class RconException(Exception):
+    def __init__(self, message):
+        super(RconException, self).__init__(message)
+        self.message = message
+
+
+class NotConnectedException(RconException):
+    def __init__(self, name):
+        super(NotConnectedException, self).__init__("not connected to {}".format(name))
+        self.name = name
+
+
+def pack_packet(request_id, packet_type, body):
+    payload = struct.pack('<ii', request_id, packet_type) + body.encode('utf-8') + b'\x00\x00'
+    return struct.pack('<i', len(payload)) + payload
+
+
+def unpack_packet(data):
+    request_id, packet_type = struct.unpack('<ii', data[:8])
+    return request_id, packet_type, data[8:-2].decode('utf-8', 'replace')
+
+
+async def read_packet(reader):
+    length = struct.unpack('<i', await reader.readexactly(4))[0]
+    if length < 10 or length > MAX_PAYLOAD + 10:
+        raise RconException("bad packet length {}".format(length))
+    return unpack_packet(await reader.readexactly(length))
+
+
+class RconConnection(object):
+    """One authenticated RCON connection, with requests pipelined over it.
+
+    Commands are written as soon as they're issued, each followed by an end
+    marker, and a single reader task matches responses to them by request
+    ID, so several commands can be in flight at once.
+    """
+
+    def __init__(self, name, host, port, password, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.ids = itertools.count(1)
+        self.reader = None
+        self.writer = None
+        self.loop = None
+        self.pending = {}
+        self.markers = {}
+        self.tasks = []
+        self.used_at = time.monotonic()
+
+    @property
+    def connected(self):
+        return (self.writer is not None and not self.writer.is_closing() and
+                self.loop is asyncio.get_running_loop())
+
+    async def connect(self):
+        logging.info("Connecting to RCON on {} ({}:{}).".format(self.name, self.host, self.port))
+        CONNECTS.inc(server=self.name)
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.loop = asyncio.get_running_loop()
+        try:
+            request_id = next(self.ids)
+            self.writer.write(pack_packet(request_id, SERVERDATA_AUTH, self.password))
+            await self.writer.drain()
+            # some servers send an empty response value before the auth response
+            while True:
+                response_id, packet_type, body = await asyncio.wait_for(read_packet(self.reader), self.timeout)
+                if packet_type == SERVERDATA_AUTH_RESPONSE:
+                    break
+            if response_id == -1:
+                raise RconException("authentication failed")
+        except BaseException:
+            self.writer.close()
+            self.writer = None
+            raise
+        self.used_at = time.monotonic()
+        self.tasks = [self.loop.create_task(self.read_responses()), self.loop.create_task(self.keepalive())]
+
+    def close(self, error=None):
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self.tasks = []
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except RuntimeError:
+                # its event loop has already closed
+                pass
+            self.writer = None
+        error = error or RconException("connection closed")
+        for future, parts in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending = {}
+        self.markers = {}
+
+    async def read_responses(self):
+        try:
+            while True:
+                response_id, packet_type, body = await read_packet(self.reader)
+                if response_id in self.pending:
+                    self.pending[response_id][1].append(body)
+                elif response_id in self.markers:
+                    request_id = self.markers.pop(response_id)
+                    future, parts = self.pending.pop(request_id)
+                    if not future.done():
+                        future.set_result("".join(parts))
+        except asyncio.CancelledError:
+            raise
+        except (OSError, EOFError, asyncio.IncompleteReadError, RconException) as e:
+            logging.warning("RCON connection to {} dropped: {}".format(self.name, e))
+            self.close(RconException("connection lost: {}".format(e)))
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            if time.monotonic() - self.used_at < KEEPALIVE_INTERVAL or self.pending:
+                continue
+            try:
+                await self.command(KEEPALIVE_COMMAND)
+            except (OSError, asyncio.TimeoutError, RconException) as e:
+                logging.warning("RCON keepalive to {} failed: {}".format(self.name, e))
+                self.close()
+                return
+
+    async def command(self, text, timeout=None):
+        if not self.connected:
+            raise NotConnectedException(self.name)
+        request_id = next(self.ids)
+        marker_id = next(self.ids)
+        future = self.loop.create_future()
+        self.pending[request_id] = (future, [])
+        self.markers[marker_id] = request_id
+        self.used_at = time.monotonic()
+        self.writer.write(pack_packet(request_id, SERVERDATA_EXECCOMMAND, text) + pack_packet(marker_id, END_MARKER_TYPE, ''))
+        await self.writer.drain()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(request_id, None)
+            self.markers.pop(marker_id, None)
+            raise
+
+
+class RconPool(object):
+    """A persistent RCON connection per server, opened on first use.
+
+    A connection that drops or fails its keepalive is replaced on the next
+    command. A command is never resent once written, since console commands
+    aren't idempotent; one that finds its connection already gone is retried
+    on a new one. Commands to each server are limited by a token bucket.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, timeout=DEFAULT_TIMEOUT):
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.connections = {}
+        self.connecting = {}
+        self.buckets = {}
+
+    async def connection(self, name, host, port, password):
+        connection = self.connections.get(name)
+        if connection is not None:
+            if connection.connected and (connection.host, connection.port, connection.password) == (host, port, password):
+                return connection
+            connection.close()
+            del self.connections[name]
+
+        # share a connect already under way
+        task = self.connecting.get(name)
+        if task is None:
+            connection = RconConnection(name, host, port, password, self.timeout)
+            task = self.connecting[name] = asyncio.ensure_future(connection.connect())
+            task.add_done_callback(lambda t: self.connecting.pop(name, None))
+            task.connection = connection
+        await task
+        self.connections[name] = task.connection
+        return task.connection
+
+    async def throttle(self, name):
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = TokenBucket(self.rate, self.burst)
+        while not bucket.take():
+            await asyncio.sleep(bucket.delay())
+
+    async def command(self, name, host, port, password, text, timeout=None):
+        """Run a console command on a server and return its output."""
+        await self.throttle(name)
+        with metrics.Timer(COMMAND_DURATION, COMMAND_ERRORS, server=name):
+            for attempt in (1, 2):
+                connection = await self.connection(name, host, port, password)
+                try:
+                    return await connection.command(text, timeout)
+                except NotConnectedException:
+                    if attempt == 2:
+                        raise
+                    logging.info("RCON connection to {} is gone; reconnecting.".format(name))
+                except (OSError, RconException):
+                    connection.close()
+                    raise
+
+    def close(self, name=None):
+        for key in [name] if name is not None else list(self.connections):
+            connection = self.connections.pop(key, None)
+            if connection is not None:
+                connection.close()
@@ -0,0 +1,236 @@
+import collections
+import concurrent.futures
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+import threading
+
+
+SECTOR_SIZE = 4096
+
+# 1024 chunk locations followed by 1024 timestamps
+HEADER_SIZE = 2 * SECTOR_SIZE
+
+REGION_NAME = re.compile(r"^r\.(-?\d+)\.(-?\d+)\.mca$")
+
+# directories below a dimension holding .mca files; only region/ has terrain
+KINDS = ('region', 'entities', 'poi')
+
+# changed files scanned in this process rather than sent to the pool
+INLINE_SCAN_LIMIT = 16
+
+# files handed to a pool worker at a time
+POOL_BATCH_SIZE = 64
+
+DEFAULT_WORKERS = 4
+
+# regions listed as heaviest and most recently modified
+DEFAULT_TOP = 5
+
+
+class RegionException(Exception):
+    def __init__(self, message):
+        super(RegionException, self).__init__(message)
+        self.message = message
+
+
+class RegionInfo(object):
+    """What an Anvil region file's header says about its chunks."""
+
+    def __init__(self, path, size, mtime, chunks=0, sectors=0, newest=0, x=None, z=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.chunks = chunks
+        self.sectors = sectors
+        self.newest = newest
+        self.x = x
+        self.z = z
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+
+def read_header(path):
+    """(chunks, sectors, newest timestamp, file size, mtime) from a region file's header."""
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size < HEADER_SIZE:
+            # created but never written
+            return 0, 0, 0, stat.st_size, stat.st_mtime_ns
+        # only the header is mapped, so only the header is read
+        with mmap.mmap(f.fileno(), HEADER_SIZE, access=mmap.ACCESS_READ) as header:
+            locations = struct.unpack_from('>1024I', header, 0)
+            timestamps = struct.unpack_from('>1024I', header, SECTOR_SIZE)
+    chunks = 0
+    sectors = 0
+    newest = 0
+    for location, timestamp in zip(locations, timestamps):
+        if location == 0:
+            continue
+        chunks += 1
+        sectors += location & 0xFF
+        if timestamp > newest:
+            newest = timestamp
+    return chunks, sectors, newest, stat.st_size, stat.st_mtime_ns
+
+
+def scan_files(paths):
+    # runs in pool workers; failures are returned rather than raised so one
+    # bad file doesn't lose the batch
+    results = []
+    for path in paths:
+        try:
+            results.append((path, read_header(path), None))
+        except (IOError, OSError, ValueError, struct.error) as e:
+            results.append((path, None, str(e)))
+    return results
+
+
+def dimension_of(root, directory):
+    """(dimension, kind) for a directory of .mca files under a world root."""
+    parts = os.path.relpath(directory, root).split(os.sep)
+    kind = parts[-1]
+    parts = parts[:-1]
+    if parts and parts[0] == 'dimensions' and len(parts) >= 3:
+        # 1.16+ datapack dimensions: dimensions/<namespace>/<name>
+        return ":".join(parts[1:3]), kind
+    if parts == ['DIM-1']:
+        return 'the_nether', kind
+    if parts == ['DIM1']:
+        return 'the_end', kind
+    if not parts:
+        return 'overworld', kind
+    return "/".join(parts), kind
+
+
+def find_region_files(root):
+    """(path, dimension, kind) for every .mca file under a world root."""
+    for directory, dirs, files in os.walk(root):
+        dirs.sort()
+        if os.path.basename(directory) not in KINDS:
+            continue
+        dimension, kind = dimension_of(root, directory)
+        for name in sorted(files):
+            if name.endswith('.mca'):
+                yield os.path.join(directory, name), dimension, kind
+
+
+class WorldSummary(object):
+    def __init__(self, root):
+        self.root = root
+        self.dimensions = collections.OrderedDict()
+        self.regions = []
+        self.errors = []
+        self.scanned = 0
+        self.cached = 0
+
+    def dimension(self, name):
+        totals = self.dimensions.get(name)
+        if totals is None:
+            totals = self.dimensions[name] = {'regions': 0, 'chunks': 0, 'bytes': 0, 'other_bytes': 0}
+        return totals
+
+    def heaviest(self, n=DEFAULT_TOP):
+        return sorted(self.regions, key=lambda r: r.size, reverse=True)[:n]
+
+    def newest(self, n=DEFAULT_TOP):
+        return sorted(self.regions, key=lambda r: r.newest, reverse=True)[:n]
+
+    @property
+    def chunks(self):
+        return sum(d['chunks'] for d in self.dimensions.values())
+
+    @property
+    def bytes(self):
+        return sum(d['bytes'] + d['other_bytes'] for d in self.dimensions.values())
+
+
+class RegionAnalyzer(object):
+    """Scans worlds' region file headers, remembering each file's result.
+
+    A file whose mtime and size haven't changed since it was last read is
+    answered from the cache, so rescanning an unchanged world only costs a
+    stat per file. Changed files are read in a process pool, a batch per
+    worker; a handful are read inline instead, since that's cheaper than
+    a round trip to the pool.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pool = None
+        self.results = {}
+
+    def executor(self):
+        with self.lock:
+            if self.pool is None:
+                # forking a threaded process can copy held locks into the
+                # children, so workers are spawned fresh
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def read(self, paths):
+        if len(paths) <= INLINE_SCAN_LIMIT:
+            return scan_files(paths)
+        batches = [paths[i:i + POOL_BATCH_SIZE] for i in range(0, len(paths), POOL_BATCH_SIZE)]
+        results = []
+        for batch in self.executor().map(scan_files, batches):
+            results.extend(batch)
+        return results
+
+    def scan(self, root):
+        if not os.path.isdir(root):
+            raise RegionException("world directory {} not found".format(root))
+
+        summary = WorldSummary(root)
+        files = []
+        stale = []
+        for path, dimension, kind in find_region_files(root):
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                summary.errors.append((path, str(e)))
+                continue
+            files.append((path, dimension, kind))
+            cached = self.results.get(path)
+            if cached is None or cached[3:] != (stat.st_size, stat.st_mtime_ns):
+                stale.append(path)
+
+        for path, header, error in self.read(stale):
+            if error is not None:
+                summary.errors.append((path, error))
+                self.results.pop(path, None)
+            else:
+                self.results[path] = header
+        summary.scanned = len(stale)
+        summary.cached = len(files) - len(stale)
+
+        for path, dimension, kind in files:
+            header = self.results.get(path)
+            if header is None:
+                continue
+            chunks, sectors, newest, size, mtime = header
+            totals = summary.dimension(dimension)
+            if kind != 'region':
+                totals['other_bytes'] += size
+                continue
+            totals['regions'] += 1
+            totals['chunks'] += chunks
+            totals['bytes'] += size
+            m = REGION_NAME.match(os.path.basename(path))
+            x, z = (int(m.group(1)), int(m.group(2))) if m else (None, None)
+            summary.regions.append(RegionInfo(path, size, mtime, chunks, sectors, newest, x, z))
+
+        logging.info("Scanned {}: {} region files read, {} cached.".format(root, summary.scanned, summary.cached))
+        return summary
+
+    def forget(self, root):
+        prefix = os.path.join(root, '')
+        for path in [p for p in self.results if p.startswith(prefix)]:
+            del self.results[path]
@@ -0,0 +1,53 @@
+import hashlib
+import json
+
+import metrics
+import slackapi
+
+
+RENDERS = metrics.Counter('foreman_render_total', "Attachments rendered, by whether the cached rendering was used.", ['result'])
+
+
+def stable_color(key):
+    """A colour derived from key, the same on every call and every run."""
+    return "#" + hashlib.md5(key.encode('utf-8')).hexdigest()[:6]
+
+
+def serialize(value):
+    return slackapi.Encoded(json.dumps(value, separators=(',', ':')))
+
+
+def join(fragments):
+    """One JSON array from already serialised elements."""
+    return slackapi.Encoded("[" + ",".join(fragments) + "]")
+
+
+class RenderCache(object):
+    """Serialised payloads by name, each rebuilt only when its key changes.
+
+    The key is whatever the payload is rendered from, so a hit costs one
+    comparison and the JSON goes out as it was first serialised. Only the
+    latest rendering of each name is kept.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def render(self, name, key, build):
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] == key:
+            RENDERS.inc(result='hit')
+            return entry[1]
+        value = serialize(build())
+        self.entries[name] = (key, value)
+        RENDERS.inc(result='miss')
+        return value
+
+    def invalidate(self, name=None):
+        if name is None:
+            self.entries = {}
+        else:
+            self.entries.pop(name, None)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,139 @@
+import collections
+import logging
+import re
+import threading
+import time
+
+
+MEMORY_UNITS = {
+    '': 1,
+    'K': 1 << 10,
+    'M': 1 << 20,
+    'G': 1 << 30,
+    'T': 1 << 40,
+}
+
+MEMORY_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", re.IGNORECASE)
+
+# servers without a priority; higher priorities are evicted last
+DEFAULT_PRIORITY = 0
+
+START = 'start'
+QUEUE = 'queue'
+
+
+def parse_memory(value):
+    """Bytes for a JVM-style size such as '1536M' or '8G'; None if unset."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    m = MEMORY_PATTERN.match(value)
+    if m is None:
+        raise ValueError("invalid memory size '{}'".format(value))
+    return int(float(m.group(1)) * MEMORY_UNITS[m.group(2).upper()])
+
+
+def format_memory(size):
+    for unit in ('T', 'G', 'M', 'K'):
+        if size >= MEMORY_UNITS[unit]:
+            return "{:.1f}{}".format(size / float(MEMORY_UNITS[unit]), unit)
+    return "{}B".format(size)
+
+
+class Scheduler(object):
+    """Tracks player counts and decides which servers may run.
+
+    observe() is fed each server's player count on every tick: a number
+    when the server answers pings, None when it's running but not ready, or
+    not called at all once it's stopped. Servers that stay empty for longer
+    than their idle timeout are reported by idle(). plan_start() checks a
+    start against the host's memory budget and names the idle servers to
+    stop to make room, or says to queue the start.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.players = {}
+        self.empty_since = {}
+        self.queue = collections.OrderedDict()
+
+    def observe(self, server_id, players):
+        now = self.clock()
+        with self.lock:
+            self.players[server_id] = players
+            if players == 0:
+                self.empty_since.setdefault(server_id, now)
+            else:
+                self.empty_since.pop(server_id, None)
+
+    def forget(self, server_id):
+        with self.lock:
+            self.players.pop(server_id, None)
+            self.empty_since.pop(server_id, None)
+
+    def idle_for(self, server_id):
+        since = self.empty_since.get(server_id)
+        if since is None:
+            return None
+        return self.clock() - since
+
+    def idle(self, timeouts):
+        """Server IDs that have been empty longer than their timeout (seconds)."""
+        result = []
+        with self.lock:
+            for server_id, since in self.empty_since.items():
+                timeout = timeouts.get(server_id)
+                if timeout and self.clock() - since >= timeout:
+                    result.append(server_id)
+        return result
+
+    def plan_start(self, server, running, budget):
+        """Decide whether server can start on a host running `running`.
+
+        Returns (START, [servers to stop first]) or (QUEUE, []).
+        """
+        needed = parse_memory(server.get('memory')) or 0
+        if budget is None or needed == 0:
+            return START, []
+
+        used = sum(parse_memory(s.get('memory')) or 0 for s in running)
+        if used + needed <= budget:
+            return START, []
+
+        # evict empty servers that don't outrank this one, lowest priority and
+        # longest idle first
+        priority = server.get('priority', DEFAULT_PRIORITY)
+        with self.lock:
+            candidates = [s for s in running
+                          if s['id'] in self.empty_since and s.get('priority', DEFAULT_PRIORITY) <= priority]
+            candidates.sort(key=lambda s: (s.get('priority', DEFAULT_PRIORITY), self.empty_since[s['id']]))
+
+        evict = []
+        for s in candidates:
+            if used + needed <= budget:
+                break
+            evict.append(s)
+            used -= parse_memory(s.get('memory')) or 0
+        if used + needed <= budget:
+            logging.info("Starting {} needs {}; stopping idle {}.".format(
+                server['id'], format_memory(needed), [s['id'] for s in evict]))
+            return START, evict
+
+        logging.info("Not enough memory to start {} ({} needed, {} of {} in use).".format(
+            server['id'], format_memory(needed), format_memory(used), format_memory(budget)))
+        return QUEUE, []
+
+    def enqueue(self, server_id, request):
+        with self.lock:
+            self.queue[server_id] = request
+            return list(self.queue).index(server_id) + 1
+
+    def queued(self):
+        with self.lock:
+            return list(self.queue.items())
+
+    def dequeue(self, server_id):
+        with self.lock:
+            return self.queue.pop(server_id, None)
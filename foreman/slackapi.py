@@ -0,0 +1,309 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+import requests.adapters
+
+import metrics
+
+
+SLACK_API_URL = "https://slack.com/api/"
+
+# request priorities; lower runs first
+PRIORITY_REPLY = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# requests per minute for each of Slack's rate limit tiers
+TIER_LIMITS = {
+    1: 1,
+    2: 20,
+    3: 50,
+    4: 100,
+}
+
+METHOD_TIERS = {
+    'auth.test': 4,
+    'users.info': 4,
+    'users.list': 2,
+    'im.list': 2,
+    'conversations.list': 2,
+    'chat.update': 3,
+}
+
+# methods limited per channel rather than per workspace, in requests a minute
+CHANNEL_LIMITS = {
+    'chat.postMessage': 60,
+}
+
+# unknown methods are assumed to be tier 3
+DEFAULT_TIER = 3
+
+# reads whose identical concurrent requests can share one response
+READ_METHODS = frozenset([
+    'auth.test',
+    'users.info',
+    'users.list',
+    'im.list',
+    'conversations.list',
+    'conversations.info',
+])
+
+MAX_RETRIES = 3
+
+# seconds to back off after a 429 that doesn't say how long to wait
+DEFAULT_RETRY_AFTER = 30
+
+ERRORS = metrics.Counter('foreman_slack_api_errors_total', "Slack Web API requests that failed or were rate limited.",
+                         ['method', 'error'])
+DURATION = metrics.Histogram('foreman_slack_api_duration_seconds', "Slack Web API request duration.", ['method'])
+QUEUED = metrics.Gauge('foreman_slack_api_queued', "Slack Web API calls waiting to be sent.")
+
+
+class TokenBucket(object):
+    """Allows `rate` operations per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.clock = clock
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # seconds until a token is available, 0 if one is available now
+        self.refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Encoded(str):
+    """A parameter already serialised to JSON, sent as it is."""
+
+
+class HttpTransport(object):
+    """Posts Web API calls over a pooled, keep-alive HTTP session."""
+
+    def __init__(self, token, base_url=SLACK_API_URL, pool_size=4, timeout=30):
+        self.token = token
+        self.base_url = base_url.rstrip('/') + '/'
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def encode(self, params):
+        data = {}
+        for key, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, Encoded):
+                value = str(value)
+            elif type(value) in (list, dict):
+                value = json.dumps(value)
+            elif type(value) is bool:
+                value = 'true' if value else 'false'
+            data[key] = value
+        return data
+
+    def call(self, method, params):
+        response = self.session.post(
+            self.base_url + method,
+            data=self.encode(params),
+            headers={'Authorization': "Bearer {}".format(self.token)},
+            timeout=self.timeout)
+        try:
+            body = response.json()
+        except ValueError:
+            body = {'ok': False, 'error': "http_{}".format(response.status_code)}
+        return response.status_code, response.headers, body
+
+
+class Request(object):
+    def __init__(self, method, params, priority, key):
+        self.method = method
+        self.params = params
+        self.priority = priority
+        self.key = key
+        self.future = Future()
+        self.attempts = 0
+        self.started = False
+
+
+class SlackApi(object):
+    """Schedules outbound Web API calls.
+
+    Calls are queued by priority and released as each method's token bucket
+    allows, so command replies go out ahead of background refreshes and a
+    burst never runs into Slack's tier limits. Identical concurrent reads
+    share a single request. A 429 pauses the method for Retry-After seconds
+    and requeues the call.
+    """
+
+    def __init__(self, transport, workers=4, clock=time.monotonic):
+        self.transport = transport
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.queue = []
+        self.sequence = itertools.count()
+        self.buckets = {}
+        self.blocked_until = {}
+        self.inflight = {}
+        self.threads = []
+        QUEUED.callback = lambda: len(self.queue)
+        for i in range(workers):
+            thread = threading.Thread(target=self.work, name="slack-api-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def call(self, method, priority=PRIORITY_NORMAL, timeout=None, **params):
+        return self.submit(method, priority, **params).result(timeout)
+
+    def submit(self, method, priority=PRIORITY_NORMAL, **params):
+        key = None
+        if method in READ_METHODS:
+            key = (method, json.dumps(params, sort_keys=True, default=str))
+
+        with self.cond:
+            if key is not None:
+                request = self.inflight.get(key)
+                if request is not None:
+                    logging.debug("Coalescing {} with a pending request.".format(method))
+                    if priority < request.priority and not request.started:
+                        # queue it again at the better priority; whichever
+                        # entry comes up first runs it
+                        request.priority = priority
+                        self.push(request)
+                    return request.future
+            request = Request(method, params, priority, key)
+            if key is not None:
+                self.inflight[key] = request
+            self.push(request)
+        return request.future
+
+    def push(self, request):
+        heapq.heappush(self.queue, (request.priority, next(self.sequence), request))
+        self.cond.notify()
+
+    def bucket_key(self, method, params):
+        if method in CHANNEL_LIMITS:
+            return (method, params.get('channel'))
+        return method
+
+    def bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if type(key) is tuple:
+                per_minute = CHANNEL_LIMITS[key[0]]
+            else:
+                per_minute = TIER_LIMITS[METHOD_TIERS.get(key, DEFAULT_TIER)]
+            # allow a short burst, as Slack does
+            bucket = self.buckets[key] = TokenBucket(per_minute / 60.0, max(1, per_minute // 10), self.clock)
+        return bucket
+
+    def next_request(self):
+        # called with the condition held; returns a request or how long to wait
+        now = self.clock()
+        wait = None
+        skipped = []
+        request = None
+        while self.queue:
+            entry = heapq.heappop(self.queue)
+            candidate = entry[2]
+            if candidate.started or candidate.future.done():
+                continue
+            key = self.bucket_key(candidate.method, candidate.params)
+            delay = self.blocked_until.get(candidate.method, 0) - now
+            if delay <= 0:
+                delay = self.bucket(key).delay()
+            if delay <= 0:
+                self.bucket(key).take()
+                request = candidate
+                break
+            skipped.append(entry)
+            if wait is None or delay < wait:
+                wait = delay
+        for entry in skipped:
+            heapq.heappush(self.queue, entry)
+        if request is not None:
+            request.started = True
+            return request, None
+        return None, wait
+
+    def work(self):
+        while True:
+            with self.cond:
+                while True:
+                    request, wait = self.next_request()
+                    if request is not None:
+                        break
+                    self.cond.wait(wait)
+            self.execute(request)
+
+    def execute(self, request):
+        request.attempts += 1
+        started = time.perf_counter()
+        try:
+            status, headers, body = self.transport.call(request.method, request.params)
+        except Exception as e:
+            ERRORS.inc(method=request.method, error=type(e).__name__)
+            if request.attempts < MAX_RETRIES:
+                logging.warning("{} failed ({}), retrying.".format(request.method, e))
+                self.retry(request, request.attempts)
+                return
+            self.finish(request, error=e)
+            return
+        finally:
+            DURATION.observe(time.perf_counter() - started, method=request.method)
+
+        if not body.get('ok', True):
+            ERRORS.inc(method=request.method, error=body.get('error'))
+        if status == 429 or body.get('error') == 'ratelimited':
+            retry_after = headers.get('Retry-After')
+            try:
+                retry_after = float(retry_after)
+            except (TypeError, ValueError):
+                retry_after = DEFAULT_RETRY_AFTER
+            logging.warning("Rate limited on {}; pausing it for {} seconds.".format(request.method, retry_after))
+            if request.attempts < MAX_RETRIES:
+                self.retry(request, retry_after)
+                return
+        self.finish(request, result=body)
+
+    def retry(self, request, delay):
+        with self.cond:
+            until = self.clock() + delay
+            if until > self.blocked_until.get(request.method, 0):
+                self.blocked_until[request.method] = until
+            request.started = False
+            self.push(request)
+            self.cond.notify_all()
+
+    def finish(self, request, result=None, error=None):
+        with self.cond:
+            if request.key is not None and self.inflight.get(request.key) is request:
+                del self.inflight[request.key]
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(result)
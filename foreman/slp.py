@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+import re
+import struct
+import time
+
+
+DEFAULT_PORT = 25565
+
+# seconds before a probe result is refreshed
+DEFAULT_TTL = 5
+
+# seconds a probe may take, connect included
+DEFAULT_TIMEOUT = 3
+
+# -1 asks the server to report its own protocol version
+PROTOCOL_VERSION = -1
+
+# responses larger than this aren't a status response
+MAX_PACKET_LENGTH = 1 << 20
+
+FORMATTING_CODES = re.compile("§.")
+
+
+class ProtocolException(Exception):
+    def __init__(self, message):
+        super(ProtocolException, self).__init__(message)
+        self.message = message
+
+
+class ServerStatus(object):
+    """What a Server List Ping reported, or why it failed."""
+
+    def __init__(self, host, port, response=None, latency=None, error=None):
+        self.host = host
+        self.port = port
+        self.response = response or {}
+        self.latency = latency
+        self.error = error
+        self.checked_at = time.time()
+
+    @property
+    def ready(self):
+        return self.error is None
+
+    @property
+    def version(self):
+        return (self.response.get('version') or {}).get('name')
+
+    @property
+    def online(self):
+        return (self.response.get('players') or {}).get('online')
+
+    @property
+    def max(self):
+        return (self.response.get('players') or {}).get('max')
+
+    @property
+    def players(self):
+        sample = (self.response.get('players') or {}).get('sample') or []
+        return [p.get('name') for p in sample if p.get('name')]
+
+    @property
+    def motd(self):
+        return FORMATTING_CODES.sub('', flatten_text(self.response.get('description'))).strip()
+
+    def __repr__(self):
+        if self.error:
+            return "<ServerStatus {}:{} error={}>".format(self.host, self.port, self.error)
+        return "<ServerStatus {}:{} {}/{} {:.0f}ms>".format(self.host, self.port, self.online, self.max, self.latency or 0)
+
+
+def flatten_text(component):
+    # descriptions are a plain string or a chat component with nested extras
+    if component is None:
+        return ''
+    if isinstance(component, str):
+        return component
+    if isinstance(component, list):
+        return ''.join(flatten_text(c) for c in component)
+    text = component.get('text', '')
+    for extra in component.get('extra', []):
+        text += flatten_text(extra)
+    return text
+
+
+def pack_varint(value):
+    value &= 0xFFFFFFFF
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def pack_string(value):
+    data = value.encode('utf-8')
+    return pack_varint(len(data)) + data
+
+
+def pack_packet(packet_id, payload=b''):
+    body = pack_varint(packet_id) + payload
+    return pack_varint(len(body)) + body
+
+
+def unpack_varint(data, offset=0):
+    result = 0
+    for i in range(5):
+        if offset >= len(data):
+            raise ProtocolException("truncated VarInt")
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            if result & 0x80000000:
+                result -= 1 << 32
+            return result, offset
+    raise ProtocolException("VarInt is too long")
+
+
+async def read_varint(reader):
+    result = 0
+    for i in range(5):
+        byte = (await reader.readexactly(1))[0]
+        result |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return result
+    raise ProtocolException("VarInt is too long")
+
+
+async def read_packet(reader):
+    length = await read_varint(reader)
+    if length <= 0 or length > MAX_PACKET_LENGTH:
+        raise ProtocolException("bad packet length {}".format(length))
+    data = await reader.readexactly(length)
+    packet_id, offset = unpack_varint(data)
+    return packet_id, data[offset:]
+
+
+async def exchange(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        handshake = pack_varint(PROTOCOL_VERSION) + pack_string(host) + struct.pack('>H', port) + pack_varint(1)
+        writer.write(pack_packet(0x00, handshake) + pack_packet(0x00))
+        await writer.drain()
+
+        packet_id, payload = await read_packet(reader)
+        if packet_id != 0x00:
+            raise ProtocolException("expected a status response, got packet {}".format(packet_id))
+        length, offset = unpack_varint(payload)
+        response = json.loads(payload[offset:offset + length].decode('utf-8'))
+
+        started = time.monotonic()
+        token = int(time.time() * 1000)
+        writer.write(pack_packet(0x01, struct.pack('>q', token)))
+        await writer.drain()
+        packet_id, payload = await read_packet(reader)
+        latency = (time.monotonic() - started) * 1000
+        if packet_id != 0x01 or struct.unpack('>q', payload[:8])[0] != token:
+            raise ProtocolException("bad pong")
+        return response, latency
+    finally:
+        writer.close()
+
+
+async def ping(host, port=DEFAULT_PORT, timeout=DEFAULT_TIMEOUT):
+    """Run a Server List Ping and return a ServerStatus; never raises."""
+    try:
+        response, latency = await asyncio.wait_for(exchange(host, port), timeout)
+        return ServerStatus(host, port, response=response, latency=latency)
+    except asyncio.TimeoutError:
+        return ServerStatus(host, port, error="timed out")
+    except (OSError, EOFError, ValueError, ProtocolException) as e:
+        return ServerStatus(host, port, error=str(e) or type(e).__name__)
+
+
+class Prober(object):
+    """Caches Server List Ping results briefly and probes servers concurrently."""
+
+    def __init__(self, ttl=DEFAULT_TTL, timeout=DEFAULT_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.results = {}
+        self.pending = {}
+
+    async def probe(self, host, port=DEFAULT_PORT):
+        key = (host, port)
+        status = self.results.get(key)
+        if status is not None and time.time() - status.checked_at < self.ttl:
+            return status
+
+        # share an in-flight probe of the same address
+        task = self.pending.get(key)
+        if task is None:
+            task = self.pending[key] = asyncio.ensure_future(ping(host, port, self.timeout))
+            task.add_done_callback(lambda t: self.pending.pop(key, None))
+        status = await task
+        self.results[key] = status
+        logging.debug("Probed {}:{}: {}".format(host, port, status))
+        return status
+
+    async def probe_many(self, addresses):
+        statuses = await asyncio.gather(*[self.probe(host, port) for host, port in addresses])
+        return dict(zip(addresses, statuses))
@@ -0,0 +1,217 @@
+import collections
+import logging
+import re
+import threading
+import time
+
+import metrics
+
+
+# samples kept per container; Docker sends one a second
+DEFAULT_WINDOW = 60
+
+# seconds to wait for a new subscription's first samples before replying
+FIRST_SAMPLE_TIMEOUT = 3
+
+XMX_PATTERN = re.compile(r"-Xmx(\d+[kKmMgGtT]?)")
+
+SUBSCRIPTIONS = metrics.Gauge('foreman_stats_subscriptions', "Containers with a docker stats stream open.")
+
+
+def parse_xmx(command):
+    """The -Xmx value in a container's command line, e.g. '1536M', or None."""
+    if not command:
+        return None
+    if isinstance(command, (list, tuple)):
+        command = " ".join(command)
+    m = XMX_PATTERN.search(command)
+    if m is None:
+        return None
+    return m.group(1).upper()
+
+
+class Sample(object):
+    """One docker stats reading, reduced to what the stats command shows."""
+
+    def __init__(self, raw, at=None):
+        self.at = at if at is not None else time.time()
+
+        cpu = raw.get('cpu_stats') or {}
+        precpu = raw.get('precpu_stats') or {}
+        cpu_delta = (cpu.get('cpu_usage') or {}).get('total_usage', 0) - (precpu.get('cpu_usage') or {}).get('total_usage', 0)
+        system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+        cpus = cpu.get('online_cpus') or len((cpu.get('cpu_usage') or {}).get('percpu_usage') or []) or 1
+        # the first sample of a stream has no previous reading to compare to
+        self.cpu = None
+        if precpu.get('system_cpu_usage') and system_delta > 0 and cpu_delta >= 0:
+            self.cpu = cpu_delta / float(system_delta) * cpus * 100
+
+        memory = raw.get('memory_stats') or {}
+        details = memory.get('stats') or {}
+        # page cache isn't the JVM's; cgroup v1 reports it as cache, v2 as
+        # inactive_file
+        cache = details.get('total_inactive_file', details.get('inactive_file', details.get('cache', 0)))
+        self.memory = max(0, memory.get('usage', 0) - cache)
+        self.memory_limit = memory.get('limit')
+
+        self.rx = self.tx = 0
+        for network in (raw.get('networks') or {}).values():
+            self.rx += network.get('rx_bytes', 0)
+            self.tx += network.get('tx_bytes', 0)
+
+        self.read = self.written = 0
+        for entry in (raw.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []:
+            op = (entry.get('op') or '').lower()
+            if op == 'read':
+                self.read += entry.get('value', 0)
+            elif op == 'write':
+                self.written += entry.get('value', 0)
+
+
+class StatsWindow(object):
+    """The last `size` samples for one container."""
+
+    def __init__(self, size=DEFAULT_WINDOW):
+        self.samples = collections.deque(maxlen=size)
+        self.peak_memory = 0
+        self.lock = threading.Lock()
+
+    def add(self, sample):
+        with self.lock:
+            self.samples.append(sample)
+            # the peak outlives the window, for sizing -Xmx
+            self.peak_memory = max(self.peak_memory, sample.memory)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def summary(self):
+        """Current, average and peak figures over the window, or None if empty."""
+        with self.lock:
+            samples = list(self.samples)
+            peak_memory = self.peak_memory
+        if not samples:
+            return None
+        first, last = samples[0], samples[-1]
+        cpus = [s.cpu for s in samples if s.cpu is not None]
+        elapsed = last.at - first.at
+
+        def rate(attr):
+            if elapsed <= 0:
+                return None
+            return max(0, getattr(last, attr) - getattr(first, attr)) / elapsed
+
+        return {
+            'cpu': last.cpu,
+            'cpu_avg': sum(cpus) / len(cpus) if cpus else None,
+            'cpu_peak': max(cpus) if cpus else None,
+            'memory': last.memory,
+            'memory_peak': peak_memory,
+            'memory_limit': last.memory_limit,
+            'rx': last.rx,
+            'tx': last.tx,
+            'rx_rate': rate('rx'),
+            'tx_rate': rate('tx'),
+            'read': last.read,
+            'written': last.written,
+            'read_rate': rate('read'),
+            'write_rate': rate('written'),
+            'window': elapsed,
+            'samples': len(samples),
+        }
+
+
+class Subscription(object):
+    def __init__(self, key, client, container_id, window):
+        self.key = key
+        self.client = client
+        self.container_id = container_id
+        self.window = window
+        self.stopping = False
+        self.first_sample = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="stats-{}".format(self.key))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        logging.info("Subscribing to stats for {} ({}).".format(self.key, self.container_id[:12]))
+        stream = None
+        try:
+            stream = self.client.api.stats(self.container_id, stream=True, decode=True)
+            for raw in stream:
+                if self.stopping:
+                    break
+                sample = Sample(raw)
+                self.window.add(sample)
+                # CPU usage needs a second reading
+                if sample.cpu is not None:
+                    self.first_sample.set()
+        except Exception as e:
+            if not self.stopping:
+                logging.warning("Stats stream for {} failed: {}".format(self.key, e))
+        finally:
+            if stream is not None:
+                stream.close()
+        logging.info("Stats stream for {} ended.".format(self.key))
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+class StatsCollector(object):
+    """One streaming docker stats subscription per running server.
+
+    Each stream feeds a rolling StatsWindow in the background, so a stats
+    request reads what's already been collected instead of waiting on a
+    one-shot call per container. sync() is given the servers that are
+    running and opens or closes streams to match; a stream also ends by
+    itself when its container stops. A container's window is kept across
+    reconnects and dropped when the server is no longer running.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window_size = window
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.windows = {}
+        SUBSCRIPTIONS.callback = lambda: sum(1 for s in list(self.subscriptions.values()) if s.alive())
+
+    def subscribe(self, key, client, container_id):
+        with self.lock:
+            subscription = self.subscriptions.get(key)
+            if subscription is not None and subscription.container_id == container_id and subscription.alive():
+                return subscription
+            if subscription is not None:
+                subscription.stopping = True
+            window = self.windows.get(key)
+            if window is None or subscription.container_id != container_id:
+                window = self.windows[key] = StatsWindow(self.window_size)
+            subscription = self.subscriptions[key] = Subscription(key, client, container_id, window).start()
+            return subscription
+
+    def unsubscribe(self, key):
+        with self.lock:
+            subscription = self.subscriptions.pop(key, None)
+            self.windows.pop(key, None)
+        if subscription is not None:
+            subscription.stopping = True
+
+    def sync(self, running):
+        """Subscribe to each of {key: (client, container ID)}; drop the rest."""
+        for key in [k for k in list(self.subscriptions) if k not in running]:
+            self.unsubscribe(key)
+        return dict((key, self.subscribe(key, client, container_id))
+                    for key, (client, container_id) in running.items())
+
+    def summary(self, key, timeout=0):
+        """Window summary for key, waiting up to timeout for usable samples."""
+        subscription = self.subscriptions.get(key)
+        if subscription is None:
+            return None
+        if timeout:
+            subscription.first_sample.wait(timeout)
+        return subscription.window.summary()
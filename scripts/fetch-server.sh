@@ -4,15 +4,16 @@ set -x
 set -e
 
 usage() {
-    echo "$0 [-x] [-v <version>] [-t release|snapshot] [-H] [-s <seed>]"
+    echo "$0 [-x] [-v <version>] [-t release|snapshot] [-H] [-s <seed>] [-c <dir>]"
     echo "         -x                   show debug output"
     echo "         -v <version>         specify a version to download, defaults to latest for the type"
     echo "         -t release|snapshot  type of server, defaults to 'release'"
     echo "         -s <seed>            generate ('g') or use a seed value"
     echo "         -H                   add a 'Hardcore' tag to the motd"
+    echo "         -c <dir>             reuse and fill a cache of server jars, one directory per version"
 }
 
-while getopts "h?xv:t:Hs:" opt; do
+while getopts "h?xv:t:Hs:c:" opt; do
     case "$opt" in
     h | \?)
         usage
@@ -33,6 +34,9 @@ while getopts "h?xv:t:Hs:" opt; do
     H)
         hardcore="1"
         ;;
+    c)
+        cache=$OPTARG
+        ;;
     esac
 done
 shift "$(($OPTIND - 1))"
@@ -67,8 +71,20 @@ echo "Fetching game version manifest..."
 curl -s -o ${version_manifest} -L ${version_manifest_url}
 
 server_file_url=$(jq -j '.downloads.server.url' ${version_manifest})
-echo "Fetching server jar..."
-curl -s -o minecraft_server.jar -L ${server_file_url}
+server_file_sha1=$(jq -j '.downloads.server.sha1' ${version_manifest})
+cached_jar="${cache}/${version}/minecraft_server.jar"
+if [ -n "${cache}" ] && [ -f "${cached_jar}" ] && echo "${server_file_sha1}  ${cached_jar}" | sha1sum -c --status; then
+    echo "Using cached server jar."
+    cp "${cached_jar}" minecraft_server.jar
+else
+    echo "Fetching server jar..."
+    curl -s -o minecraft_server.jar -L ${server_file_url}
+    echo "${server_file_sha1}  minecraft_server.jar" | sha1sum -c --status
+    if [ -n "${cache}" ]; then
+        mkdir -p "${cache}/${version}"
+        cp minecraft_server.jar "${cached_jar}"
+    fi
+fi
 echo "Server fetched."
 
 if [ -w server.properties ]; then